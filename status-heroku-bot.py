@@ -5,20 +5,38 @@ try:
     from anyio import CancelScope
 except ImportError:
     from anyio._backends._asyncio import CancelScope
-import subprocess
 import psutil
 import json
+import hashlib
+import hmac
+import secrets
+import socket
+import shutil
+import sys
+import sqlite3
+import threading
 import tempfile
+import gzip
 import re
+import ctypes
+import ctypes.util
+import struct
 import asyncio
-import requests
+import types
+import copy
+import functools
+import heapq
+import math
+from collections import deque
+import aiohttp
+from aiohttp import web
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, ContextTypes, InlineQueryHandler,
     CallbackQueryHandler, ChosenInlineResultHandler
 )
-from telegram.error import TimedOut, NetworkError, BadRequest
+from telegram.error import TimedOut, NetworkError, BadRequest, RetryAfter, Forbidden
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
@@ -35,18 +53,116 @@ DEFAULT_CONFIG = {
     "BOT_VERSION": "1.0.7",
     "USER_IDS_FILE": "users.json",
     "LOG_FILE": "heroku.log",
+    "USERBOT_PID_FILE": "userbot.pid",
+    "BOT_API_BASE_URL": "",
+    "WEBHOOK": {
+        "ENABLED": False,
+        "PUBLIC_URL": "",
+        "PATH": "/telegram",
+        "LISTEN_HOST": "127.0.0.1",
+        "LISTEN_PORT": 8443,
+        "SECRET_TOKEN": "",
+        "MAX_CONNECTIONS": 40,
+        "HEALTH_CHECK_INTERVAL": 60
+    },
     "MONITORING": {
         "ENABLED": True,
         "CHECK_INTERVAL": 60,
+        "SAMPLE_INTERVAL": 5,
         "ALERTS": {
             "CPU_THRESHOLD": 85,
             "RAM_THRESHOLD": 85,
             "DISK_THRESHOLD": 90,
             "MIN_INTERVAL_BETWEEN_ALERTS": 300,
+            "FOR_SECONDS": 180,
+            "CLEAR_FOR_SECONDS": 60,
+            "CLEAR_MARGIN": 5,
+            "USERBOT_CPU_THRESHOLD": 0,
+            "USERBOT_RSS_MB_THRESHOLD": 0,
+            "RULES": [],
+            "COOLDOWNS": {},
+            "ACK_DURATION": 3600,
+            "STATE_FILE": "alerts.json",
             "NOTIFY_USERS": True,
             "NOTIFY_OWNER_ONLY": False
         }
     },
+    "LEAK_DETECTOR": {
+        "ENABLED": True,
+        "CHECK_INTERVAL": 300,
+        "WINDOW_HOURS": 6,
+        "MIN_SAMPLES": 60,
+        "WARMUP_MINUTES": 30,
+        "MIN_SPAN_MINUTES": 60,
+        "MIN_R2": 0.8,
+        "MIN_GROWTH_MB_PER_HOUR": 1,
+        "LIMIT_MB": 0,
+        "ALERT_HOURS": 24,
+        "RESTART_HOURS": 0
+    },
+    "DISK_INDEX": {
+        "ENABLED": True,
+        "INTERVAL": 600,
+        "FULL_RESCAN_HOURS": 24,
+        "TOP": 10
+    },
+    "BROADCAST": {
+        "GLOBAL_RATE": 25,
+        "PER_CHAT_INTERVAL": 1.0,
+        "MAX_CONCURRENCY": 20,
+        "MAX_RETRIES": 3
+    },
+    "SUPERVISOR": {
+        "ENABLED": True,
+        "RESTART_DELAY": 1,
+        "MAX_RESTART_DELAY": 60,
+        "BACKOFF_FACTOR": 2,
+        "STABLE_UPTIME": 60,
+        "CRASH_LOOP_RESTARTS": 5,
+        "CRASH_LOOP_WINDOW": 300
+    },
+    "READINESS": {
+        "READY_PATTERN": "",
+        "TIMEOUT": 60,
+        "STARTUP_GRACE": 5,
+        "HEALTH_HOST": "127.0.0.1",
+        "HEALTH_PORT": 0
+    },
+    "FLEET": [],
+    "OUTPUT_CAPTURE": {
+        "BUFFER_LINES": 1000,
+        "FILE": "",
+        "MAX_FILE_SIZE_MB": 10,
+        "BACKUP_COUNT": 3
+    },
+    "METRICS_HISTORY": {
+        "ENABLED": True,
+        "DB_FILE": "metrics.db",
+        "RAW_RETENTION_HOURS": 24,
+        "MINUTE_RETENTION_DAYS": 7,
+        "HOUR_RETENTION_DAYS": 90
+    },
+    "METRICS_EXPORTER": {
+        "ENABLED": False,
+        "HOST": "127.0.0.1",
+        "PORT": 9464,
+        "CACHE_TTL": 1
+    },
+    "PERFORMANCE": {
+        "LOOP_LAG_INTERVAL": 0.5,
+        "SLOW_HANDLER_MS": 300
+    },
+    "UPDATE_CHECK": {
+        "ENABLED": True,
+        "INTERVAL": 21600,
+        "CACHE_TTL": 300,
+        "BACKUPS_TO_KEEP": 5,
+        "STATE_FILE": "update_check.json"
+    },
+    "LOG_EXPORT": {
+        "COMPRESS": False,
+        "MAX_PART_SIZE_MB": 45
+    },
     "SCHEDULED_TASKS": {
         "ENABLED": True,
         "DAILY_REPORT_TIME": "09:00",
@@ -57,22 +173,22 @@ DEFAULT_CONFIG = {
     }
 }
 
+def merge_config_defaults(config, defaults):
+    """Рекурсивно дополняет конфигурацию недостающими значениями по умолчанию"""
+    for k, v in defaults.items():
+        if isinstance(v, dict):
+            config[k] = merge_config_defaults(config.get(k, {}), v)
+        else:
+            config.setdefault(k, v)
+    return config
+
 def load_config():
     """Загружает конфигурацию из файла"""
     try:
         if os.path.exists(CONFIG_FILE):
             with open(CONFIG_FILE, 'r') as f:
                 config = json.load(f)
-                # Рекурсивно обновляем недостающие значения
-                def update_dict(d, u):
-                    for k, v in u.items():
-                        if isinstance(v, dict):
-                            d[k] = update_dict(d.get(k, {}), v)
-                        else:
-                            d.setdefault(k, v)
-                    return d
-                config = update_dict(config, DEFAULT_CONFIG)
-                return config
+                return merge_config_defaults(config, DEFAULT_CONFIG)
         else:
             # Создаем файл конфигурации
             with open(CONFIG_FILE, 'w') as f:
@@ -87,6 +203,7 @@ def load_config():
 CONFIG = load_config()
 BOT_TOKEN = CONFIG["BOT_TOKEN"]
 OWNER_ID = CONFIG["OWNER_ID"]
+OWNER_USER_ID = int(OWNER_ID) if str(OWNER_ID).strip().isdigit() else None
 USERBOT_DIR = CONFIG["USERBOT_DIR"]
 VENV_PYTHON = CONFIG["VENV_PYTHON"]
 PROXYCHAINS_PATH = CONFIG["PROXYCHAINS_PATH"]
@@ -94,33 +211,256 @@ GITHUB_REPO = CONFIG["GITHUB_REPO"]
 GITHUB_RAW_URL = CONFIG["GITHUB_RAW_URL"]
 BOT_VERSION = CONFIG["BOT_VERSION"]
 USER_IDS_FILE = CONFIG["USER_IDS_FILE"]
+# Роли хранятся рядом: сам USER_IDS_FILE остается списком ID, который читают и старые версии бота
+USER_ROLES_FILE = os.path.splitext(USER_IDS_FILE)[0] + ".roles.json"
 LOG_FILE = os.path.join(USERBOT_DIR, CONFIG["LOG_FILE"])
+USERBOT_PID_FILE = CONFIG["USERBOT_PID_FILE"]
+BOT_API_BASE_URL = CONFIG.get("BOT_API_BASE_URL", "")
 
 # Конфигурация мониторинга
 MONITORING_CONFIG = CONFIG.get("MONITORING", DEFAULT_CONFIG["MONITORING"])
 SCHEDULED_TASKS_CONFIG = CONFIG.get("SCHEDULED_TASKS", DEFAULT_CONFIG["SCHEDULED_TASKS"])
+LOG_EXPORT_CONFIG = CONFIG.get("LOG_EXPORT", DEFAULT_CONFIG["LOG_EXPORT"])
+METRICS_HISTORY_CONFIG = CONFIG.get("METRICS_HISTORY", DEFAULT_CONFIG["METRICS_HISTORY"])
+UPDATE_CHECK_CONFIG = CONFIG.get("UPDATE_CHECK", DEFAULT_CONFIG["UPDATE_CHECK"])
+PERFORMANCE_CONFIG = CONFIG.get("PERFORMANCE", DEFAULT_CONFIG["PERFORMANCE"])
+METRICS_EXPORTER_CONFIG = CONFIG.get("METRICS_EXPORTER", DEFAULT_CONFIG["METRICS_EXPORTER"])
+SUPERVISOR_CONFIG = CONFIG.get("SUPERVISOR", DEFAULT_CONFIG["SUPERVISOR"])
+READINESS_CONFIG = CONFIG.get("READINESS", DEFAULT_CONFIG["READINESS"])
+OUTPUT_CAPTURE_CONFIG = CONFIG.get("OUTPUT_CAPTURE", DEFAULT_CONFIG["OUTPUT_CAPTURE"])
+WEBHOOK_CONFIG = CONFIG.get("WEBHOOK", DEFAULT_CONFIG["WEBHOOK"])
+LEAK_DETECTOR_CONFIG = CONFIG.get("LEAK_DETECTOR", DEFAULT_CONFIG["LEAK_DETECTOR"])
+DISK_INDEX_CONFIG = CONFIG.get("DISK_INDEX", DEFAULT_CONFIG["DISK_INDEX"])
+# Лимиты рассылки (Telegram: ~30 сообщений/сек всего, ~1/сек в один чат)
+BROADCAST_CONFIG = CONFIG.get("BROADCAST", DEFAULT_CONFIG["BROADCAST"])
 
 # Команды для запуска
 USERBOT_CMD = f"{VENV_PYTHON} -m heroku --no-web"
 PROXY_CMD = f"{PROXYCHAINS_PATH} {VENV_PYTHON} -m heroku --no-web"
 
+def build_fleet(config):
+    """Список инстансов юзерботов: основной из USERBOT_DIR + записи FLEET из конфига"""
+    fleet = {
+        "main": {
+            "name": "main",
+            "dir": os.path.realpath(USERBOT_DIR),
+            "venv_python": VENV_PYTHON,
+            "use_proxy": False,
+            "log_file": LOG_FILE,
+            "primary": True
+        }
+    }
+    dirs = {fleet["main"]["dir"]}
+
+    for entry in config.get("FLEET", []):
+        name = str(entry.get("NAME", "")).strip()
+        userbot_dir = entry.get("DIR")
+        if not name or not userbot_dir:
+            print(f"Пропущен инстанс флота без NAME/DIR: {entry}")
+            continue
+        userbot_dir = os.path.realpath(userbot_dir)
+        if name in fleet or userbot_dir in dirs:
+            print(f"Пропущен дублирующийся инстанс флота: {name} ({userbot_dir})")
+            continue
+        dirs.add(userbot_dir)
+        fleet[name] = {
+            "name": name,
+            "dir": userbot_dir,
+            "venv_python": entry.get("VENV_PYTHON", VENV_PYTHON),
+            "use_proxy": bool(entry.get("USE_PROXY", False)),
+            "log_file": os.path.join(userbot_dir, entry.get("LOG_FILE", "heroku.log")),
+            "primary": False
+        }
+    return fleet
+
+FLEET_INSTANCES = build_fleet(CONFIG)
+
 # Глобальные переменные
 USER_IDS = set()
 DEBUG_CHATS = set()
 monitor_task = None
+# Отслеживание логов юзербота для дебаг-чатов (отдельно от цикла мониторинга)
+log_follow_task = None
 start_time = time.time()
 reconnect_attempts = 0
 is_reconnecting = True
 application_instance = None
 
-last_alert_time = {
+alert_cooldown = MONITORING_CONFIG["ALERTS"]["MIN_INTERVAL_BETWEEN_ALERTS"]
+
+# Правила алертов: имя -> правило (см. build_alert_rules) и состояние каждого правила.
+# Состояние (активен с, последнее уведомление, подтверждение) сохраняется в STATE_FILE
+alert_rules = {}
+alert_states = {}
+ALERT_PERSISTED_KEYS = ("state", "fired_at", "last_notified", "acked_until", "acked_by")
+# Переходы firing/resolved, ожидающие отправки (разбирает check_system_health)
+alert_events = deque(maxlen=100)
+ALERT_OPERATORS = {
+    ">": lambda value, threshold: value > threshold,
+    "<": lambda value, threshold: value < threshold
+}
+
+# Счетчики отправленных алертов (для экспорта метрик)
+alert_counts = {
     "CPU": 0,
     "RAM": 0,
     "DISK": 0,
     "USERBOT_DOWN": 0
 }
-alert_cooldown = MONITORING_CONFIG["ALERTS"]["MIN_INTERVAL_BETWEEN_ALERTS"]
 
+# Последнее измеренное время ответа Telegram API (сек)
+api_response_time_last = None
+
+# Запомненный процесс юзербота (вместо обхода всей таблицы процессов)
+userbot_process = {
+    "pid": None,
+    "create_time": None,
+    "last_scan": 0
+}
+USERBOT_SCAN_TTL = 10
+
+# Ресурсы дерева процессов юзербота. Объекты psutil.Process живут между сэмплами,
+# поэтому cpu_percent(interval=None) считает дельту с прошлого сэмпла без sleep
+userbot_tree_procs = {}
+userbot_tree_stats = None
+USERBOT_TREE_TOP = 5
+
+# Супервизор: держит дескриптор дочернего процесса и перезапускает юзербота при выходе
+userbot_supervisor = {
+    "process": None,
+    "use_proxy": False,
+    "desired": False,
+    "started": 0,
+    "restart_delay": SUPERVISOR_CONFIG["RESTART_DELAY"],
+    "restarts": deque(maxlen=100),
+    "total_restarts": 0,
+    "crash_loop": False,
+    "last_exit_code": None,
+    "last_exit_time": None,
+    "reader": None
+}
+supervisor_task = None
+
+# Готовность юзербота после запуска и время запуска/перезапуска
+userbot_readiness = {
+    "process": None,
+    "event": None,
+    "reason": None,
+    "log_offset": 0
+}
+userbot_start_stats = {
+    "last_ready_seconds": None,
+    "last_restart_seconds": None,
+    "ready_seconds": deque(maxlen=50),
+    "failures": 0
+}
+READY_POLL_INTERVAL = 0.25
+
+# Процессы и вывод дополнительных инстансов флота
+fleet_state = {}
+FLEET_OUTPUT_LINES = 200
+FLEET_STOP_TIMEOUT = 15
+FLEET_VIEW_LINES = 20
+
+# Вывод юзербота (stdout+stderr): кольцевой буфер и необязательный файл с ротацией
+userbot_output_buffer = deque(maxlen=OUTPUT_CAPTURE_CONFIG["BUFFER_LINES"])
+output_file_state = {
+    "file": None,
+    "size": 0
+}
+OUTPUT_READ_CHUNK_SIZE = 64 * 1024
+OUTPUT_MAX_LINE_LENGTH = 16 * 1024
+OUTPUT_TAIL_BYTES = 16 * 1024
+
+# Последний снимок метрик, который обновляет фоновый сэмплер
+metrics_snapshot = {}
+sampler_task = None
+
+# Задержка event loop и время работы обработчиков
+loop_lag_samples = deque(maxlen=240)
+loop_lag_stats = {
+    "last": 0.0,
+    "max": 0.0
+}
+loop_lag_task = None
+handler_stats = {}
+# Сколько раз сработал каждый маршрут (callback:<data>, callback:<префикс>*, command:<имя>)
+route_dispatch_counts = {}
+HANDLER_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Экспорт метрик в формате OpenMetrics
+exporter_runner = None
+exporter_cache = {
+    "body": None,
+    "rendered": 0
+}
+
+# Получение обновлений: вебхук (локальный aiohttp-сервер) или polling
+update_mode = "polling"
+webhook_runner = None
+webhook_secret = None
+webhook_health_task = None
+
+# HTTP-клиент GitHub с кэшем ответов по ETag
+github_session = None
+github_cache = {}
+update_check_task = None
+last_notified_version = None
+
+# Детектор утечек памяти юзербота: линейный тренд RSS по истории
+leak_state = {
+    "trend": None,
+    "last_restart": None
+}
+leak_detector_task = None
+
+# Индекс размеров USERBOT_DIR: листинги кэшируются по каталогам, через scandir заново читаются
+# только каталоги с изменившимся mtime (у остальных - только stat известных файлов).
+# Снимок заменяется целиком после каждого прохода
+disk_index = {
+    "dirs": {},
+    "root": None,
+    "total": 0,
+    "files": 0,
+    "top_files": [],
+    "top_dirs": [],
+    "updated": None,
+    "full_scan": None,
+    "duration": 0,
+    "rescanned": 0
+}
+disk_index_task = None
+
+# Планировщик задач (APScheduler)
+scheduler = None
+
+# Горячая перезагрузка config.json: файл проверяется по mtime и размеру
+CONFIG_WATCH_INTERVAL = 2
+CONFIG_SETTLE_DELAY = 0.5
+# Эти значения читаются только при запуске - их изменение требует перезапуска бота
+RESTART_REQUIRED_KEYS = (
+    "BOT_TOKEN", "OWNER_ID", "USERBOT_DIR", "VENV_PYTHON", "PROXYCHAINS_PATH",
+    "GITHUB_REPO", "GITHUB_RAW_URL", "BOT_VERSION", "USER_IDS_FILE", "LOG_FILE",
+    "USERBOT_PID_FILE", "BOT_API_BASE_URL", "WEBHOOK", "FLEET",
+    "METRICS_HISTORY.DB_FILE", "METRICS_EXPORTER.ENABLED", "METRICS_EXPORTER.HOST",
+    "METRICS_EXPORTER.PORT", "OUTPUT_CAPTURE.BUFFER_LINES"
+)
+config_watch_state = {
+    "signature": None,
+    "reloads": 0,
+    "last_reload": None,
+    "last_error": None,
+    "pending_restart": []
+}
+config_watcher_task = None
+
+# История метрик (SQLite в режиме WAL)
+metrics_db = None
+metrics_db_lock = threading.Lock()
+metrics_history_state = {
+    "minute_rollup": 0,
+    "hour_rollup": 0
+}
 
 
 # Буфер для дебаг-сообщений
@@ -138,89 +478,162 @@ RECONNECT_CONFIG = {
     'health_check_interval': 10
 }
 
+# Состояние token bucket для рассылки
+broadcast_bucket = {
+    "tokens": BROADCAST_CONFIG["GLOBAL_RATE"],
+    "updated": time.monotonic(),
+    "pruned": time.monotonic()
+}
+broadcast_lock = asyncio.Lock()
+chat_last_send = {}
+CHAT_LAST_SEND_PRUNE_INTERVAL = 60
+
+# Реестр пользователей: роль по int ID. Словарь заменяется целиком при изменении,
+# поэтому проверки доступа читают его без блокировок
+ROLE_LEVELS = {
+    "viewer": 1,
+    "user": 2,
+    "owner": 3
+}
+USER_ROLES = {}
+
+# Кэш доступных действий по пользователю (сбрасывается при изменении реестра)
+permission_cache = {}
+ACTION_ROLES = {}
+
+def normalize_user_id(value):
+    """Приводит ID пользователя к int (None, если это не ID)"""
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+def apply_user_roles(roles):
+    """Подменяет реестр новым снимком (владелец из конфига всегда owner)"""
+    global USER_ROLES, USER_IDS
+    roles = {uid: ("user" if role == "owner" else role) for uid, role in roles.items()}
+    if OWNER_USER_ID:
+        roles[OWNER_USER_ID] = "owner"
+    USER_ROLES = roles
+    USER_IDS = set(roles)
+    permission_cache.clear()
+
 def load_users():
-    """Загружает список пользователей из файла"""
-    global USER_IDS
+    """Загружает реестр пользователей: список ID из USER_IDS_FILE, роли из USER_ROLES_FILE"""
+    roles = {}
+    file_exists = os.path.exists(USER_IDS_FILE)
     try:
-        if os.path.exists(USER_IDS_FILE):
+        if file_exists:
             with open(USER_IDS_FILE, 'r') as f:
-                USER_IDS = set(json.load(f))
-        else:
-            if OWNER_ID and OWNER_ID.isdigit():
-                USER_IDS = {int(OWNER_ID)}
-            else:
-                USER_IDS = set()
-            save_users(USER_IDS)
+                data = json.load(f)
+            saved_roles = {}
+            if isinstance(data, dict):
+                # Промежуточный формат {"users": {id: роль}} - переводим обратно в список + роли
+                saved_roles = data.get("users", {})
+                data = list(saved_roles)
+            elif os.path.exists(USER_ROLES_FILE):
+                with open(USER_ROLES_FILE, 'r') as f:
+                    saved_roles = json.load(f).get("users", {})
+
+            # Список главный: ID, добавленные старой версией, получают роль user,
+            # удаленные ею - пропадают и из ролей
+            for uid in data:
+                uid = normalize_user_id(uid)
+                if uid is None:
+                    continue
+                role = saved_roles.get(str(uid), "user")
+                roles[uid] = role if role in ROLE_LEVELS else "user"
     except Exception as e:
         print(f"Ошибка загрузки пользователей: {e}")
-        USER_IDS = set()
 
-def save_users(users):
-    """Сохраняет список пользователей в файл"""
-    global USER_IDS
+    apply_user_roles(roles)
+    if not file_exists or not os.path.exists(USER_ROLES_FILE):
+        save_users()
+
+def write_json_atomic(path, data, prefix):
+    """Атомарно записывает JSON (временный файл + fsync + rename)"""
+    directory = os.path.dirname(os.path.abspath(path))
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def save_users():
+    """Сохраняет реестр: роли в USER_ROLES_FILE, список ID (старый формат) в USER_IDS_FILE"""
     try:
-        with open(USER_IDS_FILE, 'w') as f:
-            json.dump(list(users), f)
-        USER_IDS = users
+        write_json_atomic(USER_ROLES_FILE, {"users": {str(uid): role for uid, role in USER_ROLES.items()}}, ".users-roles-")
+        write_json_atomic(USER_IDS_FILE, sorted(USER_ROLES), ".users-")
     except Exception as e:
         print(f"Ошибка сохранения пользователей: {e}")
 
-def is_owner(user_id):
-    """Проверяет, является ли пользователь владельцем"""
-    return str(user_id) == str(OWNER_ID)
-
-def is_user(user_id):
-    """Проверяет, имеет ли пользователь доступ"""
-    return str(user_id) in [str(uid) for uid in USER_IDS] or is_owner(user_id)
-
-def get_system_info():
-    cpu = psutil.cpu_percent(interval=1)
-    ram = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
-    uptime = time.time() - psutil.boot_time()
-
-    # Дополнительная информация
-    boot_time = datetime.fromtimestamp(psutil.boot_time()).strftime("%Y-%m-%d %H:%M:%S")
-    load_avg = os.getloadavg() if hasattr(os, 'getloadavg') else "N/A"
+def set_user_role(user_id, role="user"):
+    """Добавляет пользователя или меняет его роль (владельца изменить нельзя)"""
+    user_id = normalize_user_id(user_id)
+    if user_id is None or role not in ("user", "viewer") or user_id == OWNER_USER_ID:
+        return False
+    roles = dict(USER_ROLES)
+    roles[user_id] = role
+    apply_user_roles(roles)
+    save_users()
+    return True
+
+def remove_user(user_id):
+    """Удаляет пользователя из реестра (владельца удалить нельзя)"""
+    user_id = normalize_user_id(user_id)
+    if user_id is None or user_id == OWNER_USER_ID or user_id not in USER_ROLES:
+        return False
+    roles = dict(USER_ROLES)
+    del roles[user_id]
+    apply_user_roles(roles)
+    save_users()
+    return True
 
-    # Информация о сети
-    net_io = psutil.net_io_counters()
+def get_user_role(user_id):
+    """Роль пользователя: owner, user, viewer или None"""
+    return USER_ROLES.get(user_id)
 
-    # Информация о боте 
-    bot_uptime = 0
-    bot_start_time = "N/A"
-    if 'start_time' in globals():
-        bot_uptime = time.time() - start_time
-        bot_start_time = datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S")
-
-    info = (
-        f"🤖 **Bot Information:**\n"
-        f"• Version: {BOT_VERSION}\n"
-        f"• Uptime: {int(bot_uptime // 3600)}h {int((bot_uptime % 3600) // 60)}m\n"
-        f"• Started: {bot_start_time}\n\n"
-
-        f"🖥 **System Information:**\n"
-        f"• CPU: {cpu}%\n"
-        f"• Load: {load_avg}\n"
-        f"• RAM: {ram.percent}% ({ram.used // (1024**3)}/{ram.total // (1024**3)} GB)\n"
-        f"• Disk: {disk.percent}% ({disk.used // (1024**3)}/{disk.total // (1024**3)} GB)\n"
-        f"• Uptime: {int(uptime // 3600)}h {int((uptime % 3600) // 60)}m\n"
-        f"• Boot: {boot_time}\n\n"
-
-        f"🌐 **Network Information:**\n"
-        f"• Sent: {net_io.bytes_sent // (1024**2)} MB\n"
-        f"• Received: {net_io.bytes_recv // (1024**2)} MB\n\n"
-
-        f"👥 **User Information:**\n"
-        f"• Total Users: {len(USER_IDS)}\n"
-        f"• Debug Chats: {len(DEBUG_CHATS)}"
-    )
+def has_role(user_id, role):
+    """Проверяет, что роль пользователя не ниже требуемой"""
+    return ROLE_LEVELS.get(USER_ROLES.get(user_id), 0) >= ROLE_LEVELS[role]
 
-    return info
+def is_owner(user_id):
+    """Проверяет, является ли пользователь владельцем"""
+    return OWNER_USER_ID is not None and user_id == OWNER_USER_ID
 
-def get_detailed_metrics():
-    """Получает подробные метрики системы"""
-    cpu = psutil.cpu_percent(interval=1)
+def is_user(user_id):
+    """Проверяет, имеет ли пользователь доступ (любая роль)"""
+    return user_id in USER_ROLES
+
+def get_user_permissions(user_id):
+    """Множество действий, доступных пользователю (считается один раз и кэшируется)"""
+    permissions = permission_cache.get(user_id)
+    if permissions is not None:
+        return permissions
+
+    if user_id not in USER_ROLES:
+        # Посторонних не кэшируем, чтобы кэш не рос от случайных ID
+        return frozenset()
+
+    permissions = frozenset(action for action, role in ACTION_ROLES.items() if has_role(user_id, role))
+    permission_cache[user_id] = permissions
+    return permissions
+
+def can_run_action(user_id, action):
+    """Проверяет право пользователя на действие из таблицы действий"""
+    return action in get_user_permissions(user_id)
+
+def collect_metrics():
+    """Снимает метрики системы (без блокирующего интервала CPU)"""
+    # interval=None возвращает загрузку с момента предыдущего вызова
+    cpu = psutil.cpu_percent(interval=None)
     ram = psutil.virtual_memory()
     disk = psutil.disk_usage('/')
 
@@ -236,20 +649,274 @@ def get_detailed_metrics():
     # Сетевая активность
     net_io = psutil.net_io_counters()
 
-    return {
+    metrics = {
+        "timestamp": time.time(),
         "cpu": cpu,
         "ram_percent": ram.percent,
         "ram_used": ram.used // (1024**3),
         "ram_total": ram.total // (1024**3),
+        "disk_percent": disk.percent,
         "disk_used": disk.used // (1024**3),
         "disk_total": disk.total // (1024**3),
         "cpu_temp": cpu_temp,
         "net_sent": net_io.bytes_sent // (1024**2),
-        "net_recv": net_io.bytes_recv // (1024**2)
+        "net_recv": net_io.bytes_recv // (1024**2),
+        "load_avg": os.getloadavg() if hasattr(os, 'getloadavg') else "N/A",
+        "boot_time": psutil.boot_time(),
+        "ram_used_bytes": ram.used,
+        "ram_total_bytes": ram.total,
+        "disk_used_bytes": disk.used,
+        "disk_total_bytes": disk.total,
+        "net_sent_bytes": net_io.bytes_sent,
+        "net_recv_bytes": net_io.bytes_recv
     }
+    # Файловая система юзербота, если она не та же, что /
+    try:
+        if os.stat(USERBOT_DIR).st_dev != os.stat('/').st_dev:
+            userbot_disk = psutil.disk_usage(USERBOT_DIR)
+            metrics["userbot_disk_percent"] = userbot_disk.percent
+            metrics["userbot_disk_used_bytes"] = userbot_disk.used
+            metrics["userbot_disk_total_bytes"] = userbot_disk.total
+    except OSError:
+        pass
+
+    userbot = collect_userbot_tree_metrics()
+    metrics["userbot"] = userbot
+    if userbot:
+        # Плоские ключи, по которым можно строить правила алертов
+        metrics["userbot_cpu"] = userbot["cpu"]
+        metrics["userbot_rss_mb"] = userbot["rss"] / (1024 * 1024)
+        metrics["userbot_threads"] = userbot["threads"]
+        metrics["userbot_fds"] = userbot["fds"]
+    return metrics
+
+def get_detailed_metrics():
+    """Возвращает последний снимок метрик системы"""
+    global metrics_snapshot
+    if not metrics_snapshot:
+        # Сэмплер еще не успел отработать - снимаем метрики один раз
+        metrics_snapshot = collect_metrics()
+    return metrics_snapshot
+
+async def metrics_sampler():
+    """Фоновая задача: периодически обновляет снимок метрик"""
+    global metrics_snapshot
+
+    # Первый вызов cpu_percent(interval=None) всегда возвращает 0.0
+    psutil.cpu_percent(interval=None)
+
+    while True:
+        try:
+            metrics_snapshot = await asyncio.to_thread(collect_metrics)
+            evaluate_alert_rules(metrics_snapshot)
+            if METRICS_HISTORY_CONFIG["ENABLED"]:
+                await asyncio.to_thread(record_metrics_sample, metrics_snapshot)
+        except Exception as e:
+            print(f"Ошибка сбора метрик: {e}")
+        await asyncio.sleep(MONITORING_CONFIG.get("SAMPLE_INTERVAL", 5))
+
+async def start_metrics_sampler():
+    """Запускает фоновый сэмплер метрик"""
+    global sampler_task
+    if sampler_task and not sampler_task.done():
+        return
+    sampler_task = asyncio.create_task(metrics_sampler())
+    print(f"📡 Сэмплер метрик запущен (интервал: {MONITORING_CONFIG.get('SAMPLE_INTERVAL', 5)} сек)")
+
+async def stop_metrics_sampler():
+    """Останавливает фоновый сэмплер метрик"""
+    global sampler_task
+    if sampler_task:
+        sampler_task.cancel()
+        sampler_task = None
+        print("🛑 Сэмплер метрик остановлен")
+
+
+
+
+# История метрик
+METRICS_ROLLUP_COLUMNS = """
+    ts INTEGER PRIMARY KEY,
+    cpu_avg REAL, cpu_max REAL,
+    ram_avg REAL, ram_max REAL,
+    disk_avg REAL, disk_max REAL,
+    net_sent REAL, net_recv REAL,
+    temp_max REAL,
+    samples INTEGER
+"""
+
+def open_metrics_db():
+    """Открывает (и при необходимости создает) базу истории метрик"""
+    global metrics_db
+    if metrics_db is not None:
+        return metrics_db
+
+    db = sqlite3.connect(METRICS_HISTORY_CONFIG["DB_FILE"], check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS metrics_raw (
+            ts REAL PRIMARY KEY,
+            cpu REAL, ram REAL, disk REAL,
+            net_sent REAL, net_recv REAL,
+            temp REAL
+        )
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS userbot_raw (
+            ts REAL PRIMARY KEY,
+            processes INTEGER, cpu REAL, rss REAL, uss REAL,
+            threads INTEGER, fds INTEGER,
+            read_bytes REAL, write_bytes REAL
+        )
+    """)
+    db.execute(f"CREATE TABLE IF NOT EXISTS metrics_1m ({METRICS_ROLLUP_COLUMNS})")
+    db.execute(f"CREATE TABLE IF NOT EXISTS metrics_1h ({METRICS_ROLLUP_COLUMNS})")
+    db.commit()
+
+    # Продолжаем агрегацию с места, где остановились до перезапуска
+    last_minute = db.execute("SELECT MAX(ts) FROM metrics_1m").fetchone()[0]
+    last_hour = db.execute("SELECT MAX(ts) FROM metrics_1h").fetchone()[0]
+    metrics_history_state["minute_rollup"] = last_minute + 60 if last_minute is not None else 0
+    metrics_history_state["hour_rollup"] = last_hour + 3600 if last_hour is not None else 0
+
+    metrics_db = db
+    return db
+
+def close_metrics_db():
+    """Закрывает базу истории метрик"""
+    global metrics_db
+    with metrics_db_lock:
+        if metrics_db is not None:
+            metrics_db.close()
+            metrics_db = None
+
+def rollup_metrics(db, now):
+    """Агрегирует сырые данные в минутные и часовые, удаляет устаревшие"""
+    minute_start = int(now // 60) * 60
+    if minute_start > metrics_history_state["minute_rollup"]:
+        db.execute("""
+            INSERT OR REPLACE INTO metrics_1m
+            SELECT CAST(ts / 60 AS INTEGER) * 60 AS bucket,
+                   AVG(cpu), MAX(cpu), AVG(ram), MAX(ram), AVG(disk), MAX(disk),
+                   MAX(net_sent), MAX(net_recv), MAX(temp), COUNT(*)
+            FROM metrics_raw
+            WHERE ts >= ? AND ts < ?
+            GROUP BY bucket
+        """, (metrics_history_state["minute_rollup"], minute_start))
+        metrics_history_state["minute_rollup"] = minute_start
+
+    hour_start = int(now // 3600) * 3600
+    if hour_start > metrics_history_state["hour_rollup"]:
+        db.execute("""
+            INSERT OR REPLACE INTO metrics_1h
+            SELECT (ts / 3600) * 3600 AS bucket,
+                   SUM(cpu_avg * samples) / SUM(samples), MAX(cpu_max),
+                   SUM(ram_avg * samples) / SUM(samples), MAX(ram_max),
+                   SUM(disk_avg * samples) / SUM(samples), MAX(disk_max),
+                   MAX(net_sent), MAX(net_recv), MAX(temp_max), SUM(samples)
+            FROM metrics_1m
+            WHERE ts >= ? AND ts < ?
+            GROUP BY bucket
+        """, (metrics_history_state["hour_rollup"], hour_start))
+        metrics_history_state["hour_rollup"] = hour_start
+
+        # Удаляем устаревшие данные раз в час
+        db.execute("DELETE FROM metrics_raw WHERE ts < ?",
+                   (now - METRICS_HISTORY_CONFIG["RAW_RETENTION_HOURS"] * 3600,))
+        db.execute("DELETE FROM userbot_raw WHERE ts < ?",
+                   (now - METRICS_HISTORY_CONFIG["RAW_RETENTION_HOURS"] * 3600,))
+        db.execute("DELETE FROM metrics_1m WHERE ts < ?",
+                   (now - METRICS_HISTORY_CONFIG["MINUTE_RETENTION_DAYS"] * 86400,))
+        db.execute("DELETE FROM metrics_1h WHERE ts < ?",
+                   (now - METRICS_HISTORY_CONFIG["HOUR_RETENTION_DAYS"] * 86400,))
+
+def record_metrics_sample(metrics):
+    """Добавляет снимок метрик в историю (вызывается из потока сэмплера)"""
+    with metrics_db_lock:
+        db = open_metrics_db()
+        temp = metrics["cpu_temp"] if isinstance(metrics["cpu_temp"], (int, float)) else None
+        db.execute(
+            "INSERT OR REPLACE INTO metrics_raw VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (metrics["timestamp"], metrics["cpu"], metrics["ram_percent"], metrics["disk_percent"],
+             metrics["net_sent"], metrics["net_recv"], temp)
+        )
+        userbot = metrics.get("userbot")
+        if userbot:
+            db.execute(
+                "INSERT OR REPLACE INTO userbot_raw VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (metrics["timestamp"], userbot["processes"], userbot["cpu"], userbot["rss"], userbot["uss"],
+                 userbot["threads"], userbot["fds"], userbot["read_bytes"], userbot["write_bytes"])
+            )
+        rollup_metrics(db, metrics["timestamp"])
+        db.commit()
+
+def query_metrics_history(since, until=None, resolution=None):
+    """Возвращает историю метрик за период
+
+    resolution: "raw", "1m" или "1h"; по умолчанию выбирается по длине периода.
+    Каждая запись: (ts, cpu, cpu_max, ram, ram_max, disk, disk_max, net_sent, net_recv, temp, samples).
+    """
+    until = until or time.time()
+    if resolution is None:
+        span = until - since
+        if span <= 2 * 3600:
+            resolution = "raw"
+        elif span <= 3 * 86400:
+            resolution = "1m"
+        else:
+            resolution = "1h"
 
+    if resolution == "raw":
+        sql = """
+            SELECT ts, cpu, cpu, ram, ram, disk, disk, net_sent, net_recv, temp, 1
+            FROM metrics_raw WHERE ts >= ? AND ts < ? ORDER BY ts
+        """
+    else:
+        table = "metrics_1m" if resolution == "1m" else "metrics_1h"
+        sql = f"""
+            SELECT ts, cpu_avg, cpu_max, ram_avg, ram_max, disk_avg, disk_max, net_sent, net_recv, temp_max, samples
+            FROM {table} WHERE ts >= ? AND ts < ? ORDER BY ts
+        """
 
+    with metrics_db_lock:
+        db = open_metrics_db()
+        return db.execute(sql, (since, until)).fetchall()
+
+def query_userbot_history(since, until=None):
+    """История ресурсов юзербота: (ts, processes, cpu, rss, uss, threads, fds, read_bytes, write_bytes)"""
+    with metrics_db_lock:
+        db = open_metrics_db()
+        return db.execute(
+            "SELECT * FROM userbot_raw WHERE ts >= ? AND ts < ? ORDER BY ts",
+            (since, until or time.time())
+        ).fetchall()
+
+def get_metrics_summary(since, until=None):
+    """Средние и пиковые значения метрик за период (None, если данных нет)"""
+    rows = query_metrics_history(since, until)
+    if not rows:
+        return None
+
+    # Строки агрегатов весят по числу сырых сэмплов в них
+    samples = sum(row[10] or 1 for row in rows)
+
+    # Счетчики трафика сбрасываются при перезагрузке хоста - отрицательные приращения не считаем
+    net_sent = net_recv = 0
+    for previous, row in zip(rows, rows[1:]):
+        net_sent += max(row[7] - previous[7], 0)
+        net_recv += max(row[8] - previous[8], 0)
 
+    return {
+        "samples": samples,
+        "cpu_avg": sum(row[1] * (row[10] or 1) for row in rows) / samples,
+        "cpu_max": max(row[2] for row in rows),
+        "ram_avg": sum(row[3] * (row[10] or 1) for row in rows) / samples,
+        "ram_max": max(row[4] for row in rows),
+        "disk_max": max(row[6] for row in rows),
+        "net_sent": net_sent,
+        "net_recv": net_recv
+    }
 
 
 async def generate_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -304,63 +971,295 @@ async def safe_edit_message(bot, chat_id, message_id, text, **kwargs):
     return False
 
 
-async def check_system_health(context: ContextTypes.DEFAULT_TYPE):
-    """Проверяет здоровье системы и отправляет алерты"""
-    global last_alert_time
+# Правила алертов: условие должно держаться FOR секунд, сброс - по отдельному порогу CLEAR
+def build_alert_rules(alerts_config):
+    """Правила из порогов CPU/RAM/DISK, проверки юзербота и пользовательских RULES"""
+    margin = alerts_config.get("CLEAR_MARGIN", 5)
+    sustain = alerts_config.get("FOR_SECONDS", 180)
+    clear_for = alerts_config.get("CLEAR_FOR_SECONDS", 60)
+    cooldowns = alerts_config.get("COOLDOWNS", {})
+
+    def rule(name, metric, op, fire, clear, title, unit="%", duration=sustain, clear_duration=clear_for):
+        return {
+            "name": name,
+            "metric": metric,
+            "op": op,
+            "fire": fire,
+            "clear": clear,
+            "for": duration,
+            "clear_for": clear_duration,
+            "title": title,
+            "unit": unit,
+            "cooldown": cooldowns.get(name, alerts_config["MIN_INTERVAL_BETWEEN_ALERTS"])
+        }
 
-    if not MONITORING_CONFIG["ENABLED"]:
-        return
+    rules = {
+        "CPU": rule("CPU", "cpu", ">", alerts_config["CPU_THRESHOLD"], alerts_config["CPU_THRESHOLD"] - margin, "🔥 Высокая нагрузка CPU"),
+        "RAM": rule("RAM", "ram_percent", ">", alerts_config["RAM_THRESHOLD"], alerts_config["RAM_THRESHOLD"] - margin, "💾 Высокая нагрузка RAM"),
+        "DISK": rule("DISK", "disk_percent", ">", alerts_config["DISK_THRESHOLD"], alerts_config["DISK_THRESHOLD"] - margin, "💽 Заканчивается место на диске"),
+        # Метрика есть, только если USERBOT_DIR на отдельной файловой системе
+        "USERBOT_DISK": rule(
+            "USERBOT_DISK", "userbot_disk_percent", ">", alerts_config["DISK_THRESHOLD"], alerts_config["DISK_THRESHOLD"] - margin,
+            "💽 Заканчивается место на диске юзербота"
+        ),
+        "USERBOT_DOWN": rule("USERBOT_DOWN", "userbot_down", ">", 0, 0, "🛑 Юзербот остановлен", unit="", duration=0, clear_duration=0)
+    }
+    # Прогноз детектора утечек: сколько часов до исчерпания памяти
+    if LEAK_DETECTOR_CONFIG["ENABLED"]:
+        hours = LEAK_DETECTOR_CONFIG["ALERT_HOURS"]
+        rules["USERBOT_LEAK"] = rule(
+            "USERBOT_LEAK", "userbot_leak_hours", "<", hours, hours * 1.5,
+            "📈 Утечка памяти юзербота, до исчерпания", unit=" ч", duration=0, clear_duration=0
+        )
 
-    metrics = get_detailed_metrics()
-    current_time = time.time()
+    # Пороги по ресурсам самого юзербота (0 - выключено)
+    if alerts_config.get("USERBOT_CPU_THRESHOLD"):
+        threshold = alerts_config["USERBOT_CPU_THRESHOLD"]
+        rules["USERBOT_CPU"] = rule("USERBOT_CPU", "userbot_cpu", ">", threshold, threshold - margin, "🔥 Юзербот нагружает CPU")
+    if alerts_config.get("USERBOT_RSS_MB_THRESHOLD"):
+        threshold = alerts_config["USERBOT_RSS_MB_THRESHOLD"]
+        rules["USERBOT_RSS"] = rule(
+            "USERBOT_RSS", "userbot_rss_mb", ">", threshold, threshold * 0.95, "💾 Юзербот занимает много памяти", unit=" MB"
+        )
 
-    alerts = []
+    for entry in alerts_config.get("RULES", []):
+        fire = entry["FIRE"]
+        rules[entry["NAME"]] = rule(
+            entry["NAME"], entry["METRIC"], entry.get("OP", ">"), fire, entry.get("CLEAR", fire),
+            entry.get("TITLE", f"⚠️ {entry['NAME']}"), entry.get("UNIT", ""),
+            entry.get("FOR", sustain), entry.get("CLEAR_FOR", clear_for)
+        )
+        if "COOLDOWN" in entry:
+            rules[entry["NAME"]]["cooldown"] = entry["COOLDOWN"]
+    return rules
+
+def refresh_alert_rules():
+    """Пересобирает правила из конфигурации (состояние сохраняется для тех же имен)"""
+    global alert_rules
+    rules = build_alert_rules(MONITORING_CONFIG["ALERTS"])
+    for name in list(alert_states):
+        if name not in rules:
+            del alert_states[name]
+    alert_rules = rules
+
+refresh_alert_rules()
+
+def format_duration_short(seconds):
+    """Длительность для текста алерта: 45 сек, 3 мин"""
+    return f"{seconds:g} сек" if seconds < 60 else f"{seconds / 60:g} мин"
+
+def new_alert_state():
+    """Начальное состояние правила"""
+    return {
+        "state": "ok",
+        "since": None,
+        "clear_since": None,
+        "value": None,
+        "fired_at": None,
+        "last_notified": 0,
+        "acked_until": 0,
+        "acked_by": None
+    }
 
-    # Проверка CPU
-    if metrics["cpu"] > MONITORING_CONFIG["ALERTS"]["CPU_THRESHOLD"]:
-        if current_time - last_alert_time["CPU"] > alert_cooldown:
-            alerts.append(f"🔥 **Высокая нагрузка CPU!** {metrics['cpu']}%")
-            last_alert_time["CPU"] = current_time
+def load_alert_state():
+    """Восстанавливает состояние алертов после перезапуска бота"""
+    path = MONITORING_CONFIG["ALERTS"]["STATE_FILE"]
+    try:
+        with open(path, 'r') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"Ошибка загрузки состояния алертов: {e}")
+        return
+
+    for name, data in saved.items():
+        if name not in alert_rules or not isinstance(data, dict):
+            continue
+        state = new_alert_state()
+        state.update({key: data[key] for key in ALERT_PERSISTED_KEYS if key in data})
+        # Незавершенное ожидание (pending) после простоя не продолжаем
+        if state["state"] != "firing":
+            state["state"] = "ok"
+        alert_states[name] = state
+
+def save_alert_state():
+    """Атомарно сохраняет состояние алертов (временный файл + rename)"""
+    path = MONITORING_CONFIG["ALERTS"]["STATE_FILE"]
+    data = {
+        name: {key: state[key] for key in ALERT_PERSISTED_KEYS}
+        for name, state in alert_states.items()
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".alerts-", suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Ошибка сохранения состояния алертов: {e}")
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def evaluate_alert_rule(rule, value, now):
+    """Обновляет состояние правила по одному сэмплу; возвращает "firing", "resolved" или None"""
+    state = alert_states.setdefault(rule["name"], new_alert_state())
+    state["value"] = value
+    compare = ALERT_OPERATORS[rule["op"]]
+
+    if state["state"] == "firing":
+        # Гистерезис: пока значение не ушло за порог сброса, алерт остается активным
+        if compare(value, rule["clear"]):
+            state["clear_since"] = None
+            return None
+        if state["clear_since"] is None:
+            state["clear_since"] = now
+        if now - state["clear_since"] < rule["clear_for"]:
+            return None
+        state.update(state="ok", since=None, clear_since=None)
+        return "resolved"
+
+    if not compare(value, rule["fire"]):
+        state.update(state="ok", since=None)
+        return None
+    if state["since"] is None:
+        state.update(state="pending", since=now)
+    if now - state["since"] < rule["for"]:
+        return None
+    state.update(state="firing", fired_at=now, clear_since=None)
+    return "firing"
+
+def evaluate_alert_rules(sample):
+    """Прогоняет сэмпл через правила, метрики которых в нем есть"""
+    now = sample.get("timestamp", time.time())
+    for rule in alert_rules.values():
+        value = sample.get(rule["metric"])
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        transition = evaluate_alert_rule(rule, value, now)
+        if transition:
+            alert_events.append((rule["name"], transition, value, now))
+
+def format_alert_line(rule, value):
+    """Строка алерта для сообщения"""
+    line = f"{rule['title']}: {value:.1f}{rule['unit']}" if rule["unit"] else rule["title"]
+    if rule["for"]:
+        line += f" ({rule['op']}{rule['fire']}{rule['unit']} дольше {format_duration_short(rule['for'])})"
+    return line
+
+def format_alert_rules_status():
+    """Состояние правил для экрана мониторинга"""
+    marks = {"ok": "✅", "pending": "⏳", "firing": "🚨"}
+    now = time.time()
+    lines = []
+    for name, rule in alert_rules.items():
+        state = alert_states.get(name) or new_alert_state()
+        mark = marks[state["state"]] + (" 🔕" if state["acked_until"] > now else "")
+        if rule["unit"]:
+            lines.append(
+                f"• {name}: {rule['op']}{rule['fire']}{rule['unit']} дольше {format_duration_short(rule['for'])}, "
+                f"сброс {rule['clear']}{rule['unit']} {mark}"
+            )
+        else:
+            lines.append(f"• {name} {mark}")
+    return "\n".join(lines)
 
-    # Проверка RAM
-    if metrics["ram_percent"] > MONITORING_CONFIG["ALERTS"]["RAM_THRESHOLD"]:
-        if current_time - last_alert_time["RAM"] > alert_cooldown:
-            alerts.append(f"💾 **Высокая нагрузка RAM!** {metrics['ram_percent']}% ({metrics['ram_used']}/{metrics['ram_total']} GB)")
-            last_alert_time["RAM"] = current_time
+async def check_system_health(context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет здоровье системы и отправляет алерты"""
+    if not MONITORING_CONFIG["ENABLED"]:
+        alert_events.clear()
+        return
 
+    current_time = time.time()
 
-    # Проверка юзербота
+    # CPU/RAM/DISK оценивает сэмплер; здесь добавляем только статус юзербота
     is_running, _ = get_userbot_status()
-    if not is_running:
-        if current_time - last_alert_time["USERBOT_DOWN"] > alert_cooldown:
-            alerts.append("🛑 **Юзербот остановлен!**")
-            last_alert_time["USERBOT_DOWN"] = current_time
-    else:
-        last_alert_time["USERBOT_DOWN"] = 0
+    evaluate_alert_rules({"timestamp": current_time, "userbot_down": 0 if is_running else 1})
+
+    # Решенные алерты: сообщаем только о тех, о которых уже уведомляли
+    resolved = []
+    changed = False
+    while alert_events:
+        name, transition, value, _ = alert_events.popleft()
+        rule, state = alert_rules.get(name), alert_states.get(name)
+        if not rule or not state:
+            continue
+        changed = True
+        if transition != "resolved" or state["state"] != "ok" or state["acked_until"] > current_time:
+            continue
+        if state["fired_at"] and state["last_notified"] >= state["fired_at"]:
+            # Прогнозные правила сбрасываются бесконечностью ("не закончится") - значение не показываем
+            if rule["unit"] and math.isfinite(value):
+                resolved.append(f"{rule['title']}: {value:.1f}{rule['unit']}")
+            else:
+                resolved.append(f"{rule['title']} - снова в норме")
 
-    # Отправка алертов
-    if alerts:
-        alert_message = "🚨 **СИСТЕМНЫЕ АЛЕРТЫ** 🚨\n\n" + "\n".join(alerts)
+    # Активные алерты без уведомления (учитывая кулдаун правила и подтверждение)
+    alerts = []
+    firing = []
+    for name, state in alert_states.items():
+        rule = alert_rules.get(name)
+        if not rule or state["state"] != "firing" or state["last_notified"] >= state["fired_at"]:
+            continue
+        if state["acked_until"] > current_time or current_time - state["last_notified"] < rule["cooldown"]:
+            continue
+        if state["value"] is None:
+            # Восстановлен из alerts.json без значения - ждем первый сэмпл
+            continue
+        alerts.append(format_alert_line(rule, state["value"]))
+        firing.append(name)
+        state["last_notified"] = current_time
+        alert_counts[name] = alert_counts.get(name, 0) + 1
+
+    if changed or firing:
+        save_alert_state()
+
+    # Отправка алертов (активные и решенные - одним сообщением)
+    if alerts or resolved:
+        sections = []
+        if alerts:
+            sections.append("🚨 **СИСТЕМНЫЕ АЛЕРТЫ** 🚨\n\n" + "\n".join(alerts))
+        if resolved:
+            sections.append("✅ **Решено:**\n" + "\n".join(resolved))
+        alert_message = "\n\n".join(sections)
         alert_message += f"\n\n⏰ Время: {datetime.now().strftime('%H:%M:%S')}"
 
+        keyboard = [[InlineKeyboardButton(f"🔕 Принять {name}", callback_data=f"alert_ack_{name}")] for name in firing]
+
         # Определяем, кому отправлять алерты
         recipients = []
         if MONITORING_CONFIG["ALERTS"]["NOTIFY_OWNER_ONLY"]:
-            if OWNER_ID and OWNER_ID.isdigit():
-                recipients = [int(OWNER_ID)]
+            if OWNER_USER_ID:
+                recipients = [OWNER_USER_ID]
         elif MONITORING_CONFIG["ALERTS"]["NOTIFY_USERS"]:
             recipients = list(USER_IDS)
         else:
-            recipients = [int(OWNER_ID)] if OWNER_ID and OWNER_ID.isdigit() else []
+            recipients = [OWNER_USER_ID] if OWNER_USER_ID else []
 
         # Отправляем алерты
-        for user_id in recipients:
-            try:
-                await safe_send_message(context.bot, user_id, alert_message, parse_mode='Markdown')
-                print(f"Алерт отправлен пользователю {user_id}")
-            except Exception as e:
-                print(f"Ошибка отправки алерта пользователю {user_id}: {e}")
+        await broadcast_message(
+            context.bot, recipients, alert_message, parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+        )
+
+async def acknowledge_alert_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, name):
+    """Подтверждение алерта: уведомления по нему отключаются на ACK_DURATION"""
+    query = update.callback_query
+    state = alert_states.get(name)
+    if not state:
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    duration = MONITORING_CONFIG["ALERTS"]["ACK_DURATION"]
+    state["acked_until"] = time.time() + duration
+    state["acked_by"] = query.from_user.id
+    save_alert_state()
 
+    await query.edit_message_reply_markup(reply_markup=None)
+    await query.message.reply_text(f"🔕 Алерт {name} принят, уведомления по нему отключены на {format_duration_short(duration)}")
 
 async def start_monitoring(context: ContextTypes.DEFAULT_TYPE):
     """Запускает мониторинг системы"""
@@ -368,11 +1267,14 @@ async def start_monitoring(context: ContextTypes.DEFAULT_TYPE):
     await check_system_health(context)
 
 async def stop_monitoring():
-    """Останавливает мониторинг системы"""
-    global monitor_task
+    """Останавливает мониторинг системы и отслеживание логов"""
+    global monitor_task, log_follow_task
     if monitor_task:
         monitor_task.cancel()
         print("🛑 Мониторинг остановлен")
+    if log_follow_task:
+        log_follow_task.cancel()
+        log_follow_task = None
 
 async def daily_report(context: ContextTypes.DEFAULT_TYPE):
     """Ежедневный отчет о состоянии системы"""
@@ -384,6 +1286,22 @@ async def daily_report(context: ContextTypes.DEFAULT_TYPE):
     metrics = get_detailed_metrics()
     is_running, start_time_userbot = get_userbot_status()
 
+    # Средние и пиковые значения за сутки из истории метрик
+    day_stats = ""
+    if METRICS_HISTORY_CONFIG["ENABLED"]:
+        try:
+            summary = await asyncio.to_thread(get_metrics_summary, time.time() - 86400)
+            if summary:
+                day_stats = (
+                    f"\n📉 **За сутки:**\n"
+                    f"• CPU: ср. {summary['cpu_avg']:.1f}% | пик {summary['cpu_max']:.1f}%\n"
+                    f"• RAM: ср. {summary['ram_avg']:.1f}% | пик {summary['ram_max']:.1f}%\n"
+                    f"• Диск: пик {summary['disk_max']:.1f}%\n"
+                    f"• Трафик: 📤 {summary['net_sent']:.0f} MB | 📥 {summary['net_recv']:.0f} MB\n"
+                )
+        except Exception as e:
+            print(f"Ошибка чтения истории метрик: {e}")
+
     # Время работы системы
     system_uptime = time.time() - psutil.boot_time()
     bot_uptime = time.time() - start_time if 'start_time' in globals() else 0
@@ -397,7 +1315,7 @@ async def daily_report(context: ContextTypes.DEFAULT_TYPE):
 • RAM: {metrics['ram_percent']:.1f}% ({metrics['ram_used']}/{metrics['ram_total']} GB)
 • Температура CPU: {metrics['cpu_temp'] if metrics['cpu_temp'] != 'N/A' else 'N/A'}°C
 • Сеть: 📤 {metrics['net_sent']} MB | 📥 {metrics['net_recv']} MB
-
+{day_stats}
 🤖 **Статус юзербота:** {'✅ Запущен' if is_running else '❌ Остановлен'}
 {'• Время работы: ' + f"{int((time.time() - start_time_userbot) // 3600)}ч {int(((time.time() - start_time_userbot) % 3600) // 60)}м" if is_running else ''}
 
@@ -412,31 +1330,32 @@ async def daily_report(context: ContextTypes.DEFAULT_TYPE):
     """
 
     # Отправляем отчет всем пользователям
-    for user_id in USER_IDS:
-        try:
-            await safe_send_message(context.bot, user_id, report, parse_mode='Markdown')
-            print(f"Отчет отправлен пользователю {user_id}")
-        except Exception as e:
-            print(f"Ошибка отправки отчета пользователю {user_id}: {e}")
+    await broadcast_message(context.bot, USER_IDS, report, parse_mode='Markdown')
 
 
 async def auto_restart_userbot(context: ContextTypes.DEFAULT_TYPE):
-    """Автоматический перезапуск юзербота"""
+    """Плановый перезапуск юзербота (с детектором утечек - только если память кончится до следующего)"""
     if not SCHEDULED_TASKS_CONFIG["ENABLED"] or not SCHEDULED_TASKS_CONFIG["AUTO_RESTART_USERBOT"]:
         return
 
+    if LEAK_DETECTOR_CONFIG["ENABLED"] and METRICS_HISTORY_CONFIG["ENABLED"]:
+        trend = await asyncio.to_thread(estimate_rss_trend)
+        leak_state["trend"] = trend
+        # Без тренда (мало сэмплов) перезапускаем по расписанию, как раньше
+        if trend and (not trend["leaking"] or trend["hours_left"] > 24):
+            print("🔄 Плановый перезапуск юзербота пропущен: память не закончится в ближайшие сутки")
+            return
+
+    await restart_userbot_now(context.bot, "по расписанию")
+
+async def restart_userbot_now(bot, reason):
+    """Перезапускает юзербота без участия пользователя (расписание, детектор утечек)"""
     print("🔄 Запускаю автоматический перезапуск юзербота...")
 
     # Сначала останавливаем
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-            continue
+    restart_requested = time.time()
+    release_userbot_supervisor()
+    processes = get_userbot_processes()
 
     if processes:
         for proc in processes:
@@ -468,35 +1387,297 @@ async def auto_restart_userbot(context: ContextTypes.DEFAULT_TYPE):
 
     # Запускаем заново
     try:
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
-
-        env = os.environ.copy()
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
+        process = await spawn_userbot(bot)
 
-        await asyncio.sleep(5)
-
-        is_running, _ = get_userbot_status()
+        is_running, ready_reason = await wait_userbot_ready(process, restart_started=restart_requested)
         if is_running:
-            notification = f"✅ Юзербот автоматически перезапущен в {datetime.now().strftime('%H:%M')}"
-            for user_id in USER_IDS:
-                await safe_send_message(context.bot, user_id, notification)
+            notification = f"✅ Юзербот автоматически перезапущен в {datetime.now().strftime('%H:%M')} ({reason})"
+            await broadcast_message(bot, USER_IDS, notification)
         else:
-            notification = f"❌ Не удалось автоматически перезапустить юзербота"
-            if OWNER_ID and OWNER_ID.isdigit():
-                await safe_send_message(context.bot, int(OWNER_ID), notification)
+            notification = f"❌ Не удалось автоматически перезапустить юзербота\n\n{format_startup_failure(ready_reason)}"
+            if OWNER_USER_ID:
+                await safe_send_message(bot, OWNER_USER_ID, notification)
 
     except Exception as e:
         print(f"Ошибка автоматического перезапуска: {e}")
 
 
+# Детектор утечек памяти
+def estimate_rss_trend(now=None):
+    """Линейный тренд RSS юзербота (МНК) после прогрева, не дольше WINDOW_HOURS
+
+    Суммы для регрессии считает SQLite, строки истории в Python не загружаются.
+    """
+    now = now or time.time()
+    started = userbot_process["create_time"]
+    if not started:
+        return None
+
+    # Рост памяти сразу после запуска (загрузка модулей, кэши) - не утечка
+    since = max(now - LEAK_DETECTOR_CONFIG["WINDOW_HOURS"] * 3600, started + LEAK_DETECTOR_CONFIG["WARMUP_MINUTES"] * 60)
+    with metrics_db_lock:
+        db = open_metrics_db()
+        # Время отсчитывается от since, RSS - в мегабайтах: так суммы не теряют точность
+        n, sx, sy, sxx, sxy, syy, first_ts, last_ts, last_rss = db.execute("""
+            SELECT COUNT(*), SUM(ts - :t0), SUM(rss / 1048576.0),
+                   SUM((ts - :t0) * (ts - :t0)), SUM((ts - :t0) * rss / 1048576.0),
+                   SUM((rss / 1048576.0) * (rss / 1048576.0)),
+                   MIN(ts), MAX(ts), (SELECT rss / 1048576.0 FROM userbot_raw WHERE ts >= :t0 ORDER BY ts DESC LIMIT 1)
+            FROM userbot_raw WHERE ts >= :t0
+        """, {"t0": since}).fetchone()
+
+    if n < max(LEAK_DETECTOR_CONFIG["MIN_SAMPLES"], 2):
+        return None
+    # Короткий отрезок дает крутой наклон с высоким R² почти на любых данных
+    if last_ts - first_ts < LEAK_DETECTOR_CONFIG["MIN_SPAN_MINUTES"] * 60:
+        return None
+    var_x = n * sxx - sx * sx
+    var_y = n * syy - sy * sy
+    if var_x <= 0:
+        return None
+
+    cov = n * sxy - sx * sy
+    slope = cov / var_x
+    intercept = (sy - slope * sx) / n
+    r2 = cov * cov / (var_x * var_y) if var_y > 0 else 0.0
+    fitted = intercept + slope * (last_ts - since)
+    growth = slope * 3600
+
+    limit = LEAK_DETECTOR_CONFIG["LIMIT_MB"]
+    if not limit and metrics_snapshot:
+        # Без явного лимита - текущий RSS плюс свободная память хоста
+        limit = last_rss + (metrics_snapshot["ram_total_bytes"] - metrics_snapshot["ram_used_bytes"]) / (1024 * 1024)
+
+    leaking = (
+        r2 >= LEAK_DETECTOR_CONFIG["MIN_R2"]
+        and growth >= LEAK_DETECTOR_CONFIG["MIN_GROWTH_MB_PER_HOUR"]
+        and bool(limit)
+    )
+    return {
+        "samples": n,
+        "since": since,
+        "growth_mb_per_hour": growth,
+        "r2": r2,
+        "rss_mb": last_rss,
+        "fitted_mb": fitted,
+        "limit_mb": limit,
+        "leaking": leaking,
+        "hours_left": max(limit - fitted, 0) / growth if leaking else None
+    }
+
+def format_leak_status():
+    """Тренд памяти юзербота для экрана мониторинга"""
+    if not LEAK_DETECTOR_CONFIG["ENABLED"]:
+        return "выключен"
+    trend = leak_state["trend"]
+    if not trend:
+        return "мало данных"
+
+    text = f"{trend['growth_mb_per_hour']:+.1f} MB/ч (R² {trend['r2']:.2f})"
+    if trend["leaking"]:
+        text += f", лимит {trend['limit_mb']:.0f} MB через {trend['hours_left']:.1f} ч"
+    return text
+
+async def leak_detector_loop(application):
+    """Периодически пересчитывает тренд RSS, кормит правило алерта и при необходимости перезапускает юзербота"""
+    while True:
+        await asyncio.sleep(LEAK_DETECTOR_CONFIG["CHECK_INTERVAL"])
+        if not LEAK_DETECTOR_CONFIG["ENABLED"] or not METRICS_HISTORY_CONFIG["ENABLED"]:
+            leak_state["trend"] = None
+            continue
+
+        try:
+            trend = await asyncio.to_thread(estimate_rss_trend)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка детектора утечек: {e}")
+            continue
+
+        leak_state["trend"] = trend
+        hours_left = trend["hours_left"] if trend and trend["leaking"] else float("inf")
+        evaluate_alert_rules({"timestamp": time.time(), "userbot_leak_hours": hours_left})
+
+        restart_hours = LEAK_DETECTOR_CONFIG["RESTART_HOURS"]
+        if restart_hours and hours_left < restart_hours and userbot_supervisor["desired"]:
+            print(f"📈 Память юзербота закончится через {hours_left:.1f} ч, перезапускаю")
+            leak_state["last_restart"] = time.time()
+            # После перезапуска история начинается заново, поэтому повторного срабатывания
+            # не будет, пока не наберется MIN_SAMPLES новых сэмплов
+            await restart_userbot_now(application.bot, f"утечка памяти: +{trend['growth_mb_per_hour']:.1f} MB/ч")
+
+async def start_leak_detector(application):
+    """Запускает детектор утечек памяти"""
+    global leak_detector_task
+    if leak_detector_task is None:
+        leak_detector_task = asyncio.create_task(leak_detector_loop(application))
+
+async def stop_leak_detector():
+    """Останавливает детектор утечек памяти"""
+    global leak_detector_task
+    if leak_detector_task:
+        leak_detector_task.cancel()
+        leak_detector_task = None
+
+
+def format_size(size):
+    """Размер в байтах -> строка с единицами"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def make_dir_entry(path, mtime, files, subdirs):
+    """Запись каталога в индексе: файлы, подкаталоги и заранее посчитанные сумма и топ файлов"""
+    return {
+        "mtime": mtime,
+        "files": files,
+        "subdirs": subdirs,
+        "size": sum(size for size, _ in files.values()),
+        "top": heapq.nlargest(DISK_INDEX_CONFIG["TOP"], ((size, os.path.join(path, name)) for name, (size, _) in files.items()))
+    }
+
+def scan_dir_entries(path):
+    """Читает каталог через os.scandir: {имя файла: (размер, mtime)} и имена подкаталогов"""
+    files = {}
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[entry.name] = (st.st_size, st.st_mtime)
+            except OSError:
+                # Файл удалили во время обхода
+                continue
+    return files, subdirs
+
+def refresh_file_stats(path, entry):
+    """Заново снимает stat файлов неизмененного каталога (дозапись не меняет mtime каталога)
+
+    Листинг каталога не перечитывается; запись пересобирается, только если что-то изменилось.
+    """
+    files = {}
+    changed = False
+    for name, cached in entry["files"].items():
+        try:
+            st = os.stat(os.path.join(path, name), follow_symlinks=False)
+        except OSError:
+            changed = True
+            continue
+        files[name] = (st.st_size, st.st_mtime)
+        changed = changed or files[name] != cached
+    if not changed:
+        return entry
+    return make_dir_entry(path, entry["mtime"], files, entry["subdirs"])
+
+def update_disk_index(full=False):
+    """Проход по USERBOT_DIR: неизмененные каталоги берутся из кэша, остальные читаются заново"""
+    global disk_index
+    started = time.monotonic()
+    now = time.time()
+    root = os.path.realpath(USERBOT_DIR)
+    cached_dirs = {} if full or disk_index["root"] != root else disk_index["dirs"]
+    root_dev = os.stat(root).st_dev
+
+    dirs = {}
+    rescanned = 0
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            continue
+        if st.st_dev != root_dev:
+            # Другие файловые системы (монтирования внутри каталога) не считаем
+            continue
+
+        entry = cached_dirs.get(path)
+        if entry and entry["mtime"] == st.st_mtime_ns:
+            entry = refresh_file_stats(path, entry)
+        else:
+            try:
+                files, subdirs = scan_dir_entries(path)
+            except OSError:
+                continue
+            entry = make_dir_entry(path, st.st_mtime_ns, files, subdirs)
+            rescanned += 1
+
+        dirs[path] = entry
+        stack.extend(os.path.join(path, name) for name in entry["subdirs"])
+
+    # Размеры каталогов с подкаталогами: от самых глубоких к корню
+    sizes = {}
+    for path in sorted(dirs, key=lambda item: item.count(os.sep), reverse=True):
+        entry = dirs[path]
+        sizes[path] = entry["size"] + sum(sizes.get(os.path.join(path, name), 0) for name in entry["subdirs"])
+
+    top = DISK_INDEX_CONFIG["TOP"]
+    disk_index = {
+        "dirs": dirs,
+        "root": root,
+        "total": sizes.get(root, 0),
+        "files": sum(len(entry["files"]) for entry in dirs.values()),
+        "top_files": heapq.nlargest(top, (item for entry in dirs.values() for item in entry["top"])),
+        "top_dirs": heapq.nlargest(top, ((size, path) for path, size in sizes.items() if path != root)),
+        "updated": now,
+        "full_scan": now if not cached_dirs else disk_index["full_scan"],
+        "duration": time.monotonic() - started,
+        "rescanned": rescanned
+    }
+    return disk_index
+
+def format_disk_index(detailed=False):
+    """Сводка индекса USERBOT_DIR (крупнейшие файлы и каталоги - при detailed)"""
+    index = disk_index
+    if not index["updated"]:
+        return "📂 Индекс каталога юзербота еще не построен"
+
+    lines = [
+        f"📂 `{index['root']}`: {format_size(index['total'])}, файлов: {index['files']}",
+        f"Обновлен {format_duration_short(int(time.time() - index['updated']))} назад "
+        f"(перечитано каталогов: {index['rescanned']} из {len(index['dirs'])} за {index['duration']:.2f} с)"
+    ]
+    if detailed:
+        root_prefix = index["root"] + os.sep
+        lines.append("\n**Крупнейшие файлы:**")
+        lines.extend(f"• {format_size(size)} - `{path.replace(root_prefix, '', 1)}`" for size, path in index["top_files"])
+        lines.append("\n**Крупнейшие каталоги:**")
+        lines.extend(f"• {format_size(size)} - `{path.replace(root_prefix, '', 1)}/`" for size, path in index["top_dirs"])
+    return "\n".join(lines)
+
+async def disk_index_loop():
+    """Периодически обновляет индекс USERBOT_DIR (полный пересчет - раз в FULL_RESCAN_HOURS)"""
+    while True:
+        if DISK_INDEX_CONFIG["ENABLED"] and os.path.isdir(USERBOT_DIR):
+            last_full = disk_index["full_scan"]
+            full = not last_full or time.time() - last_full >= DISK_INDEX_CONFIG["FULL_RESCAN_HOURS"] * 3600
+            try:
+                await asyncio.to_thread(update_disk_index, full)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ошибка индексации {USERBOT_DIR}: {e}")
+        await asyncio.sleep(DISK_INDEX_CONFIG["INTERVAL"])
+
+async def start_disk_index():
+    """Запускает фоновую индексацию каталога юзербота"""
+    global disk_index_task
+    if disk_index_task is None:
+        disk_index_task = asyncio.create_task(disk_index_loop())
+
+async def stop_disk_index():
+    """Останавливает индексацию каталога юзербота"""
+    global disk_index_task
+    if disk_index_task:
+        disk_index_task.cancel()
+        disk_index_task = None
+
+
 async def setup_scheduler(application):
     """Настройка и запуск планировщика задач"""
     global scheduler
@@ -562,19 +1743,11 @@ async def monitoring_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_user(update.effective_user.id):
         return
 
-    cpu_threshold = MONITORING_CONFIG["ALERTS"]["CPU_THRESHOLD"]
-    ram_threshold = MONITORING_CONFIG["ALERTS"]["RAM_THRESHOLD"]
-    disk_threshold = MONITORING_CONFIG["ALERTS"]["DISK_THRESHOLD"]
-
     status = "✅ Включен" if MONITORING_CONFIG["ENABLED"] else "❌ Выключен"
 
     # Текущие метрики
     metrics = get_detailed_metrics()
 
-    # Определяем статус каждого параметра
-    cpu_status = "🚨" if metrics["cpu"] > cpu_threshold else "✅"
-    ram_status = "🚨" if metrics["ram_percent"] > ram_threshold else "✅"
-
     message = f"""
 📊 **СИСТЕМА МОНИТОРИНГА**
 
@@ -582,15 +1755,19 @@ async def monitoring_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **Интервал проверки:** {MONITORING_CONFIG['CHECK_INTERVAL']} сек
 **Кулдаун алертов:** {alert_cooldown // 60} мин
 
-**Пороги алертов:**
-• CPU: {cpu_threshold}% {cpu_status}
-• RAM: {ram_threshold}% {ram_status}
+**Правила алертов:**
+{format_alert_rules_status()}
 
 **Текущие значения:**
 • CPU: {metrics['cpu']:.1f}%
 • RAM: {metrics['ram_percent']:.1f}%
+• Disk: {metrics['disk_percent']:.1f}%
 
 **Получатели алертов:** {'Все пользователи' if MONITORING_CONFIG['ALERTS']['NOTIFY_USERS'] else 'Только владелец'}
+**Ресурсы юзербота:** {format_userbot_resources()}
+**Тренд памяти юзербота:** {format_leak_status()}
+**Супервизор юзербота:** {get_supervisor_status()}
+**Запуск юзербота:** {format_start_stats()}
 """
 
     keyboard = [
@@ -636,8 +1813,91 @@ async def test_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer("✅ Тестовый алерт отправлен", show_alert=True)
 
 
-async def show_load_graph(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает график нагрузки"""
+# Окна графика нагрузки: ключ -> (длительность в секундах, подпись)
+LOAD_GRAPH_WINDOWS = {
+    "1h": (3600, "1 час"),
+    "24h": (86400, "24 часа"),
+    "7d": (7 * 86400, "7 дней")
+}
+LOAD_GRAPH_WIDTH = 24
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
+
+# Кэш отрисованных графиков: окно -> (время последнего сэмпла, текст)
+load_graph_cache = {}
+
+def make_sparkline(values, max_value=None):
+    """Строит спарклайн из значений (None - нет данных)"""
+    known = [v for v in values if v is not None]
+    if not known:
+        return " " * len(values)
+    top = max_value or max(known) or 1
+    line = ""
+    for value in values:
+        if value is None:
+            line += " "
+        else:
+            index = int(min(value, top) / top * (len(SPARKLINE_CHARS) - 1))
+            line += SPARKLINE_CHARS[index]
+    return line
+
+def bucket_history(rows, since, until, column, width, combine="avg"):
+    """Раскладывает записи истории по width столбцам"""
+    step = (until - since) / width
+    buckets = [[] for _ in range(width)]
+    for row in rows:
+        index = int((row[0] - since) / step)
+        if 0 <= index < width and row[column] is not None:
+            buckets[index].append(row[column])
+
+    if combine == "sum":
+        return [sum(b) if b else None for b in buckets]
+    return [sum(b) / len(b) if b else None for b in buckets]
+
+def render_load_graph(window):
+    """Рисует график нагрузки за окно по записанной истории"""
+    duration, title = LOAD_GRAPH_WINDOWS[window]
+    until = time.time()
+    since = until - duration
+    rows = query_metrics_history(since, until)
+    if not rows:
+        return None
+
+    # Трафик хранится накопительным счетчиком - переводим в приращения
+    traffic = []
+    previous = rows[0]
+    for row in rows:
+        sent = max(row[7] - previous[7], 0)
+        recv = max(row[8] - previous[8], 0)
+        traffic.append((row[0], sent, recv))
+        previous = row
+
+    cpu = bucket_history(rows, since, until, 1, LOAD_GRAPH_WIDTH)
+    ram = bucket_history(rows, since, until, 3, LOAD_GRAPH_WIDTH)
+    disk = bucket_history(rows, since, until, 5, LOAD_GRAPH_WIDTH)
+    sent = bucket_history(traffic, since, until, 1, LOAD_GRAPH_WIDTH, combine="sum")
+    recv = bucket_history(traffic, since, until, 2, LOAD_GRAPH_WIDTH, combine="sum")
+
+    samples = sum(row[10] or 1 for row in rows)
+    cpu_avg = sum(row[1] * (row[10] or 1) for row in rows) / samples
+    cpu_max = max(row[2] for row in rows)
+    ram_avg = sum(row[3] * (row[10] or 1) for row in rows) / samples
+    ram_max = max(row[4] for row in rows)
+    disk_max = max(row[6] for row in rows)
+
+    return f"""
+📈 ГРАФИК НАГРУЗКИ СИСТЕМЫ ({title})
+
+CPU  {make_sparkline(cpu, 100)}  ср. {cpu_avg:.1f}% | пик {cpu_max:.1f}%
+RAM  {make_sparkline(ram, 100)}  ср. {ram_avg:.1f}% | пик {ram_max:.1f}%
+Disk {make_sparkline(disk, 100)}  пик {disk_max:.1f}%
+📤   {make_sparkline(sent)}  {sum(v for v in sent if v):.0f} MB
+📥   {make_sparkline(recv)}  {sum(v for v in recv if v):.0f} MB
+
+Точек: {len(rows)} | {datetime.fromtimestamp(since).strftime('%d.%m %H:%M')} → {datetime.fromtimestamp(until).strftime('%d.%m %H:%M')}
+"""
+
+def render_current_load():
+    """График из текущего снимка (если история метрик недоступна)"""
     metrics = get_detailed_metrics()
 
     def create_bar(value, threshold):
@@ -650,7 +1910,7 @@ async def show_load_graph(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     cpu_bar = create_bar(metrics["cpu"], MONITORING_CONFIG["ALERTS"]["CPU_THRESHOLD"])
     ram_bar = create_bar(metrics["ram_percent"], MONITORING_CONFIG["ALERTS"]["RAM_THRESHOLD"])
-    graph = f"""
+    return f"""
 📈 **ГРАФИК НАГРУЗКИ СИСТЕМЫ**
 
 CPU [{metrics['cpu']:>5.1f}%] {cpu_bar}
@@ -661,9 +1921,45 @@ RAM [{metrics['ram_percent']:>5.1f}%] {ram_bar}
 0%{' ' * 18}50%{' ' * 18}100%
 """
 
-    keyboard = [[InlineKeyboardButton("🔄 Обновить", callback_data="load_graph"), InlineKeyboardButton("⬅️ Назад", callback_data="monitoring_status")]]
+async def show_load_graph(update: Update, context: ContextTypes.DEFAULT_TYPE, window="1h"):
+    """Показывает график нагрузки за выбранное окно"""
+    query = update.callback_query
+    if window not in LOAD_GRAPH_WINDOWS:
+        window = "1h"
+
+    graph = None
+    if METRICS_HISTORY_CONFIG["ENABLED"]:
+        # Перерисовываем, только если с прошлого раза появились новые сэмплы
+        last_sample = get_detailed_metrics()["timestamp"]
+        cached = load_graph_cache.get(window)
+        if cached and cached[0] == last_sample:
+            graph = cached[1]
+        else:
+            try:
+                graph = await asyncio.to_thread(render_load_graph, window)
+            except Exception as e:
+                print(f"Ошибка построения графика: {e}")
+            if graph:
+                load_graph_cache[window] = (last_sample, graph)
+
+    if not graph:
+        graph = render_current_load()
+
+    keyboard = [
+        [
+            InlineKeyboardButton(("• " if key == window else "") + key, callback_data=f"load_graph_{key}")
+            for key in LOAD_GRAPH_WINDOWS
+        ],
+        [
+            InlineKeyboardButton("🔄 Обновить", callback_data=f"load_graph_{window}"),
+            InlineKeyboardButton("⬅️ Назад", callback_data="monitoring_status")
+        ]
+    ]
 
-    await update.callback_query.edit_message_text(graph, reply_markup=InlineKeyboardMarkup(keyboard))
+    await safe_edit_message(
+        context.bot, query.message.chat_id, query.message.message_id, graph,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 
 
@@ -684,16 +1980,16 @@ async def clean_old_logs(context: ContextTypes.DEFAULT_TYPE):
         current_time = time.time()
         cutoff_time = current_time - (days_to_keep * 24 * 3600)
 
-        for filename in os.listdir(log_dir):
-            filepath = os.path.join(log_dir, filename)
-            if os.path.isfile(filepath):
-                # Проверяем расширение файла
-                if filename.endswith(('.log', '.txt')) and 'backup' in filename.lower():
-                    file_mtime = os.path.getmtime(filepath)
-                    if file_mtime < cutoff_time:
-                        os.remove(filepath)
-                        deleted_files += 1
-                        print(f"Удален старый файл: {filename}")
+        # scandir отдает тип файла без отдельного stat, mtime берется из той же записи
+        with os.scandir(log_dir) as entries:
+            for entry in entries:
+                filename = entry.name
+                if not filename.endswith(('.log', '.txt')) or 'backup' not in filename.lower():
+                    continue
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff_time:
+                    os.remove(entry.path)
+                    deleted_files += 1
+                    print(f"Удален старый файл: {filename}")
 
         if deleted_files > 0:
             print(f"Удалено {deleted_files} старых файлов логов")
@@ -753,21 +2049,6 @@ async def edit_message_progress(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 
-async def send_debug_message(message, bot=None):
-    """Буферизирует и отправляет дебаг-сообщения группами"""
-    if not DEBUG_CHATS or not bot:
-        return
-
-    async with debug_buffer_lock:
-        debug_message_buffer.append(message)
-
-        # Если буфер заполнен или это первое сообщение, запускаем таймер отправки
-        if len(debug_message_buffer) >= debug_buffer_size:
-            await flush_debug_buffer(bot)
-        elif len(debug_message_buffer) == 1:
-            # Запускаем отложенную отправку для первого сообщения
-            asyncio.create_task(delayed_flush(bot))
-
 async def delayed_flush(bot):
     """Отложенная отправка буфера"""
     await asyncio.sleep(debug_buffer_timeout)
@@ -805,42 +2086,728 @@ async def force_flush_debug_buffer(bot):
 
 # Системные функции
 def get_system_info():
-    cpu = psutil.cpu_percent(interval=1)
-    ram = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
-    uptime = time.time() - psutil.boot_time()
+    metrics = get_detailed_metrics()
+    uptime = time.time() - metrics["boot_time"]
 
     return (
-        f"CPU: {cpu}%\n"
-        f"RAM: {ram.percent}% ({ram.used // (1024**3)}/{ram.total // (1024**3)} GB)\n"
-        f"Disk: {disk.percent}% ({disk.used // (1024**3)}/{disk.total // (1024**3)} GB)\n"
+        f"CPU: {metrics['cpu']}%\n"
+        f"RAM: {metrics['ram_percent']}% ({metrics['ram_used']}/{metrics['ram_total']} GB)\n"
+        f"Disk: {metrics['disk_percent']}% ({metrics['disk_used']}/{metrics['disk_total']} GB)\n"
         f"Uptime: {int(uptime // 3600)}h {int((uptime % 3600) // 60)}m"
     )
 
-def get_userbot_status():
-    """Проверяет статус юзербота с улучшенной логикой"""
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'create_time']):
+def is_userbot_cmdline(cmdline):
+    """Проверяет, похожа ли командная строка на юзербота"""
+    cmdline_str = ' '.join(cmdline or []).lower()
+    return 'python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str
+
+def save_userbot_pidfile():
+    """Сохраняет PID юзербота, чтобы найти его после перезапуска бота"""
+    try:
+        with open(USERBOT_PID_FILE, 'w') as f:
+            json.dump(userbot_process, f)
+    except Exception as e:
+        print(f"Ошибка сохранения pid-файла: {e}")
+
+def load_userbot_pidfile():
+    """Загружает PID юзербота, запущенного до перезапуска бота"""
+    try:
+        if os.path.exists(USERBOT_PID_FILE):
+            with open(USERBOT_PID_FILE, 'r') as f:
+                data = json.load(f)
+            userbot_process["pid"] = data.get("pid")
+            userbot_process["create_time"] = data.get("create_time")
+    except Exception as e:
+        print(f"Ошибка загрузки pid-файла: {e}")
+
+def register_userbot_process(proc):
+    """Запоминает процесс юзербота (PID + create_time)"""
+    try:
+        userbot_process["pid"] = proc.pid
+        userbot_process["create_time"] = proc.create_time()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return
+    userbot_process["last_scan"] = 0
+    save_userbot_pidfile()
+
+def forget_userbot_process():
+    """Сбрасывает запомненный процесс юзербота"""
+    userbot_process["pid"] = None
+    userbot_process["create_time"] = None
+    userbot_process["last_scan"] = 0
+    try:
+        if os.path.exists(USERBOT_PID_FILE):
+            os.remove(USERBOT_PID_FILE)
+    except Exception as e:
+        print(f"Ошибка удаления pid-файла: {e}")
+
+def get_tracked_userbot():
+    """Возвращает запомненный процесс юзербота, если он еще жив (O(1))"""
+    pid = userbot_process["pid"]
+    if not pid:
+        return None
+    try:
+        proc = psutil.Process(pid)
+        # create_time защищает от переиспользования PID другим процессом
+        if proc.create_time() == userbot_process["create_time"] and proc.status() != psutil.STATUS_ZOMBIE:
+            return proc
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        pass
+    forget_userbot_process()
+    return None
+
+def scan_userbot_processes():
+    """Полный обход таблицы процессов (используется, если дескриптор устарел)"""
+    processes = []
+    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
         try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                return True, proc.info['create_time']
+            if is_userbot_cmdline(proc.info['cmdline']):
+                processes.append(proc)
         except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
             continue
 
+    userbot_process["last_scan"] = time.time()
+    if processes:
+        register_userbot_process(processes[0])
+        userbot_process["last_scan"] = time.time()
+    return processes
+
+def get_userbot_processes():
+    """Процессы юзербота для остановки: отслеживаемый плюс полный обход (дубликаты и потерянные копии)"""
+    proc = get_tracked_userbot()
+    processes = scan_userbot_processes()
+    if proc and all(found.pid != proc.pid for found in processes):
+        processes.insert(0, proc)
+    return processes
+
+def get_userbot_status():
+    """Проверяет статус юзербота с улучшенной логикой"""
+    proc = get_tracked_userbot()
+    if proc:
+        return True, userbot_process["create_time"]
+
+    # Недавний полный обход ничего не нашел - не повторяем его на каждый вызов
+    if time.time() - userbot_process["last_scan"] < USERBOT_SCAN_TTL:
+        return False, None
+
+    if scan_userbot_processes():
+        return True, userbot_process["create_time"]
     return False, None
 
-async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Проверить обновления бота на GitHub"""
-    user_id = update.effective_user.id
+def read_process_stats(proc):
+    """Снимает ресурсы одного процесса (None, если он уже завершился)"""
+    try:
+        with proc.oneshot():
+            stats = {
+                "pid": proc.pid,
+                "name": proc.name(),
+                # Для процесса, которого еще не было в прошлом сэмпле, всегда 0.0
+                "cpu": proc.cpu_percent(interval=None),
+                "threads": proc.num_threads(),
+                "fds": proc.num_fds() if hasattr(proc, "num_fds") else proc.num_handles()
+            }
+            try:
+                memory = proc.memory_full_info()
+                stats["uss"] = memory.uss
+            except psutil.AccessDenied:
+                memory = proc.memory_info()
+                stats["uss"] = None
+            stats["rss"] = memory.rss
+            try:
+                io = proc.io_counters()
+                stats["read_bytes"], stats["write_bytes"] = io.read_bytes, io.write_bytes
+            except (psutil.AccessDenied, AttributeError, NotImplementedError):
+                stats["read_bytes"] = stats["write_bytes"] = 0
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+        return None
+    return stats
+
+def collect_userbot_tree_metrics():
+    """Суммарные ресурсы юзербота и его дочерних процессов (вызывается из потока сэмплера)"""
+    global userbot_tree_stats
+
+    pid = userbot_process["pid"]
+    root = userbot_tree_procs.get(pid) if pid else None
+    try:
+        if pid and root is None:
+            root = psutil.Process(pid)
+            if root.create_time() != userbot_process["create_time"]:
+                root = None
+        children = root.children(recursive=True) if root else []
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        root = None
+
+    if root is None:
+        userbot_tree_procs.clear()
+        userbot_tree_stats = None
+        return None
+
+    # Оставляем старые объекты для известных процессов (сравнение psutil учитывает create_time)
+    current = {root.pid: root}
+    for child in children:
+        known = userbot_tree_procs.get(child.pid)
+        current[child.pid] = known if known is not None and known == child else child
+    userbot_tree_procs.clear()
+    userbot_tree_procs.update(current)
+
+    processes = [stats for stats in map(read_process_stats, current.values()) if stats]
+    if not processes:
+        userbot_tree_stats = None
+        return None
+
+    uss = [item["uss"] for item in processes]
+    userbot_tree_stats = {
+        "timestamp": time.time(),
+        "pid": root.pid,
+        "processes": len(processes),
+        "cpu": sum(item["cpu"] for item in processes),
+        "rss": sum(item["rss"] for item in processes),
+        "uss": sum(uss) if None not in uss else None,
+        "threads": sum(item["threads"] for item in processes),
+        "fds": sum(item["fds"] for item in processes),
+        "read_bytes": sum(item["read_bytes"] for item in processes),
+        "write_bytes": sum(item["write_bytes"] for item in processes),
+        "top": sorted(processes, key=lambda item: item["rss"], reverse=True)[:USERBOT_TREE_TOP]
+    }
+    return userbot_tree_stats
+
+def format_userbot_resources(stats=None, detailed=False):
+    """Текст с ресурсами юзербота для экранов статуса"""
+    stats = stats or userbot_tree_stats
+    if not stats:
+        return "нет данных"
+
+    mb = 1024 * 1024
+    memory = f"RSS {stats['rss'] / mb:.0f} MB"
+    if stats["uss"] is not None:
+        memory += f" (USS {stats['uss'] / mb:.0f} MB)"
+    text = (
+        f"CPU {stats['cpu']:.1f}%, {memory}\n"
+        f"Процессов: {stats['processes']}, потоков: {stats['threads']}, fd: {stats['fds']}, "
+        f"I/O: чтение {stats['read_bytes'] / mb:.0f} MB, запись {stats['write_bytes'] / mb:.0f} MB"
+    )
+    if detailed and stats["processes"] > 1:
+        text += "\n" + "\n".join(
+            f"  • {item['name']} ({item['pid']}): {item['rss'] / mb:.0f} MB, CPU {item['cpu']:.1f}%"
+            for item in stats["top"]
+        )
+    return text
+
+def build_userbot_command(use_proxy=False):
+    """Команда запуска; exec заменяет shell, поэтому PID процесса - это PID юзербота"""
+    return f"exec {PROXY_CMD if use_proxy else USERBOT_CMD}"
+
+async def launch_userbot_process(use_proxy=False):
+    """Запускает процесс юзербота и запоминает его дескриптор"""
+    env = os.environ.copy()
+    env['GIT_PYTHON_REFRESH'] = 'quiet'
+    env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
+
+    process = await asyncio.create_subprocess_shell(
+        build_userbot_command(use_proxy),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=USERBOT_DIR,
+        env=env
+    )
 
-    if not is_owner(user_id):
-        if update.callback_query:
-            await update.callback_query.answer("❌ Доступ запрещен", show_alert=True)
+    userbot_supervisor["process"] = process
+    userbot_supervisor["use_proxy"] = use_proxy
+    userbot_supervisor["started"] = time.time()
+    reset_userbot_readiness(process)
+    record_userbot_output(f"--- запуск {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} (PID: {process.pid}) ---".encode())
+    userbot_supervisor["reader"] = asyncio.create_task(read_userbot_output(process))
+    try:
+        register_userbot_process(psutil.Process(process.pid))
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        pass
+    return process
+
+async def spawn_userbot(bot, use_proxy=False):
+    """Запускает юзербота вручную и передает его под присмотр супервизора"""
+    global supervisor_task
+
+    userbot_supervisor["desired"] = True
+    userbot_supervisor["crash_loop"] = False
+    userbot_supervisor["restart_delay"] = SUPERVISOR_CONFIG["RESTART_DELAY"]
+    process = await launch_userbot_process(use_proxy)
+
+    if SUPERVISOR_CONFIG["ENABLED"] and (supervisor_task is None or supervisor_task.done()):
+        supervisor_task = asyncio.create_task(supervise_userbot(bot))
+    return process
+
+def release_userbot_supervisor():
+    """Отключает автоперезапуск перед намеренной остановкой юзербота"""
+    userbot_supervisor["desired"] = False
+
+async def supervise_userbot(bot):
+    """Ждет выхода юзербота и сразу перезапускает его (backoff + защита от crash-loop)"""
+    global log_follow_task
+
+    while True:
+        process = userbot_supervisor["process"]
+        if process is None:
+            return
+
+        exit_code = await process.wait()
+        # Пока ждали, юзербота могли перезапустить вручную - следим за новым процессом
+        if process is not userbot_supervisor["process"]:
+            continue
+
+        now = time.time()
+        uptime = now - userbot_supervisor["started"]
+        userbot_supervisor["last_exit_code"] = exit_code
+        userbot_supervisor["last_exit_time"] = now
+        forget_userbot_process()
+
+        if not userbot_supervisor["desired"]:
+            userbot_supervisor["process"] = None
+            return
+
+        print(f"⚠️ Юзербот завершился с кодом {exit_code} после {uptime:.0f} сек работы")
+
+        # Долго проработавший процесс сбрасывает backoff
+        if uptime >= SUPERVISOR_CONFIG["STABLE_UPTIME"]:
+            userbot_supervisor["restart_delay"] = SUPERVISOR_CONFIG["RESTART_DELAY"]
+
+        restarts = userbot_supervisor["restarts"]
+        restarts.append(now)
+        while restarts and now - restarts[0] > SUPERVISOR_CONFIG["CRASH_LOOP_WINDOW"]:
+            restarts.popleft()
+
+        if len(restarts) > SUPERVISOR_CONFIG["CRASH_LOOP_RESTARTS"]:
+            userbot_supervisor["crash_loop"] = True
+            userbot_supervisor["desired"] = False
+            userbot_supervisor["process"] = None
+            print("🛑 Юзербот падает в цикле, автоперезапуск остановлен")
+            if OWNER_USER_ID:
+                await safe_send_message(
+                    bot, OWNER_USER_ID,
+                    f"🛑 Юзербот упал {len(restarts)} раз за {SUPERVISOR_CONFIG['CRASH_LOOP_WINDOW'] // 60} мин "
+                    f"(последний код выхода: {exit_code}). Автоперезапуск остановлен, запустите его вручную.\n\n"
+                    f"{format_startup_failure(f'код выхода {exit_code}')}"
+                )
+            return
+
+        delay = userbot_supervisor["restart_delay"]
+        userbot_supervisor["restart_delay"] = min(
+            delay * SUPERVISOR_CONFIG["BACKOFF_FACTOR"],
+            SUPERVISOR_CONFIG["MAX_RESTART_DELAY"]
+        )
+        await asyncio.sleep(delay)
+
+        if process is not userbot_supervisor["process"]:
+            continue
+        if not userbot_supervisor["desired"]:
+            userbot_supervisor["process"] = None
+            return
+
+        try:
+            new_process = await launch_userbot_process(userbot_supervisor["use_proxy"])
+        except Exception as e:
+            print(f"❌ Супервизор не смог запустить юзербота: {e}")
+            userbot_supervisor["started"] = time.time()
+            continue
+
+        userbot_supervisor["total_restarts"] += 1
+        print(f"♻️ Юзербот перезапущен супервизором (PID: {new_process.pid})")
+        is_ready, ready_reason = await wait_userbot_ready(new_process, restart_started=now)
+
+        if DEBUG_CHATS:
+            if log_follow_task:
+                log_follow_task.cancel()
+            log_follow_task = asyncio.create_task(monitor_userbot_logs(bot))
+
+        if OWNER_USER_ID:
+            if is_ready:
+                status_text = f"готов через {time.time() - now:.1f} сек"
+            else:
+                status_text = f"не подтвердил готовность: {ready_reason}"
+            await safe_send_message(
+                bot, OWNER_USER_ID,
+                f"♻️ Юзербот завершился (код {exit_code}) и перезапущен, {status_text}"
+            )
+
+async def stop_supervisor():
+    """Останавливает супервизор, не трогая сам процесс юзербота"""
+    global supervisor_task
+    if supervisor_task:
+        supervisor_task.cancel()
+        try:
+            await supervisor_task
+        except asyncio.CancelledError:
+            pass
+        supervisor_task = None
+
+@functools.lru_cache(maxsize=4)
+def compile_ready_pattern(pattern):
+    """Компилирует шаблон готовности (для поиска по байтам)"""
+    return re.compile(pattern.encode()) if pattern else None
+
+def reset_userbot_readiness(process):
+    """Сбрасывает состояние готовности для только что запущенного процесса"""
+    try:
+        log_offset = os.path.getsize(LOG_FILE)
+    except OSError:
+        log_offset = 0
+    userbot_readiness["process"] = process
+    userbot_readiness["event"] = asyncio.Event()
+    userbot_readiness["reason"] = None
+    userbot_readiness["log_offset"] = log_offset
+
+def mark_userbot_ready(process, reason):
+    """Отмечает процесс готовым (учитывается только первый признак)"""
+    if userbot_readiness["process"] is process and not userbot_readiness["event"].is_set():
+        userbot_readiness["reason"] = reason
+        userbot_readiness["event"].set()
+
+def rotate_output_file():
+    """Ротирует файл с выводом юзербота (file -> file.1 -> file.2 ...)"""
+    path = OUTPUT_CAPTURE_CONFIG["FILE"]
+    backup_count = OUTPUT_CAPTURE_CONFIG["BACKUP_COUNT"]
+    try:
+        if output_file_state["file"]:
+            output_file_state["file"].close()
+        for i in range(backup_count - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if backup_count > 0:
+            os.replace(path, f"{path}.1")
         else:
-            await update.message.reply_text("❌ Доступ запрещен")
+            os.remove(path)
+    except OSError as e:
+        print(f"Ошибка ротации файла вывода: {e}")
+    output_file_state["file"] = None
+    output_file_state["size"] = 0
+
+def write_output_file(text):
+    """Дописывает строку вывода в файл (если он включен в конфиге)"""
+    try:
+        if output_file_state["file"] is None:
+            output_file_state["file"] = open(OUTPUT_CAPTURE_CONFIG["FILE"], 'a', encoding='utf-8')
+            output_file_state["size"] = output_file_state["file"].tell()
+        data = text + "\n"
+        output_file_state["file"].write(data)
+        output_file_state["size"] += len(data)
+    except OSError as e:
+        print(f"Ошибка записи файла вывода: {e}")
+        return
+
+    if output_file_state["size"] >= OUTPUT_CAPTURE_CONFIG["MAX_FILE_SIZE_MB"] * 1024 * 1024:
+        rotate_output_file()
+
+def flush_output_file():
+    """Сбрасывает буфер файла вывода на диск"""
+    if output_file_state["file"]:
+        try:
+            output_file_state["file"].flush()
+        except OSError:
+            pass
+
+def record_userbot_output(line):
+    """Сохраняет строку вывода в кольцевой буфер (и в файл)"""
+    text = line.decode(errors='replace').rstrip("\r")
+    userbot_output_buffer.append(text)
+    if OUTPUT_CAPTURE_CONFIG["FILE"]:
+        write_output_file(text)
+
+async def read_userbot_output(process):
+    """Постоянно вычитывает stdout юзербота, чтобы он не завис на заполненном pipe"""
+    pattern = compile_ready_pattern(READINESS_CONFIG["READY_PATTERN"])
+    tail = b""
+    try:
+        while True:
+            chunk = await process.stdout.read(OUTPUT_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            # Строка без перевода строки не должна расти бесконечно
+            if len(tail) > OUTPUT_MAX_LINE_LENGTH:
+                lines.append(tail)
+                tail = b""
+
+            for line in lines:
+                record_userbot_output(line)
+                if pattern and pattern.search(line):
+                    mark_userbot_ready(process, "stdout")
+            flush_output_file()
+
+        if tail:
+            record_userbot_output(tail)
+            flush_output_file()
+    except Exception as e:
+        print(f"Ошибка чтения вывода юзербота: {e}")
+
+def read_file_tail(path, lines=10):
+    """Последние строки файла (читается только конец, OUTPUT_TAIL_BYTES)"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - OUTPUT_TAIL_BYTES, 0))
+            data = f.read()
+    except OSError:
+        return []
+    return [line.decode(errors='replace') for line in data.splitlines()[-lines:]]
+
+def get_userbot_output_tail(lines=10):
+    """Последние строки вывода юзербота (из буфера, иначе - хвост лог-файла)"""
+    if userbot_output_buffer:
+        return list(userbot_output_buffer)[-lines:]
+
+    # Юзербот запущен не нами (например, до перезапуска бота) - читаем только конец лога
+    return read_file_tail(LOG_FILE, lines)
+
+def format_startup_failure(reason):
+    """Текст с причиной неудачного запуска и последним выводом юзербота"""
+    text = f"Причина: {reason}"
+    output = [line[:300] for line in get_userbot_output_tail(10)]
+    if output:
+        text += "\n\nПоследний вывод:\n" + "\n".join(output)
+    return text[-3500:]
+
+async def wait_log_ready(process, pattern):
+    """Ищет признак готовности в строках, дописанных в лог после запуска"""
+    offset = userbot_readiness["log_offset"]
+    tail = b""
+    while True:
+        await asyncio.sleep(READY_POLL_INTERVAL)
+        try:
+            size = os.path.getsize(LOG_FILE)
+            if size < offset:
+                offset = 0
+                tail = b""
+            if size == offset:
+                continue
+            with open(LOG_FILE, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read(size - offset)
+            offset += len(chunk)
+        except OSError:
+            continue
+
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        if any(pattern.search(line) for line in lines):
+            mark_userbot_ready(process, "лог")
+            return
+
+async def wait_health_port(process):
+    """Ждет, пока юзербот начнет принимать соединения на health-порту"""
+    host = READINESS_CONFIG["HEALTH_HOST"]
+    port = READINESS_CONFIG["HEALTH_PORT"]
+    while True:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 1)
+            writer.close()
+            mark_userbot_ready(process, f"порт {port}")
+            return
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(READY_POLL_INTERVAL)
+
+async def wait_userbot_ready(process, restart_started=None):
+    """Ждет готовности юзербота и возвращает (готов, причина), как только это известно"""
+    event = userbot_readiness["event"]
+    pattern = compile_ready_pattern(READINESS_CONFIG["READY_PATTERN"])
+    timeout = READINESS_CONFIG["TIMEOUT"]
+
+    probes = [asyncio.create_task(event.wait()), asyncio.create_task(process.wait())]
+    if pattern:
+        probes.append(asyncio.create_task(wait_log_ready(process, pattern)))
+    if READINESS_CONFIG["HEALTH_PORT"]:
+        probes.append(asyncio.create_task(wait_health_port(process)))
+
+    # Без шаблона и порта считаем готовым процесс, проживший STARTUP_GRACE секунд
+    grace = None
+    if not pattern and not READINESS_CONFIG["HEALTH_PORT"]:
+        grace = asyncio.create_task(asyncio.sleep(READINESS_CONFIG["STARTUP_GRACE"]))
+        probes.append(grace)
+
+    try:
+        done, _ = await asyncio.wait(probes, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for probe in probes:
+            probe.cancel()
+
+    if process.returncode is not None:
+        is_ready, reason = False, f"процесс завершился с кодом {process.returncode}"
+    elif event.is_set():
+        is_ready, reason = True, userbot_readiness["reason"]
+    elif grace is not None and grace in done:
+        is_ready, reason = True, f"процесс работает {READINESS_CONFIG['STARTUP_GRACE']} сек"
+    else:
+        is_ready, reason = False, f"нет признака готовности за {timeout} сек"
+
+    elapsed = time.time() - userbot_supervisor["started"]
+    if is_ready:
+        userbot_start_stats["last_ready_seconds"] = elapsed
+        userbot_start_stats["ready_seconds"].append(elapsed)
+        if restart_started:
+            userbot_start_stats["last_restart_seconds"] = time.time() - restart_started
+        print(f"✅ Юзербот готов через {elapsed:.2f} сек ({reason})")
+    else:
+        userbot_start_stats["failures"] += 1
+        print(f"❌ Юзербот не готов: {reason}")
+    return is_ready, reason
+
+def format_start_stats():
+    """Краткая статистика времени запуска юзербота"""
+    if userbot_start_stats["last_ready_seconds"] is None:
+        return "нет данных"
+    text = f"готов за {userbot_start_stats['last_ready_seconds']:.1f} сек"
+    if userbot_start_stats["last_restart_seconds"] is not None:
+        text += f", перезапуск {userbot_start_stats['last_restart_seconds']:.1f} сек"
+    if userbot_start_stats["failures"]:
+        text += f", неудачных запусков: {userbot_start_stats['failures']}"
+    return text
+
+def get_supervisor_status():
+    """Текстовое описание состояния супервизора"""
+    if not SUPERVISOR_CONFIG["ENABLED"]:
+        return "выключен"
+    if userbot_supervisor["crash_loop"]:
+        return "⛔ crash-loop, автоперезапуск остановлен"
+    if supervisor_task is None or supervisor_task.done():
+        return "не следит (юзербот запущен не ботом)"
+    return f"следит, перезапусков: {userbot_supervisor['total_restarts']}"
+
+async def get_github_session():
+    """Возвращает общую aiohttp-сессию для запросов к GitHub"""
+    global github_session
+    if github_session is None or github_session.closed:
+        github_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30, sock_connect=10, sock_read=10),
+            connector=aiohttp.TCPConnector(limit=4),
+            headers={
+                "Accept": "application/vnd.github+json",
+                "User-Agent": f"status-heroku-bot/{BOT_VERSION}"
+            }
+        )
+    return github_session
+
+async def close_github_session():
+    """Закрывает aiohttp-сессию GitHub"""
+    global github_session
+    if github_session is not None and not github_session.closed:
+        await github_session.close()
+    github_session = None
+
+async def github_get_json(url, force=False):
+    """GET к GitHub API с TTL-кэшем и условными запросами (If-None-Match)
+
+    Ответ 304 не расходует лимит запросов GitHub. Возвращает (status, data).
+    """
+    cached = github_cache.get(url)
+    if cached and not force and time.time() - cached["fetched"] < UPDATE_CHECK_CONFIG["CACHE_TTL"]:
+        return cached["status"], cached["data"]
+
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+
+    session = await get_github_session()
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304 and cached:
+            cached["fetched"] = time.time()
+            return cached["status"], cached["data"]
+
+        data = await response.json(content_type=None) if response.status == 200 else None
+        if response.status in (200, 404):
+            github_cache[url] = {
+                "status": response.status,
+                "data": data,
+                "etag": response.headers.get("ETag"),
+                "fetched": time.time()
+            }
+        return response.status, data
+
+async def fetch_latest_release(force=False):
+    """Получает последний релиз репозитория бота"""
+    return await github_get_json(f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest", force)
+
+def load_update_check_state():
+    """Восстанавливает последнюю версию, о которой уже сообщили владельцу"""
+    global last_notified_version
+    path = UPDATE_CHECK_CONFIG.get("STATE_FILE", "update_check.json")
+    try:
+        with open(path, 'r') as f:
+            last_notified_version = json.load(f).get("last_notified_version")
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Ошибка загрузки состояния проверки обновлений: {e}")
+
+def save_update_check_state():
+    """Атомарно сохраняет последнюю версию, о которой сообщили (временный файл + rename)"""
+    path = UPDATE_CHECK_CONFIG.get("STATE_FILE", "update_check.json")
+    directory = os.path.dirname(os.path.abspath(path))
+    temp_path = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".update-check-", suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"last_notified_version": last_notified_version}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Ошибка сохранения состояния проверки обновлений: {e}")
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+async def update_check_loop(application):
+    """Периодически проверяет новые релизы и сообщает владельцу"""
+    global last_notified_version
+
+    while True:
+        await asyncio.sleep(UPDATE_CHECK_CONFIG["INTERVAL"])
+        try:
+            status, release = await fetch_latest_release(force=True)
+            if status != 200 or not release:
+                continue
+
+            latest_version = release['tag_name']
+            if latest_version == BOT_VERSION or latest_version == last_notified_version:
+                continue
+
+            if OWNER_USER_ID:
+                keyboard = [[InlineKeyboardButton("🔄 Обновить бота", callback_data="update_bot")]]
+                await safe_send_message(
+                    application.bot, OWNER_USER_ID,
+                    f"🆕 **Вышла новая версия бота** `{latest_version}`\n\n"
+                    f"• Текущая версия: `{BOT_VERSION}`\n"
+                    f"• Релиз: {release.get('name') or latest_version}",
+                    parse_mode='Markdown',
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+            last_notified_version = latest_version
+            # Переживает перезапуски бота (в том числе после обновления и смены конфига)
+            save_update_check_state()
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка фоновой проверки обновлений: {e}")
+
+async def start_update_checker(application):
+    """Запускает фоновую проверку обновлений"""
+    global update_check_task
+    if not UPDATE_CHECK_CONFIG["ENABLED"]:
         return
+    load_update_check_state()
+    update_check_task = asyncio.create_task(update_check_loop(application))
+    print(f"🔍 Фоновая проверка обновлений запущена (каждые {UPDATE_CHECK_CONFIG['INTERVAL'] // 3600} ч)")
+
+async def stop_update_checker():
+    """Останавливает фоновую проверку обновлений"""
+    global update_check_task
+    if update_check_task:
+        update_check_task.cancel()
+        update_check_task = None
+    await close_github_session()
 
+async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверить обновления бота на GitHub"""
     # Определяем, откуда пришел запрос
     if update.callback_query:
         # Редактируем существующее сообщение
@@ -856,11 +2823,9 @@ async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Получаем информацию о последнем релизе
-        url = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
-        response = requests.get(url, timeout=10)
+        status, latest_release = await fetch_latest_release()
 
-        if response.status_code == 200:
-            latest_release = response.json()
+        if status == 200:
             latest_version = latest_release['tag_name']
             release_name = latest_release['name']
             release_notes = latest_release['body'][:500] + "..." if len(latest_release['body']) > 500 else latest_release['body']
@@ -887,13 +2852,12 @@ async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="updates_menu")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
 
-        elif response.status_code == 404:
+        elif status == 404:
             # Если нет релизов, проверяем последний коммит
             url = f"https://api.github.com/repos/{GITHUB_REPO}/commits?per_page=1"
-            response = requests.get(url, timeout=10)
+            status, commits = await github_get_json(url)
 
-            if response.status_code == 200:
-                commits = response.json()
+            if status == 200:
                 if commits:
                     latest_commit = commits[0]
                     commit_hash = latest_commit['sha'][:7]
@@ -911,11 +2875,11 @@ async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 else:
                     message_text = "❌ Не удалось получить информацию о коммитах"
             else:
-                message_text = f"❌ Ошибка при запросе к GitHub: {response.status_code}"
+                message_text = f"❌ Ошибка при запросе к GitHub: {status}"
         else:
-            message_text = f"❌ Ошибка при проверке обновлений: {response.status_code}"
+            message_text = f"❌ Ошибка при проверке обновлений: {status}"
 
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         message_text = f"❌ Ошибка сети при проверке обновлений: {str(e)}"
     except Exception as e:
         message_text = f"❌ Неожиданная ошибка: {str(e)}"
@@ -938,6 +2902,129 @@ async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await context.bot.send_message(chat_id, message_text, parse_mode='Markdown')
 
+UPDATE_BACKUP_STAMP = re.compile(r"-(\d{8}-\d{6})\.backup$")
+
+def list_update_backups(current_file):
+    """Возвращает резервные копии бота, от новых к старым"""
+    directory = os.path.dirname(current_file)
+    prefix = os.path.basename(current_file) + "."
+    backups = [
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(".backup")
+    ]
+    # mtime у копии - от исходного файла (copy2), поэтому порядок берем из метки в имени
+    def backup_stamp(path):
+        match = UPDATE_BACKUP_STAMP.search(path)
+        return match.group(1) if match else ""
+
+    backups.sort(key=backup_stamp, reverse=True)
+    return backups
+
+def fsync_directory(directory):
+    """Сбрасывает на диск запись каталога (иначе rename может потеряться при сбое питания)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def create_update_backup(current_file):
+    """Сохраняет версионированную резервную копию и удаляет лишние старые"""
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    backup_file = f"{current_file}.{BOT_VERSION}-{stamp}.backup"
+
+    # Копируем во временный файл и атомарно переименовываем
+    shutil.copy2(current_file, backup_file + ".tmp")
+    with open(backup_file + ".tmp", 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(backup_file + ".tmp", backup_file)
+    fsync_directory(os.path.dirname(os.path.abspath(backup_file)))
+
+    for old_backup in list_update_backups(current_file)[UPDATE_CHECK_CONFIG.get("BACKUPS_TO_KEEP", 5):]:
+        try:
+            os.remove(old_backup)
+        except OSError:
+            pass
+    return backup_file
+
+def atomic_install_file(source_file, target_file, keep_source=False):
+    """Атомарно заменяет target_file содержимым source_file"""
+    if keep_source:
+        temp_file = target_file + ".restore"
+        shutil.copy2(source_file, temp_file)
+        source_file = temp_file
+
+    with open(source_file, 'rb') as f:
+        os.fsync(f.fileno())
+    os.chmod(source_file, 0o755)
+    os.replace(source_file, target_file)
+    fsync_directory(os.path.dirname(os.path.abspath(target_file)))
+
+async def download_update(url, destination, progress_callback=None):
+    """Потоково скачивает файл, возвращает (размер, sha256)"""
+    session = await get_github_session()
+    digest = hashlib.sha256()
+    size = 0
+
+    # Без сжатия: иначе aiohttp распакует ответ и размер не совпадет с Content-Length
+    async with session.get(url, headers={"Accept": "*/*", "Accept-Encoding": "identity"}) as response:
+        response.raise_for_status()
+        expected_size = response.content_length
+        if response.headers.get("Content-Encoding", "identity") != "identity":
+            # Сервер все равно сжал ответ - Content-Length относится к сжатым данным
+            expected_size = None
+
+        with open(destination, 'wb') as f:
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                if progress_callback:
+                    await progress_callback(size, expected_size)
+
+    if expected_size is not None and size != expected_size:
+        raise ValueError(f"размер не совпадает: получено {size} из {expected_size} байт")
+    if size == 0:
+        raise ValueError("получен пустой файл")
+
+    return size, digest.hexdigest()
+
+async def fetch_expected_checksum(url):
+    """Загружает опубликованную контрольную сумму (<url>.sha256), если она есть"""
+    session = await get_github_session()
+    try:
+        async with session.get(url + ".sha256", headers={"Accept": "*/*"}) as response:
+            if response.status != 200:
+                return None
+            text = await response.text()
+            return text.split()[0].lower() if text.strip() else None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+async def check_python_syntax(path):
+    """Проверяет синтаксис файла в отдельном процессе, возвращает (ok, ошибка)"""
+    python = VENV_PYTHON if os.path.exists(VENV_PYTHON) else sys.executable
+    process = await asyncio.create_subprocess_exec(
+        python, "-m", "py_compile", path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=10)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False, "Таймаут проверки синтаксиса"
+
+    if process.returncode != 0:
+        return False, stderr.decode()[:500] if stderr else "Неизвестная ошибка синтаксиса"
+    return True, None
+
 async def update_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обновить бота с GitHub"""
     user_id = update.effective_user.id
@@ -964,11 +3051,10 @@ async def update_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Сохраняем текущих пользователей перед обновлением
-        save_users(USER_IDS)
+        save_users()
 
         # Получаем текущий путь к файлу бота
         current_file = os.path.abspath(__file__)
-        backup_file = current_file + ".backup"
 
         # Создаем временный файл для нового кода
         temp_file = current_file + ".new"
@@ -976,29 +3062,43 @@ async def update_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Скачиваем новый код по raw ссылке
         await edit_message_progress(update, context, message_id, "📥 Скачиваю обновление...")
 
+        last_progress = {"time": 0}
+
+        async def report_progress(size, expected_size):
+            now = time.time()
+            if now - last_progress["time"] < 1:
+                return
+            last_progress["time"] = now
+            if expected_size:
+                text = f"📥 Скачиваю обновление... {size * 100 // expected_size}% ({size // 1024} KB)"
+            else:
+                text = f"📥 Скачиваю обновление... {size // 1024} KB"
+            await edit_message_progress(update, context, message_id, text)
+
         try:
-            response = requests.get(GITHUB_RAW_URL, timeout=30)
-            response.raise_for_status()
+            size, checksum = await download_update(GITHUB_RAW_URL, temp_file, report_progress)
         except Exception as e:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
             await edit_message_progress(update, context, message_id, f"❌ Ошибка загрузки обновления: {str(e)}")
             return
 
-        # Сохраняем новый код во временный файл
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            f.write(response.text)
+        # Сверяем контрольную сумму, если она опубликована рядом с файлом
+        await edit_message_progress(update, context, message_id, "🔐 Проверяю контрольную сумму...")
+        expected_checksum = await fetch_expected_checksum(GITHUB_RAW_URL)
+        if expected_checksum and expected_checksum != checksum:
+            os.remove(temp_file)
+            await edit_message_progress(
+                update, context, message_id,
+                f"❌ Контрольная сумма не совпадает:\nожидалось {expected_checksum}\nполучено {checksum}"
+            )
+            return
 
         # Проверяем синтаксис нового кода
         await edit_message_progress(update, context, message_id, "🔍 Проверяю синтаксис...")
         try:
-            check_result = subprocess.run(
-                [VENV_PYTHON, "-m", "py_compile", temp_file],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-
-            if check_result.returncode != 0:
-                error_msg = check_result.stderr[:500] if check_result.stderr else "Неизвестная ошибка синтаксиса"
+            is_valid, error_msg = await check_python_syntax(temp_file)
+            if not is_valid:
                 await edit_message_progress(
                     update, context, message_id,
                     f"❌ Ошибка синтаксиса в новом коде:\n```\n{error_msg}\n```"
@@ -1012,31 +3112,26 @@ async def update_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Создаем резервную копию текущего файла
         await edit_message_progress(update, context, message_id, "💾 Создаю резервную копию...")
+        backup_file = None
         try:
-            import shutil
-            shutil.copy2(current_file, backup_file)
+            backup_file = await asyncio.to_thread(create_update_backup, current_file)
         except Exception as e:
             await edit_message_progress(update, context, message_id, f"⚠️ Не удалось создать резервную копию: {str(e)}")
 
         # Заменяем текущий файл новым
         await edit_message_progress(update, context, message_id, "🔄 Применяю обновление...")
         try:
-            # Закрываем все файловые дескрипторы перед заменой
-            import sys
             sys.stdout.flush()
             sys.stderr.flush()
 
-            # Заменяем файл
-            os.replace(temp_file, current_file)
-
-            # Устанавливаем правильные права доступа
-            os.chmod(current_file, 0o755)
+            # Атомарная замена: файл либо старый, либо новый целиком
+            await asyncio.to_thread(atomic_install_file, temp_file, current_file)
 
         except Exception as e:
             # Восстанавливаем из резервной копии при ошибке
-            if os.path.exists(backup_file):
+            if backup_file and os.path.exists(backup_file):
                 try:
-                    os.replace(backup_file, current_file)
+                    await asyncio.to_thread(atomic_install_file, backup_file, current_file, True)
                     await edit_message_progress(update, context, message_id, "🔄 Восстановлен из резервной копии")
                 except:
                     pass
@@ -1051,17 +3146,24 @@ async def update_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
+        result_text = (
+            "✅ Бот успешно обновлен!\n\n"
+            f"• Размер: {size // 1024} KB\n"
+            f"• SHA-256: {checksum[:16]}…{' (проверена)' if expected_checksum else ''}\n\n"
+            "Нажмите кнопку для перезапуска:"
+        )
+
         if is_callback:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=message_id,
-                text="✅ Бот успешно обновлен!\n\nНажмите кнопку для перезапуска:",
+                text=result_text,
                 reply_markup=reply_markup
             )
         else:
             await context.bot.send_message(
                 chat_id,
-                "✅ Бот успешно обновлен!\n\nНажмите кнопку для перезапуска:",
+                result_text,
                 reply_markup=reply_markup
             )
 
@@ -1080,7 +3182,7 @@ async def delete_user_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
     users_list = ["🗑 Удалить пользователя:\n"]
     for uid in USER_IDS:
-        if uid != OWNER_ID:
+        if uid != OWNER_USER_ID:
             users_list.append(f"👤 {uid} - /del_user_{uid}")
 
     if len(users_list) == 1:
@@ -1089,23 +3191,16 @@ async def delete_user_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="users_menu")]]
     await query.edit_message_text("\n".join(users_list), reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def delete_specific_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Удаление конкретного пользователя через кнопку"""
+async def delete_specific_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str):
+    """Удаление конкретного пользователя через кнопку (del_user_<id>)"""
     query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
 
-    if user_id in USER_IDS and user_id != OWNER_ID:
-        USER_IDS.remove(user_id)
-        save_users(USER_IDS)
-        await query.answer(f"✅ Пользователь {user_id} удален", show_alert=True)
-        await asyncio.sleep(1)
+    if remove_user(user_id):
+        await query.edit_message_text(f"✅ Пользователь {user_id} удален")
+        await asyncio.sleep(2)
         await show_users_menu(update, context)
     else:
-        await query.answer("❌ Нельзя удалить этого пользователя", show_alert=True)
+        await query.edit_message_text("❌ Нельзя удалить этого пользователя")
 
 async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статус через кнопку"""
@@ -1115,6 +3210,7 @@ async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_running:
         uptime = time.time() - start_time
         status_text += f"\n⏱ Uptime: {int(uptime // 3600)}h {int((uptime % 3600) // 60)}m"
+        status_text += f"\n🧮 {format_userbot_resources()}"
 
     keyboard = [[InlineKeyboardButton("🔄 Обновить", callback_data="status"), InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]]
     await query.edit_message_text(f"📊 **Статус юзербота:**\n\n{status_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
@@ -1204,13 +3300,11 @@ async def del_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.args:
         try:
             user_id = int(context.args[0])
-            if user_id == OWNER_ID:
+            if is_owner(user_id):
                 await update.message.reply_text("❌ Нельзя удалить владельца")
                 return
 
-            if user_id in USER_IDS:
-                USER_IDS.remove(user_id)
-                save_users(USER_IDS)  # Сохраняем изменения
+            if remove_user(user_id):
                 await update.message.reply_text(f"✅ Пользователь {user_id} удален")
             else:
                 await update.message.reply_text("❌ Пользователь не найден")
@@ -1335,11 +3429,10 @@ async def scheduler_settings(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def toggle_auto_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global SCHEDULED_TASKS_CONFIG
     """Переключение автоперезапуска юзербота"""
     query = update.callback_query
 
-    SCHEDULED_TASKS_CONFIG["AUTO_RESTART_USERBOT"] = not SCHEDULED_TASKS_CONFIG["AUTO_RESTART_USERBOT"]
+    update_config_values("SCHEDULED_TASKS", {"AUTO_RESTART_USERBOT": not SCHEDULED_TASKS_CONFIG["AUTO_RESTART_USERBOT"]})
 
     status = "включен" if SCHEDULED_TASKS_CONFIG["AUTO_RESTART_USERBOT"] else "выключен"
     await query.answer(f"🔄 Автоперезапуск {status}", show_alert=True)
@@ -1400,7 +3493,7 @@ async def toggle_scheduler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Включение/выключение планировщика"""
     query = update.callback_query
 
-    SCHEDULED_TASKS_CONFIG["ENABLED"] = not SCHEDULED_TASKS_CONFIG["ENABLED"]
+    update_config_values("SCHEDULED_TASKS", {"ENABLED": not SCHEDULED_TASKS_CONFIG["ENABLED"]})
 
     status = "включен" if SCHEDULED_TASKS_CONFIG["ENABLED"] else "выключен"
     await query.answer(f"Планировщик {status}", show_alert=True)
@@ -1415,11 +3508,7 @@ async def apply_scheduler_settings(update: Update, context: ContextTypes.DEFAULT
 
     try:
         # Перезапускаем планировщик с новыми настройками
-        global scheduler
-        if scheduler:
-            scheduler.shutdown()
-
-        await setup_scheduler(context.application)
+        await restart_scheduler(context.application)
 
         await query.answer("✅ Настройки применены", show_alert=True)
         await scheduler_settings(update, context)
@@ -1429,24 +3518,14 @@ async def apply_scheduler_settings(update: Update, context: ContextTypes.DEFAULT
 
 
 async def save_scheduler_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global SCHEDULED_TASKS_CONFIG
     """Сохранение настроек планировщика в config.json"""
     query = update.callback_query
 
     try:
-        # Обновляем конфигурацию
-        CONFIG["SCHEDULED_TASKS"] = SCHEDULED_TASKS_CONFIG
-
-        # Сохраняем в файл
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(CONFIG, f, indent=4)
+        # Текущий снимок уже содержит изменения из меню
+        write_config_file(CONFIG)
 
         await query.answer("✅ Настройки сохранены в config.json", show_alert=True)
-
-        # Обновляем глобальные переменные
-
-        SCHEDULED_TASKS_CONFIG = CONFIG["SCHEDULED_TASKS"]
-
         await scheduler_settings(update, context)
 
     except Exception as e:
@@ -1455,24 +3534,23 @@ async def save_scheduler_config(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 async def handle_time_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global SCHEDULED_TASKS_CONFIG
     """Обработка установки времени"""
     query = update.callback_query
     data = query.data
 
     if data.startswith("set_time_"):
         time_str = data.replace("set_time_", "")
-        SCHEDULED_TASKS_CONFIG["DAILY_REPORT_TIME"] = time_str
+        update_config_values("SCHEDULED_TASKS", {"DAILY_REPORT_TIME": time_str})
         await query.answer(f"📅 Время отчета: {time_str}", show_alert=True)
 
     elif data.startswith("set_restart_"):
         time_str = data.replace("set_restart_", "")
-        SCHEDULED_TASKS_CONFIG["AUTO_RESTART_TIME"] = time_str
+        update_config_values("SCHEDULED_TASKS", {"AUTO_RESTART_TIME": time_str})
         await query.answer(f"⏰ Время перезапуска: {time_str}", show_alert=True)
 
     elif data.startswith("set_logs_"):
         days = int(data.replace("set_logs_", ""))
-        SCHEDULED_TASKS_CONFIG["CLEAN_OLD_LOGS_DAYS"] = days
+        update_config_values("SCHEDULED_TASKS", {"CLEAN_OLD_LOGS_DAYS": days})
         status = "отключена" if days == 0 else f"{days} дней"
         await query.answer(f"🧹 Очистка логов: {status}", show_alert=True)
 
@@ -1487,7 +3565,7 @@ async def handle_time_setting(update: Update, context: ContextTypes.DEFAULT_TYPE
         }
         tz_key = data.replace("set_tz_", "")
         if tz_key in tz_map:
-            SCHEDULED_TASKS_CONFIG["TIMEZONE"] = tz_map[tz_key]
+            update_config_values("SCHEDULED_TASKS", {"TIMEZONE": tz_map[tz_key]})
             await query.answer(f"🌐 Часовой пояс: {tz_key}", show_alert=True)
 
     # Возвращаемся к настройкам
@@ -1495,6 +3573,268 @@ async def handle_time_setting(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 
+# Горячая перезагрузка конфигурации
+def get_config_value(config, path):
+    """Значение по пути вида SECTION.KEY (None, если его нет)"""
+    value = config
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def validate_config(config):
+    """Проверяет значения, применяемые на лету; возвращает список ошибок"""
+    errors = []
+
+    positive = (
+        "MONITORING.CHECK_INTERVAL", "MONITORING.SAMPLE_INTERVAL", "PERFORMANCE.LOOP_LAG_INTERVAL",
+        "UPDATE_CHECK.INTERVAL", "MONITORING.ALERTS.ACK_DURATION", "SUPERVISOR.RESTART_DELAY",
+        "LEAK_DETECTOR.CHECK_INTERVAL", "LEAK_DETECTOR.WINDOW_HOURS", "LEAK_DETECTOR.ALERT_HOURS", "SUPERVISOR.MAX_RESTART_DELAY",
+        "READINESS.TIMEOUT", "METRICS_EXPORTER.CACHE_TTL", "DISK_INDEX.INTERVAL", "DISK_INDEX.FULL_RESCAN_HOURS",
+        "DISK_INDEX.TOP",
+        "BROADCAST.GLOBAL_RATE", "BROADCAST.PER_CHAT_INTERVAL", "BROADCAST.MAX_CONCURRENCY", "BROADCAST.MAX_RETRIES"
+    )
+    for path in positive:
+        value = get_config_value(config, path)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            errors.append(f"{path}: нужно положительное число, получено {value!r}")
+
+    for path in ("MONITORING.ALERTS.CPU_THRESHOLD", "MONITORING.ALERTS.RAM_THRESHOLD", "MONITORING.ALERTS.DISK_THRESHOLD"):
+        value = get_config_value(config, path)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value <= 100:
+            errors.append(f"{path}: нужен процент 1-100, получено {value!r}")
+
+    for path in ("MONITORING.ALERTS.USERBOT_CPU_THRESHOLD", "MONITORING.ALERTS.USERBOT_RSS_MB_THRESHOLD"):
+        value = get_config_value(config, path)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            errors.append(f"{path}: нужно число >= 0 (0 - выключено), получено {value!r}")
+
+    for path in ("SCHEDULED_TASKS.DAILY_REPORT_TIME", "SCHEDULED_TASKS.AUTO_RESTART_TIME"):
+        value = get_config_value(config, path)
+        if not isinstance(value, str) or not re.fullmatch(r"([01]?\d|2[0-3]):[0-5]\d", value):
+            errors.append(f"{path}: нужно время ЧЧ:ММ, получено {value!r}")
+
+    for path in ("LEAK_DETECTOR.WARMUP_MINUTES", "LEAK_DETECTOR.MIN_SPAN_MINUTES"):
+        value = get_config_value(config, path)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            errors.append(f"{path}: нужно число >= 0, получено {value!r}")
+
+    min_r2 = get_config_value(config, "LEAK_DETECTOR.MIN_R2")
+    if isinstance(min_r2, bool) or not isinstance(min_r2, (int, float)) or not 0 <= min_r2 <= 1:
+        errors.append(f"LEAK_DETECTOR.MIN_R2: нужно число от 0 до 1, получено {min_r2!r}")
+
+    timezone = get_config_value(config, "SCHEDULED_TASKS.TIMEZONE")
+    if timezone not in pytz.all_timezones_set:
+        errors.append(f"SCHEDULED_TASKS.TIMEZONE: неизвестный часовой пояс {timezone!r}")
+
+    for entry in get_config_value(config, "MONITORING.ALERTS.RULES") or []:
+        if not isinstance(entry, dict) or not entry.get("NAME") or not entry.get("METRIC"):
+            errors.append(f"MONITORING.ALERTS.RULES: у правила нет NAME/METRIC: {entry!r}")
+        elif entry.get("OP", ">") not in ALERT_OPERATORS:
+            errors.append(f"MONITORING.ALERTS.RULES.{entry['NAME']}: OP должен быть > или <")
+        elif isinstance(entry.get("FIRE"), bool) or not isinstance(entry.get("FIRE"), (int, float)):
+            errors.append(f"MONITORING.ALERTS.RULES.{entry['NAME']}: FIRE должен быть числом")
+
+    pattern = get_config_value(config, "READINESS.READY_PATTERN")
+    try:
+        re.compile(pattern or "")
+    except (re.error, TypeError) as e:
+        errors.append(f"READINESS.READY_PATTERN: {e}")
+
+    return errors
+
+def diff_config(old, new, prefix=""):
+    """Список путей SECTION.KEY, значения которых отличаются"""
+    changes = []
+    for key in sorted(set(old) | set(new)):
+        path = f"{prefix}{key}"
+        old_value, new_value = old.get(key), new.get(key)
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changes.extend(diff_config(old_value, new_value, path + "."))
+        elif old_value != new_value:
+            changes.append(path)
+    return changes
+
+def is_restart_required(path):
+    """Изменение по этому пути применится только после перезапуска бота"""
+    return any(path == key or path.startswith(key + ".") for key in RESTART_REQUIRED_KEYS)
+
+def apply_config(config):
+    """Подменяет снимок конфигурации и ссылки на его секции (без await - атомарно для event loop)"""
+    global CONFIG, MONITORING_CONFIG, SCHEDULED_TASKS_CONFIG, LOG_EXPORT_CONFIG, METRICS_HISTORY_CONFIG
+    global UPDATE_CHECK_CONFIG, PERFORMANCE_CONFIG, METRICS_EXPORTER_CONFIG, SUPERVISOR_CONFIG
+    global READINESS_CONFIG, OUTPUT_CAPTURE_CONFIG, LEAK_DETECTOR_CONFIG, DISK_INDEX_CONFIG, alert_cooldown
+    global BROADCAST_CONFIG
+
+    CONFIG = config
+    MONITORING_CONFIG = config["MONITORING"]
+    SCHEDULED_TASKS_CONFIG = config["SCHEDULED_TASKS"]
+    LOG_EXPORT_CONFIG = config["LOG_EXPORT"]
+    METRICS_HISTORY_CONFIG = config["METRICS_HISTORY"]
+    UPDATE_CHECK_CONFIG = config["UPDATE_CHECK"]
+    PERFORMANCE_CONFIG = config["PERFORMANCE"]
+    METRICS_EXPORTER_CONFIG = config["METRICS_EXPORTER"]
+    SUPERVISOR_CONFIG = config["SUPERVISOR"]
+    READINESS_CONFIG = config["READINESS"]
+    OUTPUT_CAPTURE_CONFIG = config["OUTPUT_CAPTURE"]
+    LEAK_DETECTOR_CONFIG = config["LEAK_DETECTOR"]
+    DISK_INDEX_CONFIG = config["DISK_INDEX"]
+    BROADCAST_CONFIG = config["BROADCAST"]
+    alert_cooldown = MONITORING_CONFIG["ALERTS"]["MIN_INTERVAL_BETWEEN_ALERTS"]
+    refresh_alert_rules()
+
+def update_config_values(section, values):
+    """Меняет значения секции через новый снимок (текущий снимок не изменяется)"""
+    config = copy.deepcopy(CONFIG)
+    config[section].update(values)
+    apply_config(config)
+
+def write_config_file(config):
+    """Атомарно записывает config.json (временный файл + rename)"""
+    directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".config-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(config, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, CONFIG_FILE)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Собственную запись наблюдатель перечитывать не должен
+    config_watch_state["signature"] = get_config_signature()
+
+async def restart_scheduler(application):
+    """Пересоздает задачи планировщика по текущему снимку конфигурации"""
+    global scheduler
+    if scheduler and scheduler.running:
+        scheduler.shutdown(wait=False)
+    scheduler = None
+    await setup_scheduler(application)
+
+async def reconfigure_services(application, changes):
+    """Перенастраивает на месте то, что не перечитывает конфигурацию само"""
+    global update_check_task
+
+    sections = {path.split(".")[0] for path in changes}
+
+    if "SCHEDULED_TASKS" in sections and application:
+        await restart_scheduler(application)
+
+    if "UPDATE_CHECK.ENABLED" in changes or "UPDATE_CHECK.INTERVAL" in changes:
+        if update_check_task:
+            update_check_task.cancel()
+            update_check_task = None
+        if application:
+            await start_update_checker(application)
+
+    if "OUTPUT_CAPTURE.FILE" in changes and output_file_state["file"]:
+        # Следующая строка вывода откроет новый файл
+        output_file_state["file"].close()
+        output_file_state["file"] = None
+        output_file_state["size"] = 0
+
+async def reload_config(application=None):
+    """Перечитывает config.json: проверка, diff и подмена снимка. Возвращает (изменения, ошибки)"""
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("ожидается JSON-объект")
+        config = merge_config_defaults(config, DEFAULT_CONFIG)
+        errors = validate_config(config)
+    except (OSError, ValueError) as e:
+        errors = [f"не удалось прочитать {CONFIG_FILE}: {e}"]
+
+    if errors:
+        config_watch_state["last_error"] = "; ".join(errors)
+        print(f"⚠️ Конфигурация не применена: {config_watch_state['last_error']}")
+        return [], errors
+
+    config_watch_state["last_error"] = None
+    changes = diff_config(CONFIG, config)
+    if not changes:
+        return [], []
+
+    apply_config(config)
+    await reconfigure_services(application, changes)
+
+    pending = set(config_watch_state["pending_restart"])
+    pending.update(path for path in changes if is_restart_required(path))
+    config_watch_state["pending_restart"] = sorted(pending)
+    config_watch_state["reloads"] += 1
+    config_watch_state["last_reload"] = time.time()
+    print(f"🔧 Конфигурация перечитана: {', '.join(changes)}")
+    return changes, []
+
+def format_config_reload(changes, errors):
+    """Текст о результате перезагрузки конфигурации"""
+    if errors:
+        return "⚠️ config.json не применен:\n" + "\n".join(f"• {error}" for error in errors)
+    if not changes:
+        return "ℹ️ config.json не изменился"
+
+    lines = ["🔧 config.json перечитан, изменено:"]
+    lines.extend(f"• {path}" + (" (после перезапуска)" if is_restart_required(path) else "") for path in changes)
+    return "\n".join(lines)
+
+def get_config_signature():
+    """mtime и размер config.json (None, если файла нет)"""
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+async def config_watcher(application):
+    """Следит за config.json и применяет изменения без перезапуска бота"""
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        signature = get_config_signature()
+        if signature is None or signature == config_watch_state["signature"]:
+            continue
+
+        # Редактор мог еще не дописать файл - ждем, пока он перестанет меняться
+        await asyncio.sleep(CONFIG_SETTLE_DELAY)
+        if get_config_signature() != signature:
+            continue
+        config_watch_state["signature"] = signature
+
+        try:
+            changes, errors = await reload_config(application)
+            if (changes or errors) and OWNER_USER_ID:
+                await safe_send_message(application.bot, OWNER_USER_ID, format_config_reload(changes, errors))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка перезагрузки конфигурации: {e}")
+
+async def start_config_watcher(application):
+    """Запускает наблюдение за config.json"""
+    global config_watcher_task
+    config_watch_state["signature"] = get_config_signature()
+    config_watcher_task = asyncio.create_task(config_watcher(application))
+
+async def stop_config_watcher():
+    """Останавливает наблюдение за config.json"""
+    global config_watcher_task
+    if config_watcher_task:
+        config_watcher_task.cancel()
+        config_watcher_task = None
+
+async def reload_config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перечитать config.json вручную"""
+    config_watch_state["signature"] = get_config_signature()
+    changes, errors = await reload_config(context.application)
+
+    text = format_config_reload(changes, errors)
+    if config_watch_state["pending_restart"]:
+        text += "\n\n♻️ Ждут перезапуска бота: " + ", ".join(config_watch_state["pending_restart"])
+    await update.message.reply_text(text)
+
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает главное меню"""
@@ -1545,34 +3885,6 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def show_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Меню настроек"""
-    debug_status = "✅ Включен" if update.effective_chat.id in DEBUG_CHATS else "❌ Выключен"
-
-    keyboard = [
-        [
-            InlineKeyboardButton(f"🔍 Дебаг: {debug_status}", callback_data="toggle_debug")
-        ],
-        [
-            InlineKeyboardButton("🌐 Статус соединения", callback_data="connection_status"),
-            InlineKeyboardButton("🖥 Терминал", callback_data="terminal_menu")
-        ],
-        [
-            InlineKeyboardButton("🌐 Ping", callback_data="ping_menu"),
-            InlineKeyboardButton("👥 Пользователи", callback_data="users_menu")
-        ],
-        [
-            InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.callback_query.edit_message_text(
-        f"⚙️ **Меню настроек**\n\nТекущие настройки:\n- Дебаг-режим: {debug_status}",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
-
 async def show_logs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Меню логов"""
     keyboard = [
@@ -1617,6 +3929,8 @@ async def show_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
             InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")
         ]
     ]
+    if is_owner(update.effective_user.id):
+        keyboard.insert(-1, [InlineKeyboardButton("⏱ Performance", callback_data="performance")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await update.callback_query.edit_message_text(
@@ -1686,15 +4000,9 @@ async def restart_userbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔄 Перезапускаю юзербота...")
 
     # Сначала останавливаем
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-            continue
+    restart_requested = time.time()
+    release_userbot_supervisor()
+    processes = get_userbot_processes()
 
     if processes:
         for proc in processes:
@@ -1724,33 +4032,19 @@ async def restart_userbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Запускаем заново
     try:
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
-
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(5)
+        process = await spawn_userbot(context.bot)
 
-        is_running, _ = get_userbot_status()
+        is_running, ready_reason = await wait_userbot_ready(process, restart_started=restart_requested)
         if is_running:
             await update.message.reply_text("✅ Юзербот успешно перезапущен!")
 
-            global monitor_task
+            global log_follow_task
             if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
+                if log_follow_task:
+                    log_follow_task.cancel()
+                log_follow_task = asyncio.create_task(monitor_userbot_logs(context.bot))
         else:
-            await update.message.reply_text("❌ Не удалось перезапустить юзербота. Проверьте логи.")
+            await update.message.reply_text(f"❌ Не удалось перезапустить юзербота.\n\n{format_startup_failure(ready_reason)}")
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка перезапуска: {str(e)}")
@@ -1841,6 +4135,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /stop_userbot - Остановить юзербота
 /restart_userbot - Перезапустить юзербота
 /restart_bot - Перезапустить бота
+/reload_config - Перечитать config.json
 /status - Статус юзербота
 /info - Информация о системе
 /detailed_info - Подробная информация
@@ -1854,6 +4149,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **Управление:**
 /install_requirements - Установить зависимости
 /update_heroku - Обновить HerokuTL
+/fleet [start|stop|restart|logs] [имя] - Флот юзерботов
 /logs <уровень> - Получить логи
 /debug_on - Включить дебаг
 /debug_off - Выключить дебаг
@@ -1862,13 +4158,14 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /ram - Информация о RAM
 /cpu - Информация о CPU
 /disk - Информация о диске
+/du - Крупнейшие файлы и каталоги юзербота
 /uptime - Аптайм системы
 /ping [хост] - Ping хоста
 /terminal [команда] - Выполнить команду
 
 **Пользователи:**
 /get_owner - Добавить себя
-/get_user [id] - Добавить пользователя
+/get_user [id] [user|viewer] - Добавить пользователя
 /del_user [id] - Удалить пользователя
 
 **Инлайн-режим:**
@@ -1897,6 +4194,7 @@ async def about_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def connection_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статус соединения бота с кнопкой обновления"""
+    global api_response_time_last
     user_id = update.effective_user.id
 
     if not is_user(user_id):
@@ -1930,6 +4228,7 @@ async def connection_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             bot_info = await asyncio.wait_for(context.bot.get_me(), timeout=10)
             api_response_time = (time.time() - start_time) * 1000  # в миллисекундах
+            api_response_time_last = api_response_time / 1000
 
             # Дополнительные проверки
             start_time_ping = time.time()
@@ -1942,8 +4241,9 @@ async def connection_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ping_time = (time.time() - start_time_ping) * 1000
 
             # Получаем информацию о системе
-            cpu_usage = psutil.cpu_percent(interval=0.1)
-            memory_usage = psutil.virtual_memory().percent
+            metrics = get_detailed_metrics()
+            cpu_usage = metrics["cpu"]
+            memory_usage = metrics["ram_percent"]
 
             # Определяем качество соединения
             if api_response_time < 500:
@@ -1966,6 +4266,7 @@ async def connection_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "📊 Производительность:\n"
                 f"• Время ответа API: {api_response_time:.0f} мс\n"
                 f"• Ping до Telegram: {ping_time:.0f} мс\n"
+                f"• Получение обновлений: {update_mode}\n"
                 f"• Качество соединения: {connection_quality}\n"
                 f"• Загрузка CPU: {cpu_usage:.1f}%\n"
                 f"• Использование RAM: {memory_usage:.1f}%\n\n"
@@ -2031,6 +4332,19 @@ async def connection_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(error_message)
         print(f"Ошибка при отправке статуса соединения: {e}")
 
+INTERNET_CHECK_HOSTS = (("1.1.1.1", 53), ("8.8.8.8", 53))
+
+async def check_internet_connection():
+    """Проверяет доступ в интернет: TCP-соединение хотя бы с одним публичным DNS"""
+    for host, port in INTERNET_CHECK_HOSTS:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=5)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            continue
+    return False
+
 async def check_telegram_connection(bot):
     """Проверяет соединение с Telegram API"""
     try:
@@ -2137,23 +4451,11 @@ async def send_connection_status_update(bot, status, downtime=None):
 
     message = message_map.get(status, "❓ Неизвестный статус соединения")
 
-    for user_id in USER_IDS.copy():
-        try:
-            await safe_send_message(bot, user_id, message)
-        except Exception as e:
-            print(f"Не удалось отправить уведомление о соединении пользователю {user_id}: {e}")
+    await broadcast_message(bot, USER_IDS.copy(), message)
 
 
 async def check_updates_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверка обновлений через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-
-    await query.answer()
     await check_updates(update, context)
 
 async def update_bot_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2210,6 +4512,9 @@ async def show_management_menu(update: Update, context: ContextTypes.DEFAULT_TYP
             InlineKeyboardButton("🚀 Запуск с прокси", callback_data="start_proxy"),
             InlineKeyboardButton("🐞 Диагностика", callback_data="debug_userbot")
         ],
+        [
+            InlineKeyboardButton("🚢 Флот юзерботов", callback_data="fleet")
+        ],
         [
             InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")
         ]
@@ -2221,306 +4526,627 @@ async def show_management_menu(update: Update, context: ContextTypes.DEFAULT_TYP
         reply_markup=reply_markup
     )
 
-async def install_requirements_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Установка зависимостей через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Эта функция доступна только владельцу", show_alert=True)
-        return
-
-    await query.edit_message_text("📦 Устанавливаю зависимости...")
-
-    try:
-        cmd = f"cd {USERBOT_DIR} && {VENV_PYTHON} -m pip install -r requirements.txt"
-
-        # Устанавливаем правильные переменные окружения
-        env = os.environ.copy()
-        env['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:/home/alina/.venv/bin:/home/alina/.local/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
+# Флот юзерботов
+def get_fleet_state(name):
+    """Состояние дополнительного инстанса (дескриптор процесса и буфер вывода)"""
+    if name not in fleet_state:
+        fleet_state[name] = {
+            "process": None,
+            "output": deque(maxlen=FLEET_OUTPUT_LINES)
+        }
+    return fleet_state[name]
 
-        output_lines = []
-        async for line in process.stdout:
-            line = line.decode().strip()
-            output_lines.append(line)
+def scan_fleet_processes():
+    """Один проход по таблице процессов: раскладывает юзерботов по инстансам по cwd"""
+    by_dir = {instance["dir"]: name for name, instance in FLEET_INSTANCES.items()}
+    found = {name: [] for name in FLEET_INSTANCES}
 
-        await process.wait()
+    for proc in psutil.process_iter(['pid', 'cmdline', 'cwd', 'create_time']):
+        try:
+            if not is_userbot_cmdline(proc.info['cmdline']):
+                continue
+            name = by_dir.get(proc.info['cwd'])
+            if name:
+                found[name].append(proc)
+        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
+            continue
 
-        if process.returncode == 0:
-            await query.edit_message_text("✅ Зависимости установлены успешно!")
+    # Основной инстанс заодно обновляет запомненный PID
+    if found["main"]:
+        register_userbot_process(found["main"][0])
+    userbot_process["last_scan"] = time.time()
+    return found
+
+def get_fleet_status():
+    """Статус всех инстансов флота за один обход процессов"""
+    found = scan_fleet_processes()
+    now = time.time()
+    status = []
+    for name, instance in FLEET_INSTANCES.items():
+        procs = found[name]
+        if procs:
+            proc = procs[0]
+            status.append((instance, True, proc.pid, now - proc.info['create_time']))
         else:
-            error_output = "\n".join(output_lines[-10:])
-            await query.edit_message_text(f"❌ Ошибка установки:\n{error_output}")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
+            status.append((instance, False, None, None))
+    return status
 
-    await asyncio.sleep(2)
-    await show_management_menu(update, context)
-
-async def update_heroku_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обновление HerokuTL через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Эта функция доступна только владельцу", show_alert=True)
-        return
-
-    await query.edit_message_text("🔄 Обновляю HerokuTL...")
+async def drain_fleet_output(process, output):
+    """Вычитывает stdout инстанса флота в его кольцевой буфер"""
+    tail = b""
+    while True:
+        chunk = await process.stdout.read(OUTPUT_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()[-OUTPUT_MAX_LINE_LENGTH:]
+        output.extend(line.decode(errors='replace').rstrip("\r") for line in lines)
+    if tail:
+        output.append(tail.decode(errors='replace'))
+
+async def start_fleet_instance(bot, instance, processes):
+    """Запускает инстанс флота; возвращает (успех, описание)"""
+    if processes:
+        return True, f"уже запущен (PID {processes[0].pid})"
+
+    if instance["primary"]:
+        process = await spawn_userbot(bot, use_proxy=instance["use_proxy"])
+        is_ready, reason = await wait_userbot_ready(process)
+        return is_ready, f"PID {process.pid}" if is_ready else reason
+
+    state = get_fleet_state(instance["name"])
+    if not os.path.exists(instance["venv_python"]):
+        return False, "виртуальное окружение не найдено"
+
+    command = f"{instance['venv_python']} -m heroku --no-web"
+    if instance["use_proxy"]:
+        command = f"{PROXYCHAINS_PATH} {command}"
+
+    env = os.environ.copy()
+    env['GIT_PYTHON_REFRESH'] = 'quiet'
+
+    process = await asyncio.create_subprocess_shell(
+        f"exec {command}",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=instance["dir"],
+        env=env
+    )
+    state["process"] = process
+    asyncio.create_task(drain_fleet_output(process, state["output"]))
 
+    # Процесс, переживший STARTUP_GRACE секунд, считаем запущенным
     try:
-        cmd = f"{VENV_PYTHON} -m pip install heroku-tl-new -U"
-
-        # Устанавливаем правильные переменные окружения
-        env = os.environ.copy()
-        env['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:/home/alina/.venv/bin:/home/alina/.local/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            env=env
-        )
+        exit_code = await asyncio.wait_for(process.wait(), READINESS_CONFIG["STARTUP_GRACE"])
+        return False, f"завершился с кодом {exit_code}"
+    except asyncio.TimeoutError:
+        return True, f"PID {process.pid}"
 
-        output_lines = []
-        async for line in process.stdout:
-            line = line.decode().strip()
-            output_lines.append(line)
+async def stop_fleet_instance(instance, processes):
+    """Останавливает процессы инстанса: SIGTERM, затем SIGKILL по таймауту"""
+    if instance["primary"]:
+        release_userbot_supervisor()
+    if not processes:
+        return True, "не был запущен"
 
-        await process.wait()
+    for proc in processes:
+        try:
+            proc.terminate()
+        except psutil.NoSuchProcess:
+            pass
 
-        if process.returncode == 0:
-            await query.edit_message_text("✅ HerokuTL обновлен успешно!")
-        else:
-            error_output = "\n".join(output_lines[-10:])
-            await query.edit_message_text(f"❌ Ошибка обновления:\n{error_output}")
+    _, alive = await asyncio.to_thread(psutil.wait_procs, processes, timeout=FLEET_STOP_TIMEOUT)
+    for proc in alive:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
 
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
+    if instance["primary"]:
+        forget_userbot_process()
+    return True, "остановлен принудительно" if alive else "остановлен"
 
-    await asyncio.sleep(2)
-    await show_management_menu(update, context)
+async def run_fleet_action(bot, action, names=None):
+    """Параллельно выполняет start/stop/restart для выбранных инстансов флота"""
+    instances = [FLEET_INSTANCES[name] for name in (names or FLEET_INSTANCES) if name in FLEET_INSTANCES]
+    found = await asyncio.to_thread(scan_fleet_processes)
 
-async def debug_userbot_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Диагностика юзербота через кнопку"""
+    async def run_one(instance):
+        processes = found[instance["name"]]
+        try:
+            if action == "start":
+                return await start_fleet_instance(bot, instance, processes)
+            ok, text = await stop_fleet_instance(instance, processes)
+            if action == "stop":
+                return ok, text
+            return await start_fleet_instance(bot, instance, [])
+        except Exception as e:
+            return False, str(e)
+
+    results = await asyncio.gather(*(run_one(instance) for instance in instances))
+    return {instance["name"]: result for instance, result in zip(instances, results)}
+
+def format_fleet_status():
+    """Текст со статусом всех инстансов флота"""
+    status = get_fleet_status()
+    running = sum(1 for _, is_running, _, _ in status if is_running)
+    lines = [f"🚢 Флот юзерботов: {running}/{len(status)} запущено", ""]
+    for instance, is_running, pid, uptime in status:
+        proxy = " 🌐" if instance["use_proxy"] else ""
+        if is_running:
+            lines.append(f"🟢 {instance['name']}{proxy} - PID {pid}, аптайм {int(uptime // 3600)}ч {int((uptime % 3600) // 60)}м")
+        else:
+            lines.append(f"🔴 {instance['name']}{proxy} - остановлен")
+    return "\n".join(lines)
+
+def format_fleet_instance_output(name, lines=FLEET_VIEW_LINES):
+    """Последний вывод и хвост лог-файла инстанса флота"""
+    instance = FLEET_INSTANCES[name]
+    if instance["primary"]:
+        output = list(userbot_output_buffer)[-lines:]
+    else:
+        output = list(get_fleet_state(name)["output"])[-lines:]
+    log_tail = read_file_tail(instance["log_file"], lines)
+
+    parts = [f"📜 Инстанс {name} ({instance['dir']})"]
+    if output:
+        parts.append("Вывод процесса:\n" + "\n".join(line[:300] for line in output))
+    if log_tail:
+        parts.append(f"Лог {os.path.basename(instance['log_file'])}:\n" + "\n".join(line[:300] for line in log_tail))
+    if not output and not log_tail:
+        parts.append("Вывода и логов пока нет")
+    return "\n\n".join(parts)[-4000:]
+
+def format_fleet_results(action, results):
+    """Текст с результатами массового действия"""
+    titles = {"start": "Запуск", "stop": "Остановка", "restart": "Перезапуск"}
+    lines = [f"{titles[action]} флота:", ""]
+    for name, (ok, text) in results.items():
+        lines.append(f"{'✅' if ok else '❌'} {name}: {text}")
+    return "\n".join(lines)
+
+async def show_fleet_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text=None):
+    """Меню флота: статус всех инстансов и массовые действия"""
     query = update.callback_query
-    user_id = query.from_user.id
 
-    if not is_owner(user_id):
-        await query.answer("❌ Эта функция доступна только владельцу", show_alert=True)
+    if not is_owner(query.from_user.id):
+        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
         return
 
-    await query.edit_message_text("🐞 Выполняю диагностику...")
+    message = await asyncio.to_thread(format_fleet_status)
+    if text:
+        message = f"{text}\n\n{message}"
 
-    diagnostic_messages = []
+    keyboard = [
+        [
+            InlineKeyboardButton("▶️ Запустить все", callback_data="fleet_start"),
+            InlineKeyboardButton("⏹ Остановить все", callback_data="fleet_stop")
+        ],
+        [
+            InlineKeyboardButton("🔄 Перезапустить все", callback_data="fleet_restart"),
+            InlineKeyboardButton("🔃 Обновить", callback_data="fleet")
+        ]
+    ]
+    # Логи и вывод по каждому инстансу, по две кнопки в ряд
+    names = list(FLEET_INSTANCES)
+    for i in range(0, len(names), 2):
+        keyboard.append([
+            InlineKeyboardButton(f"📜 {name}", callback_data=f"fleet_logs_{name}") for name in names[i:i + 2]
+        ])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="management")])
+    await safe_edit_message(
+        context.bot, query.message.chat_id, query.message.message_id,
+        message[-4000:], reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    if os.path.exists(VENV_PYTHON):
-        diagnostic_messages.append("✅ Виртуальное окружение найдено")
-    else:
-        diagnostic_messages.append("❌ Виртуальное окружение не найдено")
+async def fleet_action_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, action):
+    """Массовый запуск/остановка/перезапуск из меню флота"""
+    query = update.callback_query
 
-    if os.path.exists(USERBOT_DIR):
-        diagnostic_messages.append("✅ Директория юзербота найдена")
-    else:
-        diagnostic_messages.append("❌ Директория юзербота не найдена")
+    if not is_owner(query.from_user.id):
+        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
+        return
 
-    is_running, start_time = get_userbot_status()
-    if is_running:
-        uptime = time.time() - start_time
-        diagnostic_messages.append(f"✅ Юзербот запущен (Uptime: {int(uptime // 60)}m {int(uptime % 60)}s)")
-    else:
-        diagnostic_messages.append("❌ Юзербот не запущен")
+    await query.edit_message_text("⏳ Выполняю действие для всех инстансов...")
+    results = await run_fleet_action(context.bot, action)
+    await show_fleet_menu(update, context, text=format_fleet_results(action, results))
 
-    log_file_path = os.path.join(USERBOT_DIR, LOG_FILE)
-    if os.path.exists(log_file_path):
-        file_size = os.path.getsize(log_file_path)
-        diagnostic_messages.append(f"✅ Файл логов существует ({file_size} bytes)")
-    else:
-        diagnostic_messages.append("❌ Файл логов не существует")
+async def show_fleet_logs(update: Update, context: ContextTypes.DEFAULT_TYPE, name):
+    """Вывод и лог одного инстанса флота (fleet_logs_<имя>)"""
+    query = update.callback_query
+    if name not in FLEET_INSTANCES:
+        await show_fleet_menu(update, context, text=f"❌ Неизвестный инстанс: {name}")
+        return
 
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="management")]]
-    await query.edit_message_text("\n".join(diagnostic_messages), reply_markup=InlineKeyboardMarkup(keyboard))
+    text = await asyncio.to_thread(format_fleet_instance_output, name)
+    keyboard = [
+        [
+            InlineKeyboardButton("🔃 Обновить", callback_data=f"fleet_logs_{name}"),
+            InlineKeyboardButton("⬅️ Назад", callback_data="fleet")
+        ]
+    ]
+    await safe_edit_message(
+        context.bot, query.message.chat_id, query.message.message_id,
+        text, reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-# Обработчики кнопок
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
-    query = update.callback_query
-    await query.answer()
+async def fleet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/fleet [start|stop|restart|logs] [имя ...] - статус и управление флотом"""
+    if not is_owner(update.effective_user.id):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
 
-    user_id = query.from_user.id
-    if not is_user(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
+    if not context.args:
+        await update.message.reply_text(await asyncio.to_thread(format_fleet_status))
         return
 
-    data = query.data
+    action = context.args[0].lower()
+    if action == "logs":
+        if len(context.args) != 2 or context.args[1] not in FLEET_INSTANCES:
+            await update.message.reply_text("Использование: /fleet logs <имя>")
+            return
+        await update.message.reply_text(await asyncio.to_thread(format_fleet_instance_output, context.args[1]))
+        return
 
-    # Основное меню
-    if data == "main_menu":
-        await show_main_menu(update, context)
+    if action not in ("start", "stop", "restart"):
+        await update.message.reply_text("Использование: /fleet [start|stop|restart|logs] [имя ...]")
+        return
 
-    # Статус и информация
-    elif data == "status":
-        is_running, start_time = get_userbot_status()
-        status_text = "✅ Запущен" if is_running else "❌ Остановлен"
-        if is_running:
-            uptime = time.time() - start_time
-            status_text += f"\n⏱ Uptime: {int(uptime // 3600)}h {int((uptime % 3600) // 60)}m"
+    names = context.args[1:] or None
+    unknown = [name for name in names or [] if name not in FLEET_INSTANCES]
+    if unknown:
+        await update.message.reply_text(f"❌ Неизвестные инстансы: {', '.join(unknown)}")
+        return
 
-        keyboard = [[InlineKeyboardButton("🔄 Обновить", callback_data="status"), InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]]
-        await query.edit_message_text(f"📊 **Статус юзербота:**\n\n{status_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await update.message.reply_text("⏳ Выполняю...")
+    results = await run_fleet_action(context.bot, action, names)
+    await update.message.reply_text(format_fleet_results(action, results))
 
-    elif data.startswith("del_user_"):
+# Производительность: задержка event loop и медленные обработчики
+async def loop_lag_probe():
+    """Измеряет, насколько позже запланированного просыпается event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        interval = PERFORMANCE_CONFIG["LOOP_LAG_INTERVAL"]
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - started - interval, 0.0)
+        loop_lag_samples.append(lag)
+        loop_lag_stats["last"] = lag
+        loop_lag_stats["max"] = max(loop_lag_stats["max"], lag)
+
+async def start_loop_lag_probe():
+    """Запускает измерение задержки event loop"""
+    global loop_lag_task
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.create_task(loop_lag_probe())
+
+async def stop_loop_lag_probe():
+    """Останавливает измерение задержки event loop"""
+    global loop_lag_task
+    if loop_lag_task:
+        loop_lag_task.cancel()
+        loop_lag_task = None
+
+@types.coroutine
+def run_with_step_timing(coro, timing):
+    """Выполняет корутину, суммируя время ее синхронных шагов в timing["blocked"]
+
+    Каждый шаг между await - это время, когда event loop занят только этим обработчиком.
+    """
+    value, error = None, None
+    while True:
+        started = time.perf_counter()
         try:
-            user_id = int(data.split("_")[2])
-            if user_id in USER_IDS and user_id != OWNER_ID:
-              USER_IDS.remove(user_id)
-              save_users(USER_IDS)
-              await query.edit_message_text(f"✅ Пользователь {user_id} удален")
-              await asyncio.sleep(2)
-              await show_users_menu(update, context)
+            if error is not None:
+                yielded = coro.throw(error)
             else:
-              await query.edit_message_text("❌ Нельзя удалить этого пользователя")
-        except (ValueError, IndexError):
-            await query.edit_message_text("❌ Ошибка удаление пользователя")
+                yielded = coro.send(value)
+        except StopIteration as stop:
+            timing["blocked"] += time.perf_counter() - started
+            return stop.value
+        except BaseException:
+            timing["blocked"] += time.perf_counter() - started
+            raise
+        timing["blocked"] += time.perf_counter() - started
 
-    elif data == "system_info":
-        info = get_system_info()
-        keyboard = [[InlineKeyboardButton("🔄 Обновить", callback_data="system_info"), InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]]
-        await query.edit_message_text(f"🖥 **Информация о системе:**\n\n{info}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        value, error = None, None
+        try:
+            value = yield yielded
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            error = e
+
+def get_handler_key(update, func):
+    """Имя обработчика для статистики: callback_data, команда или имя функции"""
+    if update and update.callback_query and update.callback_query.data:
+        action, _, _ = resolve_callback(update.callback_query.data)
+        return action or update.callback_query.data
+    if update and update.message and update.message.text and update.message.text.startswith("/"):
+        return update.message.text.split()[0].split("@")[0]
+    return func.__name__
+
+def record_handler_timing(key, wall, blocked):
+    """Обновляет статистику обработчика"""
+    stats = handler_stats.get(key)
+    if stats is None:
+        stats = handler_stats[key] = {
+            "count": 0,
+            "wall_total": 0.0,
+            "wall_max": 0.0,
+            "blocked_total": 0.0,
+            "blocked_max": 0.0,
+            "buckets": [0] * len(HANDLER_LATENCY_BUCKETS)
+        }
+    stats["count"] += 1
+    for index, bound in enumerate(HANDLER_LATENCY_BUCKETS):
+        if wall <= bound:
+            stats["buckets"][index] += 1
+            break
+    stats["wall_total"] += wall
+    stats["wall_max"] = max(stats["wall_max"], wall)
+    stats["blocked_total"] += blocked
+    stats["blocked_max"] = max(stats["blocked_max"], blocked)
+
+    if blocked * 1000 >= PERFORMANCE_CONFIG["SLOW_HANDLER_MS"]:
+        print(f"⏱ Обработчик {key} заблокировал event loop на {blocked * 1000:.0f} мс (всего {wall * 1000:.0f} мс)")
+
+def timed_handler(func):
+    """Оборачивает обработчик: замеряет общее время и время блокировки loop"""
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        key = get_handler_key(update, func)
+        timing = {"blocked": 0.0}
+        started = time.perf_counter()
+        try:
+            return await run_with_step_timing(func(update, context), timing)
+        finally:
+            record_handler_timing(key, time.perf_counter() - started, timing["blocked"])
+    return wrapper
 
-    # Управление юзерботом
-    elif data == "start_userbot":
-        await start_userbot_callback(update, context)
+async def show_performance_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Меню производительности (только для владельца)"""
+    query = update.callback_query
+    if not is_owner(query.from_user.id):
+        await query.answer("❌ Только для владельца", show_alert=True)
+        return
 
-    elif data == "start_proxy":
-        await start_userbot_proxy_callback(update, context)
+    samples = list(loop_lag_samples)
+    lag_avg = sum(samples) / len(samples) * 1000 if samples else 0
+    lag_p_max = max(samples) * 1000 if samples else 0
+
+    lines = [
+        "⏱ Производительность",
+        "",
+        "🔁 Задержка event loop:",
+        f"• Сейчас: {loop_lag_stats['last'] * 1000:.1f} мс",
+        f"• Среднее ({len(samples)} замеров): {lag_avg:.1f} мс",
+        f"• Максимум за окно: {lag_p_max:.1f} мс",
+        f"• Максимум с запуска: {loop_lag_stats['max'] * 1000:.1f} мс",
+        "",
+        f"🐢 Самые медленные обработчики (порог {PERFORMANCE_CONFIG['SLOW_HANDLER_MS']} мс):"
+    ]
 
-    elif data == "stop_userbot":
-        await stop_userbot_callback(update, context)
+    slowest = sorted(handler_stats.items(), key=lambda item: item[1]["blocked_max"], reverse=True)[:10]
+    if not slowest:
+        lines.append("• Пока нет данных")
+    for key, stats in slowest:
+        mark = "🔴" if stats["blocked_max"] * 1000 >= PERFORMANCE_CONFIG["SLOW_HANDLER_MS"] else "🟢"
+        lines.append(
+            f"{mark} {key} ×{stats['count']}: "
+            f"блок. ср. {stats['blocked_total'] / stats['count'] * 1000:.0f}/макс {stats['blocked_max'] * 1000:.0f} мс, "
+            f"всего ср. {stats['wall_total'] / stats['count'] * 1000:.0f}/макс {stats['wall_max'] * 1000:.0f} мс"
+        )
 
-    elif data == "management":
-        await show_management_menu(update, context)
+    lines.append("")
+    lines.append("🧭 Частые маршруты:")
+    busiest = sorted(route_dispatch_counts.items(), key=lambda item: item[1], reverse=True)[:10]
+    if not busiest:
+        lines.append("• Пока нет данных")
+    for action, count in busiest:
+        lines.append(f"• {action}: {count}")
 
-    elif data == "delete_user":
-      await delete_user_callback(update, context)
+    keyboard = [
+        [
+            InlineKeyboardButton("🔄 Обновить", callback_data="performance"),
+            InlineKeyboardButton("🧹 Сбросить", callback_data="performance_reset")
+        ],
+        [
+            InlineKeyboardButton("⬅️ Назад", callback_data="settings")
+        ]
+    ]
 
-    elif data == "install_requirements":
-        await install_requirements_callback(update, context)
+    await safe_edit_message(
+        context.bot, query.message.chat_id, query.message.message_id,
+        "\n".join(lines)[:4000], reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    elif data == "update_heroku":
-        await update_heroku_callback(update, context)
+async def reset_performance_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сбрасывает статистику производительности"""
+    if not is_owner(update.callback_query.from_user.id):
+        await update.callback_query.answer("❌ Только для владельца", show_alert=True)
+        return
 
-    elif data == "debug_userbot":
-        await debug_userbot_callback(update, context)
+    handler_stats.clear()
+    route_dispatch_counts.clear()
+    loop_lag_samples.clear()
+    loop_lag_stats["max"] = 0.0
+    await show_performance_menu(update, context)
+
+# Экспорт метрик для Prometheus (OpenMetrics)
+def escape_label_value(value):
+    """Экранирует значение метки OpenMetrics"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render_openmetrics():
+    """Формирует ответ OpenMetrics из уже собранных данных (без обращения к psutil)"""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"# HELP {name} {help_text}")
+        for suffix, labels, value in samples:
+            label_text = ""
+            if labels:
+                label_text = "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in labels.items()) + "}"
+            lines.append(f"{name}{suffix}{label_text} {value}")
+
+    metrics = metrics_snapshot
+    if metrics:
+        metric("status_heroku_cpu_usage_percent", "gauge", "Host CPU usage.", [("", None, metrics["cpu"])])
+        metric("status_heroku_memory_usage_percent", "gauge", "Host RAM usage.", [("", None, metrics["ram_percent"])])
+        metric("status_heroku_memory_used_bytes", "gauge", "Host RAM used.", [("", None, metrics["ram_used_bytes"])])
+        metric("status_heroku_memory_total_bytes", "gauge", "Host RAM total.", [("", None, metrics["ram_total_bytes"])])
+        metric("status_heroku_disk_usage_percent", "gauge", "Root filesystem usage.", [("", None, metrics["disk_percent"])])
+        metric("status_heroku_disk_used_bytes", "gauge", "Root filesystem used.", [("", None, metrics["disk_used_bytes"])])
+        metric("status_heroku_disk_total_bytes", "gauge", "Root filesystem size.", [("", None, metrics["disk_total_bytes"])])
+        if "userbot_disk_percent" in metrics:
+            metric("status_heroku_userbot_disk_usage_percent", "gauge", "Usage of the filesystem holding USERBOT_DIR.", [("", None, metrics["userbot_disk_percent"])])
+        metric("status_heroku_network_sent_bytes", "counter", "Bytes sent by the host.", [("_total", None, metrics["net_sent_bytes"])])
+        metric("status_heroku_network_received_bytes", "counter", "Bytes received by the host.", [("_total", None, metrics["net_recv_bytes"])])
+        if isinstance(metrics["cpu_temp"], (int, float)):
+            metric("status_heroku_cpu_temperature_celsius", "gauge", "CPU temperature.", [("", None, metrics["cpu_temp"])])
+        metric("status_heroku_metrics_sample_timestamp_seconds", "gauge", "Time of the last host sample.", [("", None, metrics["timestamp"])])
+
+    is_running, userbot_started = get_userbot_status()
+    metric("status_heroku_userbot_up", "gauge", "Whether the userbot process is running.", [("", None, 1 if is_running else 0)])
+    tree = userbot_tree_stats
+    if tree:
+        metric("status_heroku_userbot_processes", "gauge", "Processes in the userbot tree.", [("", None, tree["processes"])])
+        metric("status_heroku_userbot_cpu_percent", "gauge", "CPU usage of the userbot tree (100 = one core).", [("", None, tree["cpu"])])
+        metric("status_heroku_userbot_rss_bytes", "gauge", "Resident memory of the userbot tree.", [("", None, tree["rss"])])
+        if tree["uss"] is not None:
+            metric("status_heroku_userbot_uss_bytes", "gauge", "Unique memory of the userbot tree.", [("", None, tree["uss"])])
+        metric("status_heroku_userbot_threads", "gauge", "Threads in the userbot tree.", [("", None, tree["threads"])])
+        metric("status_heroku_userbot_open_fds", "gauge", "Open file descriptors in the userbot tree.", [("", None, tree["fds"])])
+        # Сумма по живым процессам - при выходе дочернего процесса может уменьшиться, поэтому gauge
+        metric("status_heroku_userbot_io_read_bytes", "gauge", "Bytes read by live userbot processes.", [("", None, tree["read_bytes"])])
+        metric("status_heroku_userbot_io_written_bytes", "gauge", "Bytes written by live userbot processes.", [("", None, tree["write_bytes"])])
+    trend = leak_state["trend"]
+    if trend:
+        metric("status_heroku_userbot_rss_growth_bytes_per_second", "gauge", "Fitted userbot RSS growth.", [("", None, round(trend["growth_mb_per_hour"] * 1024 * 1024 / 3600, 3))])
+        if trend["leaking"]:
+            metric("status_heroku_userbot_memory_exhaustion_seconds", "gauge", "Projected time until the userbot hits its memory limit.", [("", None, round(trend["hours_left"] * 3600))])
+    if disk_index["updated"]:
+        metric("status_heroku_userbot_dir_size_bytes", "gauge", "Total size of files under USERBOT_DIR.", [("", None, disk_index["total"])])
+        metric("status_heroku_userbot_dir_files", "gauge", "Files under USERBOT_DIR.", [("", None, disk_index["files"])])
+    if is_running:
+        metric("status_heroku_userbot_uptime_seconds", "gauge", "Userbot process uptime.", [("", None, round(time.time() - userbot_started, 3))])
+    metric("status_heroku_userbot_restarts", "counter", "Userbot restarts performed by the supervisor.", [("_total", None, userbot_supervisor["total_restarts"])])
+    metric("status_heroku_userbot_start_failures", "counter", "Userbot starts that never became ready.", [("_total", None, userbot_start_stats["failures"])])
+    if userbot_start_stats["last_ready_seconds"] is not None:
+        metric("status_heroku_userbot_ready_seconds", "gauge", "Time from the last launch until the userbot was ready.", [("", None, round(userbot_start_stats["last_ready_seconds"], 3))])
+    if userbot_start_stats["last_restart_seconds"] is not None:
+        metric("status_heroku_userbot_restart_seconds", "gauge", "Time from the last restart request or crash until the userbot was ready.", [("", None, round(userbot_start_stats["last_restart_seconds"], 3))])
+
+    metric("status_heroku_bot_uptime_seconds", "gauge", "Monitor bot uptime.", [("", None, round(time.time() - start_time, 3))])
+    metric("status_heroku_reconnect_attempts", "gauge", "Current Telegram reconnect attempts.", [("", None, reconnect_attempts)])
+    if api_response_time_last is not None:
+        metric("status_heroku_telegram_api_response_seconds", "gauge", "Last measured Telegram API response time.", [("", None, round(api_response_time_last, 6))])
+
+    metric("status_heroku_alerts", "counter", "Alerts sent, by type.", [
+        ("_total", {"type": alert_type}, count) for alert_type, count in alert_counts.items()
+    ])
+    metric("status_heroku_alert_firing", "gauge", "Whether an alert rule is currently firing.", [
+        ("", {"rule": name}, int(alert_states.get(name, {}).get("state") == "firing")) for name in alert_rules
+    ])
+
+    metric("status_heroku_route_dispatches", "counter", "Button and command dispatches, by route.", [
+        ("_total", {"route": action}, count) for action, count in sorted(route_dispatch_counts.items())
+    ])
+
+    metric("status_heroku_event_loop_lag_seconds", "gauge", "Last measured event loop lag.", [("", None, round(loop_lag_stats["last"], 6))])
+
+    histogram = []
+    for key, stats in sorted(handler_stats.items()):
+        cumulative = 0
+        for bound, count in zip(HANDLER_LATENCY_BUCKETS, stats["buckets"]):
+            cumulative += count
+            histogram.append(("_bucket", {"handler": key, "le": bound}, cumulative))
+        histogram.append(("_bucket", {"handler": key, "le": "+Inf"}, stats["count"]))
+        histogram.append(("_count", {"handler": key}, stats["count"]))
+        histogram.append(("_sum", {"handler": key}, round(stats["wall_total"], 6)))
+    metric("status_heroku_handler_duration_seconds", "histogram", "Handler wall time.", histogram)
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+async def metrics_endpoint(request):
+    """GET /metrics"""
+    now = time.time()
+    if exporter_cache["body"] is None or now - exporter_cache["rendered"] >= METRICS_EXPORTER_CONFIG["CACHE_TTL"]:
+        exporter_cache["body"] = render_openmetrics()
+        exporter_cache["rendered"] = now
+
+    return web.Response(
+        body=exporter_cache["body"].encode(),
+        headers={"Content-Type": "application/openmetrics-text; version=1.0.0; charset=utf-8"}
+    )
 
-    # Логи
-    elif data == "logs_menu":
-        await show_logs_menu(update, context)
+async def start_metrics_exporter():
+    """Запускает локальный HTTP-эндпоинт /metrics"""
+    global exporter_runner
+    if not METRICS_EXPORTER_CONFIG["ENABLED"]:
+        return
 
-    elif data.startswith("logs_"):
-        level = data.split("_")[1]
-        await send_logs_callback(update, context, level)
+    try:
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_endpoint)
+        exporter_runner = web.AppRunner(app, access_log=None)
+        await exporter_runner.setup()
+        site = web.TCPSite(exporter_runner, METRICS_EXPORTER_CONFIG["HOST"], METRICS_EXPORTER_CONFIG["PORT"])
+        await site.start()
+        print(f"📈 Экспорт метрик: http://{METRICS_EXPORTER_CONFIG['HOST']}:{METRICS_EXPORTER_CONFIG['PORT']}/metrics")
+    except Exception as e:
+        print(f"❌ Не удалось запустить экспорт метрик: {e}")
+        exporter_runner = None
 
-    elif data == "open_logs_dir":
-        await open_logs_dir_callback(update, context)
+async def stop_metrics_exporter():
+    """Останавливает эндпоинт /metrics"""
+    global exporter_runner
+    if exporter_runner:
+        await exporter_runner.cleanup()
+        exporter_runner = None
 
+# Обработчики кнопок
+def resolve_callback(data):
+    """Находит действие по callback_data: (имя действия, обработчик, аргументы)"""
+    action = CALLBACK_ACTIONS.get(data)
+    if action:
+        return f"callback:{data}", action[0], ()
+
+    # Самый длинный подходящий префикс: проход по дереву не дольше длины префикса
+    node, match = PREFIX_TRIE, None
+    for char in data:
+        node = node.get(char)
+        if node is None:
+            break
+        match = node.get(None, match)
 
-    elif data == "monitoring_status":
-        await monitoring_status(update, context)
-    elif data == "test_alert":
-        await test_alert(update, context)
-    elif data == "load_graph":
-        await show_load_graph(update, context)
-    elif data == "monitoring_settings":
-        await monitoring_settings(update, context)
+    if match:
+        prefix, handler = match
+        return f"callback:{prefix}*", handler, (data[len(prefix):],)
+    return None, None, ()
 
-    elif data == "scheduler_status":
-        await scheduler_status(update, context)
-    elif data == "scheduler_settings":
-        await scheduler_settings(update, context)
-    elif data == "generate_report":
-        await generate_report(update, context)
-    elif data == "toggle_auto_restart":
-        await toggle_auto_restart(update, context)
-    elif data == "toggle_scheduler":
-        await toggle_scheduler(update, context)
-    elif data == "set_report_time":
-        await set_report_time(update, context)
-    elif data == "set_restart_time":
-        await set_restart_time(update, context)
-    elif data == "set_clean_days":
-        await set_clean_days(update, context)
-    elif data == "set_timezone":
-        await set_timezone(update, context)
-    elif data == "apply_scheduler_settings":
-        await apply_scheduler_settings(update, context)
-    elif data == "save_scheduler_config":
-        await save_scheduler_config(update, context)
-
-    # Обработка конкретных значений времени
-    elif data.startswith("set_time_") or data.startswith("set_restart_") or \
-         data.startswith("set_logs_") or data.startswith("set_tz_"):
-        await handle_time_setting(update, context)
-
-    elif data == "connection_status":
-        await connection_status(update, context)
-
-    elif data == "updates_menu":
-        await show_updates_menu(update, context)
-
-    elif data == "check_updates":
-        await check_updates_callback(update, context)
-
-    elif data == "update_bot":
-        await update_bot_callback(update, context)
-
-    elif data == "detailed_info":
-        await detailed_info_callback(update, context)
-
-    elif data == "about_bot":
-        await about_bot(update, context)
-
-    elif data == "settings":
-        await show_settings_menu(update, context)
-
-    elif data == "toggle_debug":
-        await toggle_debug_callback(update, context)
-
-    elif data == "terminal_menu":
-        await show_terminal_menu(update, context)
-
-    elif data.startswith("terminal_"):
-        command = data.split("_")[1]
-        await execute_terminal_command(update, context, command)
-
-    elif data == "ping_menu":
-        await show_ping_menu(update, context)
-
-    elif data.startswith("ping_"):
-        host = data.split("_")[1]
-        await ping_host_callback(update, context, host)
-
-    elif data == "users_menu":
-        await show_users_menu(update, context)
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий на кнопки: поиск в таблице действий и проверка роли"""
+    query = update.callback_query
+    action, handler, args = resolve_callback(query.data or "")
 
-    elif data == "add_me":
-        await add_me_callback(update, context)
+    if handler is None:
+        count_dispatch("callback:unrouted")
+        await query.answer()
+        return
 
-    elif data == "list_users":
-        await list_users_callback(update, context)
+    if not can_run_action(query.from_user.id, action):
+        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
+        return
 
-    # Помощь
-    elif data == "help":
-        await show_help(update, context)
+    count_dispatch(action)
+    await query.answer()
+    await handler(update, context, *args)
 
 # Функции-обработчики для кнопок
 async def start_userbot_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2541,351 +5167,68 @@ async def start_userbot_callback(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     try:
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
+        process = await spawn_userbot(context.bot)
 
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(5)
-
-        is_running, _ = get_userbot_status()
-        if is_running:
-            await query.edit_message_text("✅ Юзербот успешно запущен!")
-
-            global monitor_task
-            if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
-        else:
-            await query.edit_message_text("❌ Не удалось запустить юзербота. Проверьте логи.")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка запуска: {str(e)}")
-
-    await asyncio.sleep(2)
-    await show_main_menu(update, context)
-
-async def start_userbot_proxy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Запуск юзербота с прокси через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-
-    await query.edit_message_text("🔄 Запускаю юзербота с прокси...")
-
-    if not os.path.exists(PROXYCHAINS_PATH):
-        await query.edit_message_text(f"❌ proxychains не найден по пути {PROXYCHAINS_PATH}")
-        await show_main_menu(update, context)
-        return
-
-    is_running, _ = get_userbot_status()
-    if is_running:
-        await query.edit_message_text("⚠️ Юзербот уже запущен")
-        await show_main_menu(update, context)
-        return
-
-    try:
-        cmd = f"cd {USERBOT_DIR} && {PROXY_CMD}"
-
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(5)
-
-        is_running, _ = get_userbot_status()
-        if is_running:
-            await query.edit_message_text("✅ Юзербот успешно запущен с прокси!")
-
-            global monitor_task
-            if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
-        else:
-            await query.edit_message_text("❌ Не удалось запустить юзербота с прокси. Проверьте логи.")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка запуска: {str(e)}")
-
-    await asyncio.sleep(2)
-    await show_main_menu(update, context)
-
-
-
-
-async def handle_chosen_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает выбранные инлайн-результаты"""
-    chosen_result = update.chosen_inline_result
-    result_id = chosen_result.result_id
-    user_id = chosen_result.from_user.id
-
-    if not is_owner(user_id):
-        return
-
-    try:
-        # Запуск юзербота
-        if result_id == "start_userbot":
-            await execute_inline_start_userbot(chosen_result, context)
-
-        # Остановка юзербота
-        elif result_id == "stop_userbot":
-            await execute_inline_stop_userbot(chosen_result, context)
-
-        # Перезапуск юзербота
-        elif result_id == "restart_userbot":
-            await execute_inline_restart_userbot(chosen_result, context)
-
-    except Exception as e:
-        print(f"Ошибка в handle_chosen_inline: {e}")
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"❌ Ошибка при выполнении инлайн-команды: {str(e)}"
-            )
-        except:
-            pass
-
-async def execute_inline_start_userbot(chosen_result, context):
-    """Выполняет запуск юзербота из инлайн-режима"""
-    user_id = chosen_result.from_user.id
-
-    # Отправляем уведомление о начале операции
-    await context.bot.send_message(
-        chat_id=user_id,
-        text="🔄 Запускаю юзербота через инлайн-режим..."
-    )
-
-    # Проверяем, не запущен ли уже юзербот
-    is_running, _ = get_userbot_status()
-    if is_running:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="⚠️ Юзербот уже запущен"
-        )
-        return
-
-    try:
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
-
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(5)
-
-        is_running, _ = get_userbot_status()
+        is_running, ready_reason = await wait_userbot_ready(process)
         if is_running:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Юзербот успешно запущен через инлайн-режим!"
-            )
-
-            global monitor_task
-            if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
-        else:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="❌ Не удалось запустить юзербота через инлайн-режим. Проверьте логи."
-            )
-
-    except Exception as e:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"❌ Ошибка запуска через инлайн-режим: {str(e)}"
-        )
-
-async def execute_inline_stop_userbot(chosen_result, context):
-    """Выполняет остановку юзербота из инлайн-режима"""
-    user_id = chosen_result.from_user.id
-
-    await context.bot.send_message(
-        chat_id=user_id,
-        text="🛑 Останавливаю юзербота через инлайн-режим..."
-    )
-
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-            continue
-
-    if not processes:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="⚠️ Юзербот не был запущен"
-        )
-        return
-
-    for proc in processes:
-        try:
-            proc.terminate()
-        except:
-            pass
-
-    timeout = 15
-    start_time = time.time()
-
-    while time.time() - start_time < timeout:
-        await asyncio.sleep(2)
-        still_running = []
-        for proc in processes:
-            try:
-                if proc.is_running():
-                    still_running.append(proc)
-            except:
-                pass
-
-        if not still_running:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Юзербот корректно остановлен через инлайн-режим"
-            )
-            return
-
-        processes = still_running
-
-    for proc in processes:
-        try:
-            proc.kill()
-        except:
-            pass
-
-    await context.bot.send_message(
-        chat_id=user_id,
-        text="✅ Юзербот остановлен (принудительно) через инлайн-режим"
-    )
-
-async def execute_inline_restart_userbot(chosen_result, context):
-    """Выполняет перезапуск юзербота из инлайн-режима"""
-    user_id = chosen_result.from_user.id
-
-    await context.bot.send_message(
-        chat_id=user_id,
-        text="🔄 Перезапускаю юзербота через инлайн-режим..."
-    )
-
-    # Сначала останавливаем
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-            continue
-
-    if processes:
-        for proc in processes:
-            try:
-                proc.terminate()
-            except:
-                pass
+            await query.edit_message_text("✅ Юзербот успешно запущен!")
 
-        # Ждем завершения
-        timeout = 10
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            await asyncio.sleep(2)
-            still_running = []
-            for proc in processes:
-                try:
-                    if proc.is_running():
-                        still_running.append(proc)
-                except:
-                    pass
+            global log_follow_task
+            if DEBUG_CHATS:
+                if log_follow_task:
+                    log_follow_task.cancel()
+                log_follow_task = asyncio.create_task(monitor_userbot_logs(context.bot))
+        else:
+            await query.edit_message_text(f"❌ Не удалось запустить юзербота.\n\n{format_startup_failure(ready_reason)}")
 
-            if not still_running:
-                break
+    except Exception as e:
+        await query.edit_message_text(f"❌ Ошибка запуска: {str(e)}")
 
-            processes = still_running
+    await asyncio.sleep(2)
+    await show_main_menu(update, context)
 
-        # Если процессы все еще работают, убиваем принудительно
-        for proc in processes:
-            try:
-                proc.kill()
-            except:
-                pass
+async def start_userbot_proxy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запуск юзербота с прокси через кнопку"""
+    query = update.callback_query
+    user_id = query.from_user.id
 
-    # Запускаем заново
-    try:
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
+    if not is_owner(user_id):
+        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
+        return
 
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
+    await query.edit_message_text("🔄 Запускаю юзербота с прокси...")
 
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
+    if not os.path.exists(PROXYCHAINS_PATH):
+        await query.edit_message_text(f"❌ proxychains не найден по пути {PROXYCHAINS_PATH}")
+        await show_main_menu(update, context)
+        return
 
-        await asyncio.sleep(5)
+    is_running, _ = get_userbot_status()
+    if is_running:
+        await query.edit_message_text("⚠️ Юзербот уже запущен")
+        await show_main_menu(update, context)
+        return
 
-        is_running, _ = get_userbot_status()
+    try:
+        process = await spawn_userbot(context.bot, use_proxy=True)
+
+        is_running, ready_reason = await wait_userbot_ready(process)
         if is_running:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Юзербот успешно перезапущен через инлайн-режим!"
-            )
+            await query.edit_message_text("✅ Юзербот успешно запущен с прокси!")
 
-            global monitor_task
+            global log_follow_task
             if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
+                if log_follow_task:
+                    log_follow_task.cancel()
+                log_follow_task = asyncio.create_task(monitor_userbot_logs(context.bot))
         else:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="❌ Не удалось перезапустить юзербота через инлайн-режим. Проверьте логи."
-            )
+            await query.edit_message_text(f"❌ Не удалось запустить юзербота с прокси.\n\n{format_startup_failure(ready_reason)}")
 
     except Exception as e:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"❌ Ошибка перезапуска через инлайн-режим: {str(e)}"
-        )
+        await query.edit_message_text(f"❌ Ошибка запуска: {str(e)}")
 
+    await asyncio.sleep(2)
+    await show_main_menu(update, context)
 
 
 
@@ -2900,15 +5243,8 @@ async def stop_userbot_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return
     await query.edit_message_text("🛑 Останавливаю юзербота...")
 
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-            continue
+    release_userbot_supervisor()
+    processes = get_userbot_processes()
 
     if not processes:
         await query.edit_message_text("⚠️ Юзербот не был запущен")
@@ -2952,84 +5288,6 @@ async def stop_userbot_callback(update: Update, context: ContextTypes.DEFAULT_TY
     await asyncio.sleep(2)
     await show_main_menu(update, context)
 
-async def install_requirements_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Установка зависимостей через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-    await query.edit_message_text("📦 Устанавливаю зависимости...")
-
-    try:
-        cmd = f"cd {USERBOT_DIR} && {VENV_PYTHON} -m pip install -r requirements.txt"
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR
-        )
-
-        output_lines = []
-        async for line in process.stdout:
-            line = line.decode().strip()
-            output_lines.append(line)
-
-        await process.wait()
-
-        if process.returncode == 0:
-            await query.edit_message_text("✅ Зависимости установлены успешно!")
-        else:
-            error_output = "\n".join(output_lines[-10:])
-            await query.edit_message_text(f"❌ Ошибка установки:\n{error_output}")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
-
-    await asyncio.sleep(2)
-    await show_management_menu(update, context)
-
-async def update_heroku_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обновление HerokuTL через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-
-    await query.edit_message_text("🔄 Обновляю HerokuTL...")
-
-    try:
-        cmd = f"{VENV_PYTHON} -m pip install heroku-tl-new -U"
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT
-        )
-
-        output_lines = []
-        async for line in process.stdout:
-            line = line.decode().strip()
-            output_lines.append(line)
-
-        await process.wait()
-
-        if process.returncode == 0:
-            await query.edit_message_text("✅ HerokuTL обновлен успешно!")
-        else:
-            error_output = "\n".join(output_lines[-10:])
-            await query.edit_message_text(f"❌ Ошибка обновления:\n{error_output}")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
-
-    await asyncio.sleep(2)
-    await show_management_menu(update, context)
-
 async def debug_userbot_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Диагностика юзербота через кнопку"""
     query = update.callback_query
@@ -3070,15 +5328,120 @@ async def debug_userbot_callback(update: Update, context: ContextTypes.DEFAULT_T
     keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="management")]]
     await query.edit_message_text("\n".join(diagnostic_messages), reply_markup=InlineKeyboardMarkup(keyboard))
 
+# Экспорт логов
+LOG_LEVELS = ["ALL", "WARNING", "INFO", "ERROR", "DEBUG"]
+LOG_LEVEL_PATTERNS = {
+    level: re.compile(rb'\b' + level.encode() + rb'\b', re.IGNORECASE)
+    for level in LOG_LEVELS if level != "ALL"
+}
+LOG_EXPORT_CHUNK_SIZE = 1024 * 1024
+
+def export_logs_to_files(level, compress=False):
+    """Потоково выгружает логи в файлы размером не больше лимита Telegram
+
+    Выполняется в отдельном потоке, возвращает список путей к частям.
+    """
+    pattern = LOG_LEVEL_PATTERNS.get(level)
+    max_part_size = int(LOG_EXPORT_CONFIG.get("MAX_PART_SIZE_MB", 45) * 1024 * 1024)
+    suffix = ".txt.gz" if compress else ".txt"
+
+    parts = []
+    state = {"file": None, "written": 0}
+
+    def close_part():
+        if state["file"]:
+            state["file"].close()
+            if state["raw"] is not state["file"]:
+                state["raw"].close()
+            state["file"] = None
+
+    def open_part():
+        close_part()
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        parts.append(path)
+        raw = os.fdopen(fd, 'wb')
+        state["file"] = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) if compress else raw
+        state["raw"] = raw
+        state["written"] = 0
+
+    def write(data):
+        while data:
+            if state["file"] is None:
+                open_part()
+            room = max_part_size - state["written"]
+            if len(data) <= room:
+                state["file"].write(data)
+                state["written"] += len(data)
+                return
+
+            # Стараемся резать часть по границе строки
+            cut = data.rfind(b'\n', 0, room) + 1
+            if cut == 0 and state["written"] == 0:
+                cut = room
+            if cut:
+                state["file"].write(data[:cut])
+                data = data[cut:]
+            open_part()
+
+    completed = False
+    try:
+        with open(LOG_FILE, 'rb') as log_file:
+            if pattern is None:
+                for chunk in iter(lambda: log_file.read(LOG_EXPORT_CHUNK_SIZE), b''):
+                    write(chunk)
+            else:
+                for line in log_file:
+                    if pattern.search(line):
+                        write(line)
+        completed = True
+    finally:
+        close_part()
+        if not completed:
+            # Выгрузка оборвалась - недописанные части никто не отправит и не удалит
+            for path in parts:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    return parts
+
+async def send_logs_export(bot, chat_id, level):
+    """Отправляет логи документами, возвращает количество отправленных частей"""
+    compress = LOG_EXPORT_CONFIG.get("COMPRESS", False)
+    parts = await asyncio.to_thread(export_logs_to_files, level, compress)
+
+    try:
+        if not parts:
+            return 0
+
+        extension = "txt.gz" if compress else "txt"
+        for number, path in enumerate(parts, 1):
+            if len(parts) > 1:
+                filename = f"logs-{level}-part{number}.{extension}"
+                caption = f"Логи уровня: {level} (часть {number}/{len(parts)})"
+            else:
+                filename = f"logs-{level}.{extension}"
+                caption = f"Логи уровня: {level}"
+
+            with open(path, 'rb') as file:
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=file,
+                    filename=filename,
+                    caption=caption
+                )
+        return len(parts)
+    finally:
+        for path in parts:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
 async def send_logs_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, level: str):
     """Отправка логов через кнопку"""
     query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-
     await query.edit_message_text(f"📋 Подготавливаю логи уровня {level}...")
 
     if not os.path.exists(LOG_FILE):
@@ -3087,77 +5450,20 @@ async def send_logs_callback(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return
 
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as temp_file:
-            temp_path = temp_file.name
-
-            if level == "ALL":
-                with open(LOG_FILE, 'r') as log_file:
-                    temp_file.write(log_file.read())
-            else:
-                with open(LOG_FILE, 'r') as log_file:
-                    for line in log_file:
-                        if re.search(f'\\b{level}\\b', line, re.IGNORECASE):
-                            temp_file.write(line)
-
-        file_size = os.path.getsize(temp_path)
-        if file_size == 0:
+        sent_parts = await send_logs_export(context.bot, query.message.chat_id, level)
+        if sent_parts == 0:
             await query.edit_message_text(f"❌ Логи уровня {level} не найдены")
-            os.unlink(temp_path)
             await show_logs_menu(update, context)
             return
 
-        with open(temp_path, 'rb') as file:
-            await context.bot.send_document(
-                chat_id=query.message.chat_id,
-                document=file,
-                filename=f"logs-{level}.txt",
-                caption=f"Логи уровня: {level}"
-            )
-
-        os.unlink(temp_path)
         await query.edit_message_text(f"✅ Логи уровня {level} отправлены")
 
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка при обработке логов: {str(e)}")
-        try:
-            if 'temp_path' in locals():
-                os.unlink(temp_path)
-        except:
-            pass
 
     await asyncio.sleep(2)
     await show_logs_menu(update, context)
 
-async def open_logs_dir_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Открытие папки логов через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-
-    if not os.path.exists(USERBOT_DIR):
-        await query.edit_message_text("❌ Директория юзербота не найдена")
-        return
-
-    try:
-        process = await asyncio.create_subprocess_shell(
-            f"cd {USERBOT_DIR} && ls -la",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-
-        if process.returncode == 0:
-            files_list = stdout.decode()[:4000]  # Ограничиваем длину
-            await query.edit_message_text(f"📁 Содержимое папки логов:\n```\n{files_list}\n```", parse_mode='Markdown')
-        else:
-            await query.edit_message_text("❌ Не удалось получить список файлов")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
-
 async def toggle_debug_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Переключение дебаг-режима через кнопку"""
     query = update.callback_query
@@ -3238,72 +5544,35 @@ async def open_logs_dir_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
         return
 
-    await query.edit_message_text("📁 Получаю список файлов...")
-
-    if not os.path.exists(USERBOT_DIR):
-        await query.edit_message_text("❌ Директория юзербота не найдена")
-        return
-
-    try:
-        # Устанавливаем правильные переменные окружения
-        env = os.environ.copy()
-        env['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:/home/alina/.venv/bin:/home/alina/.local/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            f"cd {USERBOT_DIR} && ls -la",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = await process.communicate()
-
-        if process.returncode == 0:
-            files_list = stdout.decode()[:4000]  # Ограничиваем длину
-            await query.edit_message_text(f"📁 Содержимое папки логов:\n```\n{files_list}\n```", parse_mode='Markdown')
-        else:
-            error_msg = stderr.decode()[:1000] if stderr else "Неизвестная ошибка"
-            await query.edit_message_text(f"❌ Не удалось получить список файлов: {error_msg}")
-
-    except Exception as e:
-        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
-
-async def ping_host_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, host: str):
-    """Ping хоста через кнопку"""
-    query = update.callback_query
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
-        return
-
-    await query.edit_message_text(f"🌐 Пингую {host}...")
+    await query.edit_message_text("📁 Получаю список файлов...")
+
+    if not os.path.exists(USERBOT_DIR):
+        await query.edit_message_text("❌ Директория юзербота не найдена")
+        return
 
     try:
+        # Устанавливаем правильные переменные окружения
+        env = os.environ.copy()
+        env['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:/home/alina/.venv/bin:/home/alina/.local/bin'
+
         process = await asyncio.create_subprocess_shell(
-            f"ping -c 3 {host}",
+            f"cd {USERBOT_DIR} && ls -la",
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            env=env
         )
         stdout, stderr = await process.communicate()
 
         if process.returncode == 0:
-            result = stdout.decode()
-            # Извлекаем время пинга из вывода
-            ping_times = re.findall(r'time=(\d+\.?\d*) ms', result)
-            if ping_times:
-                avg_ping = sum(float(t) for t in ping_times) / len(ping_times)
-                await query.edit_message_text(f"✅ {host} доступен\nСреднее время: {avg_ping:.1f} ms")
-            else:
-                await query.edit_message_text(f"✅ {host} доступен")
+            files_list = stdout.decode()[:4000]  # Ограничиваем длину
+            await query.edit_message_text(f"📁 Содержимое папки логов:\n```\n{files_list}\n```", parse_mode='Markdown')
         else:
-            await query.edit_message_text(f"❌ {host} недоступен")
+            error_msg = stderr.decode()[:1000] if stderr else "Неизвестная ошибка"
+            await query.edit_message_text(f"❌ Не удалось получить список файлов: {error_msg}")
 
     except Exception as e:
         await query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
-    await asyncio.sleep(2)
-    await show_ping_menu(update, context)
-
 async def add_me_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Добавление пользователя через кнопку"""
     query = update.callback_query
@@ -3313,12 +5582,11 @@ async def add_me_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
         return
 
-    if user_id == OWNER_ID:
+    if is_owner(user_id):
         await query.edit_message_text("❌ Вы уже являетесь владельцем")
         return
 
-    USER_IDS.add(user_id)
-    save_users(USER_IDS)  # Сохраняем изменения
+    set_user_role(user_id, "user")
     await query.edit_message_text("✅ Вы добавлены как пользователь")
     await asyncio.sleep(2)
     await show_users_menu(update, context)
@@ -3328,11 +5596,13 @@ async def list_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
 
     users_list = ["👥 Список пользователей:"]
-    users_list.append(f"👑 Владелец: {OWNER_ID}")
+    users_list.append(f"👑 Владелец: {OWNER_USER_ID}")
 
-    for uid in USER_IDS:
-        if uid != OWNER_ID:
+    for uid, role in sorted(USER_ROLES.items()):
+        if role == "user":
             users_list.append(f"👤 Пользователь: {uid}")
+        elif role == "viewer":
+            users_list.append(f"👁 Наблюдатель: {uid}")
 
     users_list.append(f"\nВсего: {len(USER_IDS)} пользователей")
 
@@ -3427,20 +5697,20 @@ async def update_heroku_callback(update: Update, context: ContextTypes.DEFAULT_T
 async def ping_host_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, host: str):
     """Ping хоста через кнопку"""
     query = update.callback_query
-    await query.edit_message_text(f"🌐 Пингую {host}...")
-    user_id = query.from_user.id
-
-    if not is_owner(user_id):
-        await query.answer("❌ Нильзя жмакать на эти кнопачки", show_alert=True)
+    # callback_data приходит от клиента - в команду попадает только имя хоста
+    if not PING_HOST_PATTERN.fullmatch(host):
+        await query.edit_message_text("❌ Неверное имя хоста")
         return
 
+    await query.edit_message_text(f"🌐 Пингую {host}...")
+
     try:
         # Устанавливаем правильные переменные окружения
         env = os.environ.copy()
         env['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:/home/alina/.venv/bin:/home/alina/.local/bin'
 
-        process = await asyncio.create_subprocess_shell(
-            f"ping -c 3 {host}",
+        process = await asyncio.create_subprocess_exec(
+            "ping", "-c", "3", host,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
             env=env
@@ -3568,50 +5838,22 @@ async def start_userbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Виртуальное окружение не найдено")
         return
 
-    cmd = f"cd {USERBOT_DIR} && {PROXY_CMD if use_proxy else USERBOT_CMD}"
-
     try:
         await update.message.reply_text("🔄 Запускаю юзербота...")
 
-        log_file_path = os.path.join(USERBOT_DIR, LOG_FILE)
-
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(3)
+        process = await spawn_userbot(context.bot, use_proxy=use_proxy)
 
-        is_running, _ = get_userbot_status()
+        is_running, ready_reason = await wait_userbot_ready(process)
         if is_running:
             await update.message.reply_text(f"✅ Юзербот запущен (PID: {process.pid})")
 
-            global monitor_task
+            global log_follow_task
             if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
+                if log_follow_task:
+                    log_follow_task.cancel()
+                log_follow_task = asyncio.create_task(monitor_userbot_logs(context.bot))
         else:
-            try:
-                if os.path.exists(log_file_path):
-                    with open(log_file_path, 'r') as f:
-                        error_output = f.read().strip()
-                        if error_output:
-                            error_msg = error_output[-500:]
-                            await update.message.reply_text(f"❌ Ошибка запуска: {error_msg}")
-                        else:
-                            await update.message.reply_text("❌ Юзербот не запустился (неизвестная ошибка)")
-                else:
-                    await update.message.reply_text("❌ Юзербот не запустился (не удалось прочитать логи)")
-            except:
-                await update.message.reply_text("❌ Юзербот не запустился (не удалось прочитать логи)")
+            await update.message.reply_text(f"❌ Юзербот не запустился\n\n{format_startup_failure(ready_reason)}")
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
@@ -3628,15 +5870,8 @@ async def stop_userbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Доступ запрещен")
         return
 
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            cmdline = proc.info['cmdline'] or []
-            cmdline_str = ' '.join(cmdline).lower()
-            if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-            continue
+    release_userbot_supervisor()
+    processes = get_userbot_processes()
 
     if not processes:
         await update.message.reply_text("⚠️ Юзербот не был запущен")
@@ -3702,18 +5937,30 @@ async def ram_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cpu_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_user(update.effective_user.id):
         return
-    cpu = psutil.cpu_percent(interval=1)
+    cpu = get_detailed_metrics()["cpu"]
     await update.message.reply_text(f"CPU: {cpu}%")
 
 async def disk_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_user(update.effective_user.id):
         return
-    disk = psutil.disk_usage('/')
-    await update.message.reply_text(
-        f"Disk: {disk.percent}%\n"
-        f"Used: {disk.used // (1024**3)} GB\n"
-        f"Total: {disk.total // (1024**3)} GB"
+    metrics = get_detailed_metrics()
+    text = (
+        f"Disk: {metrics['disk_percent']}%\n"
+        f"Used: {metrics['disk_used']} GB\n"
+        f"Total: {metrics['disk_total']} GB"
     )
+    if "userbot_disk_percent" in metrics:
+        text += (
+            f"\n\nUserbot FS: {metrics['userbot_disk_percent']}%\n"
+            f"Used: {metrics['userbot_disk_used_bytes'] // (1024**3)} GB\n"
+            f"Total: {metrics['userbot_disk_total_bytes'] // (1024**3)} GB"
+        )
+    # Пути из индекса могут сломать разметку - safe_send_message повторит отправку без нее
+    await safe_send_message(context.bot, update.effective_chat.id, f"{text}\n\n{format_disk_index()}", parse_mode='Markdown')
+
+async def disk_usage_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Крупнейшие файлы и каталоги USERBOT_DIR из индекса (без обхода диска)"""
+    await safe_send_message(context.bot, update.effective_chat.id, format_disk_index(detailed=True), parse_mode='Markdown')
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_user(update.effective_user.id):
@@ -3723,6 +5970,7 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_running:
         uptime = time.time() - start_time
         status_text += f"\nUptime: {int(uptime // 3600)}h {int((uptime % 3600) // 60)}m"
+        status_text += f"\n{format_userbot_resources(detailed=True)}"
     await update.message.reply_text(status_text)
 
 async def uptime(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3743,13 +5991,19 @@ async def uptime_userbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = "❌ Юзербот не запущен"
     await update.message.reply_text(text)
 
+# Имя хоста или IP для ping (без пробелов и спецсимволов оболочки)
+PING_HOST_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9.:-]{0,252}")
+
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_user(update.effective_user.id):
         return
     host = context.args[0] if context.args else "open.spotify.com"
+    if not PING_HOST_PATTERN.fullmatch(host):
+        await update.message.reply_text("❌ Неверное имя хоста")
+        return
     try:
-        result = await asyncio.create_subprocess_shell(
-            f"ping -c 1 {host}",
+        result = await asyncio.create_subprocess_exec(
+            "ping", "-c", "1", host,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
@@ -3805,18 +6059,12 @@ async def terminal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Ошибка: {str(e)}")
 
 async def logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-
-    if not is_owner(user_id):
-        await update.message.reply_text("❌ Доступ запрещен")
-        return
-
     if not context.args:
         await update.message.reply_text("❌ Укажите уровень логов: /logs <ALL/WARNING/INFO/ERROR/DEBUG>")
         return
 
     log_level = context.args[0].upper()
-    valid_levels = ["ALL", "WARNING", "INFO", "ERROR", "DEBUG"]
+    valid_levels = LOG_LEVELS
 
     if log_level not in valid_levels:
         await update.message.reply_text(f"❌ Неверный уровень. Допустимые: {', '.join(valid_levels)}")
@@ -3827,40 +6075,12 @@ async def logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as temp_file:
-            temp_path = temp_file.name
-
-            if log_level == "ALL":
-                with open(LOG_FILE, 'r') as log_file:
-                    temp_file.write(log_file.read())
-            else:
-                with open(LOG_FILE, 'r') as log_file:
-                    for line in log_file:
-                        if re.search(f'\\b{log_level}\\b', line, re.IGNORECASE):
-                            temp_file.write(line)
-
-        file_size = os.path.getsize(temp_path)
-        if file_size == 0:
+        sent_parts = await send_logs_export(context.bot, update.message.chat_id, log_level)
+        if sent_parts == 0:
             await update.message.reply_text(f"❌ Логи уровня {log_level} не найдены")
-            os.unlink(temp_path)
-            return
-
-        with open(temp_path, 'rb') as file:
-            await update.message.reply_document(
-                document=file,
-                filename=f"logs-{log_level}.txt",
-                caption=f"Логи уровня: {log_level}"
-            )
-
-        os.unlink(temp_path)
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка при обработке логов: {str(e)}")
-        try:
-            if 'temp_path' in locals():
-                os.unlink(temp_path)
-        except:
-            pass
 
 async def safe_send_message(bot, chat_id, text, **kwargs):
     """Безопасная отправка сообщения с обработкой ошибок сети и форматирования"""
@@ -3873,15 +6093,17 @@ async def safe_send_message(bot, chat_id, text, **kwargs):
         except BadRequest as e:
             if "Can't parse entities" in str(e):
                 # Если ошибка форматирования, пробуем без разметки
-                if 'parse_mode' in kwargs:
-                    kwargs_without_markdown = kwargs.copy()
-                    kwargs_without_markdown.pop('parse_mode', None)
-                    try:
-                        await bot.send_message(chat_id=chat_id, text=text, **kwargs_without_markdown)
-                        return True
-                    except Exception as fallback_error:
-                        print(f"Ошибка при отправке без разметки: {fallback_error}")
-                        return False
+                if 'parse_mode' not in kwargs:
+                    print(f"BadRequest при отправке сообщения: {e}")
+                    return False
+                kwargs_without_markdown = kwargs.copy()
+                kwargs_without_markdown.pop('parse_mode', None)
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, **kwargs_without_markdown)
+                    return True
+                except Exception as fallback_error:
+                    print(f"Ошибка при отправке без разметки: {fallback_error}")
+                    return False
             elif "Message is not modified" in str(e):
                 # Игнорируем эту ошибку
                 return True
@@ -3901,6 +6123,103 @@ async def safe_send_message(bot, chat_id, text, **kwargs):
             return False
     return False
 
+async def acquire_send_slot(chat_id):
+    """Ждет свободный слот с учетом глобального и поштучного (на чат) лимитов"""
+    while True:
+        async with broadcast_lock:
+            now = time.monotonic()
+            rate = BROADCAST_CONFIG["GLOBAL_RATE"]
+            interval = BROADCAST_CONFIG["PER_CHAT_INTERVAL"]
+            broadcast_bucket["tokens"] = min(rate, broadcast_bucket["tokens"] + (now - broadcast_bucket["updated"]) * rate)
+            broadcast_bucket["updated"] = now
+
+            # Отметки старше интервала уже ни на что не влияют
+            if now - broadcast_bucket["pruned"] >= CHAT_LAST_SEND_PRUNE_INTERVAL:
+                for stale_chat in [chat for chat, sent in chat_last_send.items() if now - sent >= interval]:
+                    del chat_last_send[stale_chat]
+                broadcast_bucket["pruned"] = now
+
+            chat_wait = chat_last_send.get(chat_id, 0) + interval - now
+            if broadcast_bucket["tokens"] >= 1 and chat_wait <= 0:
+                broadcast_bucket["tokens"] -= 1
+                chat_last_send[chat_id] = now
+                return
+
+            global_wait = (1 - broadcast_bucket["tokens"]) / rate if broadcast_bucket["tokens"] < 1 else 0
+            wait_time = max(chat_wait, global_wait)
+
+        await asyncio.sleep(wait_time)
+
+async def rate_limited_send(bot, chat_id, text, **kwargs):
+    """Отправляет сообщение с учетом лимитов Telegram и RetryAfter
+
+    Сетевые ошибки и RetryAfter считаются отдельно (по MAX_RETRIES каждый),
+    повтор без разметки попытку не расходует.
+    """
+    max_retries = BROADCAST_CONFIG["MAX_RETRIES"]
+    network_errors = 0
+    flood_waits = 0
+    while True:
+        await acquire_send_slot(chat_id)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            return True
+        except RetryAfter as e:
+            flood_waits += 1
+            if flood_waits > max_retries:
+                print(f"Telegram снова просит подождать, сообщение в {chat_id} не отправлено")
+                return False
+            wait_time = e.retry_after
+            if isinstance(wait_time, timedelta):
+                wait_time = wait_time.total_seconds()
+            print(f"Telegram просит подождать {wait_time} сек. (чат {chat_id})")
+            await asyncio.sleep(wait_time)
+        except Forbidden as e:
+            # Пользователь заблокировал бота - повторять бессмысленно
+            print(f"Чат {chat_id} недоступен: {e}")
+            return False
+        except BadRequest as e:
+            if "Can't parse entities" in str(e) and 'parse_mode' in kwargs:
+                kwargs = kwargs.copy()
+                kwargs.pop('parse_mode', None)
+                continue
+            print(f"BadRequest при отправке сообщения в {chat_id}: {e}")
+            return False
+        except (TimedOut, NetworkError) as e:
+            network_errors += 1
+            if network_errors >= max_retries:
+                print(f"Не удалось отправить сообщение в {chat_id} после {max_retries} попыток: {e}")
+                return False
+            await asyncio.sleep(2 ** (network_errors - 1))
+        except Exception as e:
+            print(f"Неожиданная ошибка при отправке сообщения в {chat_id}: {e}")
+            return False
+
+async def broadcast_message(bot, recipients, text, **kwargs):
+    """Параллельная рассылка сообщения с ограничением скорости
+
+    Возвращает словарь {chat_id: True/False} с результатом доставки.
+    """
+    recipients = list(dict.fromkeys(recipients))
+    if not recipients:
+        return {}
+
+    semaphore = asyncio.Semaphore(BROADCAST_CONFIG["MAX_CONCURRENCY"])
+
+    async def send_one(chat_id):
+        async with semaphore:
+            return await rate_limited_send(bot, chat_id, text, **kwargs)
+
+    results = await asyncio.gather(*(send_one(chat_id) for chat_id in recipients), return_exceptions=True)
+    delivery = {
+        chat_id: result is True
+        for chat_id, result in zip(recipients, results)
+    }
+
+    delivered = sum(delivery.values())
+    print(f"Рассылка: доставлено {delivered} из {len(recipients)}")
+    return delivery
+
 async def handle_network_errors(func, *args, **kwargs):
     """Обработчик сетевых ошибок для любых функций"""
     max_retries = 3
@@ -3927,42 +6246,219 @@ async def handle_network_errors(func, *args, **kwargs):
             print(f"Некорректный запрос в {func.__name__}: {e}")
             raise
 
-async def send_startup_notification(application):
-    """Отправляет уведомление о запуске бота с обработкой ошибок"""
-    try:
-        # Используем asyncio.wait_for вместо handle_network_errors
-        bot_info = await asyncio.wait_for(application.bot.get_me(), timeout=10)
-        message = f"🤖 Бот {bot_info.first_name} запущен и готов к работе!\n\n" \
-                 f"Используйте /start для просмотра команд"
-
-        sent_count = 0
-        for user_id in USER_IDS.copy():
-            try:
-                success = await safe_send_message(application.bot, user_id, message)
-                if success:
-                    sent_count += 1
-                    print(f"Уведомление отправлено пользователю {user_id}")
-                else:
-                    print(f"Не удалось отправить уведомление пользователю {user_id}")
-            except Exception as e:
-                print(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-
-        print(f"Уведомления отправлены {sent_count} пользователям из {len(USER_IDS)}")
-    except asyncio.TimeoutError:
-        print("Таймаут при получении информации о боте для уведомления о запуске")
-    except Exception as e:
-        print(f"Ошибка при отправке уведомлений: {e}")
-
 async def check_connection_health(bot):
     """Проверяет здоровье соединения с Telegram"""
+    global api_response_time_last
     try:
         # Простая проверка - получаем информацию о боте
+        started = time.time()
         await handle_network_errors(bot.get_me, timeout=10)
+        api_response_time_last = time.time() - started
         return True
     except Exception as e:
         print(f"Проверка соединения не удалась: {e}")
         return False
 
+# Вебхук вместо long polling
+async def webhook_endpoint(request):
+    """POST /<PATH>: принимает обновление от Telegram"""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not webhook_secret or not hmac.compare_digest(secret, webhook_secret):
+        return web.Response(status=403)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    application = request.app["application"]
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+def get_webhook_url():
+    """Публичный адрес вебхука (как его видит Telegram)"""
+    return WEBHOOK_CONFIG["PUBLIC_URL"].rstrip("/") + WEBHOOK_CONFIG["PATH"]
+
+async def start_webhook(application):
+    """Поднимает локальный aiohttp-сервер и регистрирует вебхук в Telegram"""
+    global webhook_runner, webhook_secret
+
+    webhook_secret = WEBHOOK_CONFIG["SECRET_TOKEN"] or secrets.token_urlsafe(32)
+
+    app = web.Application()
+    app["application"] = application
+    app.router.add_post(WEBHOOK_CONFIG["PATH"], webhook_endpoint)
+    webhook_runner = web.AppRunner(app, access_log=None)
+    await webhook_runner.setup()
+    site = web.TCPSite(webhook_runner, WEBHOOK_CONFIG["LISTEN_HOST"], WEBHOOK_CONFIG["LISTEN_PORT"])
+    await site.start()
+
+    await application.bot.set_webhook(
+        url=get_webhook_url(),
+        secret_token=webhook_secret,
+        max_connections=WEBHOOK_CONFIG["MAX_CONNECTIONS"],
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True
+    )
+
+async def stop_webhook():
+    """Останавливает локальный сервер вебхука"""
+    global webhook_runner, webhook_health_task
+    if webhook_health_task:
+        webhook_health_task.cancel()
+        webhook_health_task = None
+    if webhook_runner:
+        await webhook_runner.cleanup()
+        webhook_runner = None
+
+async def start_polling_updates(application, timeout=20.0):
+    """Запускает long polling (он же сам удаляет вебхук в Telegram)"""
+    global update_mode
+    await application.updater.start_polling(
+        poll_interval=1.0,
+        timeout=timeout,
+        drop_pending_updates=True
+    )
+    update_mode = "polling"
+
+async def webhook_health_loop(application):
+    """Следит за ошибками доставки вебхука и при проблемах переключается на polling"""
+    interval = WEBHOOK_CONFIG["HEALTH_CHECK_INTERVAL"]
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            info = await application.bot.get_webhook_info()
+        except (TimedOut, NetworkError) as e:
+            print(f"Не удалось получить статус вебхука: {e}")
+            continue
+
+        recent_error = info.last_error_date and (time.time() - info.last_error_date.timestamp()) < interval * 2
+        if info.url == get_webhook_url() and not (recent_error and info.pending_update_count):
+            continue
+
+        print(f"⚠️ Вебхук не доставляет обновления ({info.last_error_message or 'адрес сброшен'}), переключаюсь на polling")
+        asyncio.create_task(fallback_to_polling(application))
+        return
+
+async def fallback_to_polling(application):
+    """Переключает получение обновлений с вебхука на polling"""
+    await stop_webhook()
+    try:
+        await start_polling_updates(application)
+        print("Polling запущен (резервный режим)")
+    except Exception as e:
+        print(f"❌ Не удалось запустить polling: {e}")
+
+async def start_updates(application, timeout=20.0):
+    """Запускает получение обновлений: вебхук, если он настроен, иначе или при ошибке - polling"""
+    global update_mode, webhook_health_task
+
+    if WEBHOOK_CONFIG["ENABLED"] and WEBHOOK_CONFIG["PUBLIC_URL"]:
+        try:
+            await start_webhook(application)
+            update_mode = "webhook"
+            webhook_health_task = asyncio.create_task(webhook_health_loop(application))
+            print(f"Вебхук запущен: {get_webhook_url()} -> {WEBHOOK_CONFIG['LISTEN_HOST']}:{WEBHOOK_CONFIG['LISTEN_PORT']}")
+            return
+        except Exception as e:
+            print(f"❌ Не удалось включить вебхук, использую polling: {e}")
+            await stop_webhook()
+
+    await start_polling_updates(application, timeout)
+    print("Polling запущен")
+
+async def stop_updates(application):
+    """Останавливает получение обновлений в текущем режиме"""
+    await stop_webhook()
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+
+# Проверка вебхука без Telegram: python status-heroku-bot.py --check-webhook
+FAKE_BOT_TOKEN = "123456:CHECK"
+
+async def start_fake_bot_api(state):
+    """Локальный поддельный Bot API: отвечает на методы, которые нужны вебхуку и polling"""
+    async def handle(request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        state["calls"].append((method, params))
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Check", "username": "check_bot"}
+        elif method == "setWebhook" and state["fail_set_webhook"]:
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: bad webhook"}, status=400)
+        elif method == "getUpdates":
+            await asyncio.sleep(0.2)
+            result = []
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+def get_free_port():
+    """Свободный локальный TCP-порт"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def run_webhook_check():
+    """Регистрация вебхука, 403 на чужой секрет и откат на polling - против поддельного Bot API"""
+    global WEBHOOK_CONFIG
+    state = {"calls": [], "fail_set_webhook": False}
+    fake_runner, fake_port = await start_fake_bot_api(state)
+    saved_config = WEBHOOK_CONFIG
+    WEBHOOK_CONFIG = dict(
+        saved_config, ENABLED=True, PUBLIC_URL="https://check.invalid", PATH="/telegram",
+        LISTEN_HOST="127.0.0.1", LISTEN_PORT=get_free_port(), SECRET_TOKEN="check-secret"
+    )
+    base_url = f"http://127.0.0.1:{fake_port}"
+    application = Application.builder().token(FAKE_BOT_TOKEN).base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot").build()
+    results = []
+
+    def check(name, ok):
+        results.append(ok)
+        print(f"{'✅' if ok else '❌'} {name}")
+
+    try:
+        await application.initialize()
+
+        # 1. Вебхук регистрируется с нашим адресом и секретом
+        await start_updates(application)
+        registered = [params for method, params in state["calls"] if method == "setWebhook"]
+        check("setWebhook вызван с адресом и секретом", update_mode == "webhook" and bool(registered)
+              and registered[-1].get("url") == get_webhook_url() and registered[-1].get("secret_token") == "check-secret")
+
+        # 2. Чужой секрет - 403, правильный - 200
+        url = f"http://127.0.0.1:{WEBHOOK_CONFIG['LISTEN_PORT']}{WEBHOOK_CONFIG['PATH']}"
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"update_id": 1}, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                check("неверный X-Telegram-Bot-Api-Secret-Token отклонен (403)", response.status == 403)
+            async with session.post(url, json={"update_id": 2}, headers={"X-Telegram-Bot-Api-Secret-Token": "check-secret"}) as response:
+                check("верный секрет принят (200)", response.status == 200)
+        await stop_updates(application)
+
+        # 3. setWebhook с ошибкой - переходим на polling
+        state["fail_set_webhook"] = True
+        await start_updates(application)
+        check("при ошибке setWebhook включен polling", update_mode == "polling" and application.updater.running)
+        await stop_updates(application)
+    finally:
+        await stop_updates(application)
+        await application.shutdown()
+        WEBHOOK_CONFIG = saved_config
+        await fake_runner.cleanup()
+
+    return all(results)
+
 async def restart_application(application):
     """Безопасно перезапускает приложение"""
     global reconnect_attempts, is_reconnecting
@@ -3975,8 +6471,7 @@ async def restart_application(application):
 
     try:
         print("Останавливаю приложение...")
-        if application.updater and application.updater.running:
-            await application.updater.stop()
+        await stop_updates(application)
 
         if application.running:
             await application.stop()
@@ -3989,11 +6484,7 @@ async def restart_application(application):
         await application.start()
 
         if application.updater:
-            await application.updater.start_polling(
-                poll_interval=1.0,
-                timeout=10.0,
-                drop_pending_updates=True
-            )
+            await start_updates(application, timeout=10.0)
 
         # Сбрасываем счетчик попыток при успешном переподключении
         reconnect_attempts = 0
@@ -4046,16 +6537,11 @@ async def robust_polling(application):
 
     while reconnect_attempts < RECONNECT_CONFIG['max_retries']:
         try:
-            print("Запускаю polling...")
-            await application.updater.start_polling(
-                poll_interval=1.0,
-                timeout=20.0,  # Увеличиваем таймаут
-                drop_pending_updates=True
-            )
+            print("Запускаю получение обновлений...")
+            await start_updates(application)
 
             # Если polling запущен успешно, сбрасываем счетчик
             reconnect_attempts = 0
-            print("Polling успешно запущен!")
 
             # Запускаем watchdog для мониторинга соединения
             asyncio.create_task(connection_watchdog(application))
@@ -4147,19 +6633,14 @@ async def debug_userbot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if os.path.exists(log_file_path):
         file_size = os.path.getsize(log_file_path)
         diagnostic_messages.append(f"✅ Файл логов существует ({file_size} bytes)")
-
-        try:
-            with open(log_file_path, 'r') as f:
-                lines = f.readlines()
-                if lines:
-                    last_lines = lines[-5:]
-                    diagnostic_messages.append("Последние логи:")
-                    diagnostic_messages.extend([f"  {line.strip()}" for line in last_lines])
-        except Exception as e:
-            diagnostic_messages.append(f"❌ Ошибка чтения логов: {e}")
     else:
         diagnostic_messages.append("❌ Файл логов не существует")
 
+    last_lines = get_userbot_output_tail(5)
+    if last_lines:
+        diagnostic_messages.append("Последние логи:")
+        diagnostic_messages.extend([f"  {line.strip()}" for line in last_lines])
+
     await update.message.reply_text("\n".join(diagnostic_messages))
 
 async def get_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -4170,10 +6651,7 @@ async def get_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
 
-    user_id = update.effective_user.id
-    USER_IDS.add(user_id)
-    save_users(USER_IDS)  # Сохраняем изменения
-    await update.message.reply_text("✅ Вы добавлены как пользователь")
+    await update.message.reply_text("✅ Вы владелец и уже есть в списке пользователей")
 
 async def get_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type != "private":
@@ -4185,20 +6663,74 @@ async def get_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if context.args:
-        try:
-            user_id = int(context.args[0])
-            USER_IDS.add(user_id)
-            save_users(USER_IDS)  # Сохраняем изменения
-            await update.message.reply_text(f"✅ Пользователь {user_id} добавлен")
-        except ValueError:
+        user_id = normalize_user_id(context.args[0])
+        role = context.args[1].lower() if len(context.args) > 1 else "user"
+        if user_id is None:
             await update.message.reply_text("❌ Неверный ID пользователя")
+        elif role not in ("user", "viewer"):
+            await update.message.reply_text("❌ Роль должна быть user или viewer")
+        elif set_user_role(user_id, role):
+            await update.message.reply_text(f"✅ Пользователь {user_id} добавлен (роль: {role})")
+        else:
+            await update.message.reply_text("❌ Нельзя изменить роль владельца")
     else:
-        await update.message.reply_text("❌ Укажите ID пользователя: /get_user <id>")
+        await update.message.reply_text("❌ Укажите ID пользователя: /get_user <id> [user|viewer]")
 
 # Мониторинг логов юзербота
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+LOG_FOLLOW_POLL_INTERVAL = 2
+
+def create_log_watch(log_file_path):
+    """Создает inotify-наблюдение за каталогом логов (None, если недоступно)"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+
+        # Следим за каталогом, чтобы заметить ротацию (новый файл с тем же именем)
+        mask = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        directory = os.path.dirname(os.path.abspath(log_file_path))
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except Exception as e:
+        print(f"inotify недоступен, используется опрос файла: {e}")
+        return None
+
+def read_log_watch_events(fd, filename):
+    """Вычитывает события inotify, True - если затронут файл логов"""
+    touched = False
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            break
+        if not data:
+            break
+
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            _, _, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0").decode(errors="replace")
+            offset += name_len
+            if name == filename:
+                touched = True
+    return touched
+
 async def monitor_userbot_logs(bot):
     """Мониторит вывод юзербота и отправляет в дебаг-чаты"""
     log_file_path = os.path.join(USERBOT_DIR, LOG_FILE)
+    filename = os.path.basename(log_file_path)
 
     for i in range(30):
         if os.path.exists(log_file_path):
@@ -4209,53 +6741,105 @@ async def monitor_userbot_logs(bot):
         await send_debug_message("❌ Файл логов не создался", bot)
         return
 
-    last_position = 0
+    # Юзербот должен быть известен реестру процессов, чтобы узнать о его завершении
+    get_userbot_status()
+
+    loop = asyncio.get_running_loop()
+    log_changed = asyncio.Event()
+    watch_fd = create_log_watch(log_file_path)
+    if watch_fd is not None:
+        def on_watch_event():
+            if read_log_watch_events(watch_fd, filename):
+                log_changed.set()
+        loop.add_reader(watch_fd, on_watch_event)
+
+    log_file = open(log_file_path, 'rb')
+    log_inode = os.fstat(log_file.fileno()).st_ino
+    partial = b''
     buffer = []
     buffer_size = 10  # Количество строк в одном сообщении
     last_flush_time = time.time()
     flush_interval = 5  # Секунды между отправками
 
-    while True:
-        try:
-            if not os.path.exists(log_file_path):
-                await send_debug_message("⚠️ Файл логов удален", bot)
-                break
+    async def flush(force=False):
+        nonlocal last_flush_time
+        current_time = time.time()
+        if buffer and (force or len(buffer) >= buffer_size or
+                       current_time - last_flush_time >= flush_interval):
+            combined = "\n".join(buffer[-buffer_size:])  # Берем последние N строк
+            await send_debug_message(combined, bot)
+            buffer.clear()
+            last_flush_time = current_time
+
+    def read_new_lines():
+        nonlocal partial
+        data = log_file.read()
+        if not data:
+            return
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            line = line.decode(errors='replace').strip()
+            if line:
+                buffer.append(line)
 
-            with open(log_file_path, 'r') as f:
-                f.seek(last_position)
-                new_lines = f.readlines()
-                last_position = f.tell()
-
-                for line in new_lines:
-                    line = line.strip()
-                    if line:
-                        buffer.append(line)
-
-                        # Отправляем если буфер заполнен или прошло достаточно времени
-                        current_time = time.time()
-                        if (len(buffer) >= buffer_size or
-                            current_time - last_flush_time >= flush_interval):
-                            if buffer:
-                                combined = "\n".join(buffer[-buffer_size:])  # Берем последние N строк
-                                await send_debug_message(combined, bot)
-                                buffer.clear()
-                                last_flush_time = current_time
-
-            is_running, _ = get_userbot_status()
-            if not is_running:
-                # При завершении отправляем оставшиеся логи
-                if buffer:
-                    combined = "\n".join(buffer)
-                    await send_debug_message(f"🔴 Юзербот завершил работу\nПоследние логи:\n{combined}", bot)
-                else:
-                    await send_debug_message("🔴 Юзербот завершил работу", bot)
-                break
+    try:
+        while True:
+            try:
+                read_new_lines()
+                await flush()
 
-            await asyncio.sleep(2)
+                try:
+                    stat = os.stat(log_file_path)
+                except FileNotFoundError:
+                    stat = None
 
-        except Exception as e:
-            print(f"Ошибка чтения логов: {e}")
-            await asyncio.sleep(5)
+                if stat is None:
+                    await send_debug_message("⚠️ Файл логов удален", bot)
+                    break
+
+                if stat.st_ino != log_inode:
+                    # Ротация: дочитываем старый файл и открываем новый
+                    read_new_lines()
+                    log_file.close()
+                    log_file = open(log_file_path, 'rb')
+                    log_inode = os.fstat(log_file.fileno()).st_ino
+                    partial = b''
+                    continue
+
+                if stat.st_size < log_file.tell():
+                    # Файл усечен - читаем с начала
+                    log_file.seek(0)
+                    partial = b''
+                    continue
+
+                if not get_tracked_userbot():
+                    read_new_lines()
+                    # При завершении отправляем оставшиеся логи
+                    if buffer:
+                        combined = "\n".join(buffer)
+                        await send_debug_message(f"🔴 Юзербот завершил работу\nПоследние логи:\n{combined}", bot)
+                    else:
+                        await send_debug_message("🔴 Юзербот завершил работу", bot)
+                    break
+
+                if watch_fd is not None:
+                    try:
+                        await asyncio.wait_for(log_changed.wait(), timeout=flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    log_changed.clear()
+                else:
+                    await asyncio.sleep(LOG_FOLLOW_POLL_INTERVAL)
+
+            except Exception as e:
+                print(f"Ошибка чтения логов: {e}")
+                await asyncio.sleep(5)
+    finally:
+        log_file.close()
+        if watch_fd is not None:
+            loop.remove_reader(watch_fd)
+            os.close(watch_fd)
 
 
 async def handle_chosen_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -4298,38 +6882,24 @@ async def execute_inline_start_userbot(chosen_result, context):
             return
 
         # Запускаем юзербота
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
-
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(5)
+        process = await spawn_userbot(context.bot)
 
-        is_running, _ = get_userbot_status()
+        is_running, ready_reason = await wait_userbot_ready(process)
         if is_running:
             await context.bot.send_message(
                 chat_id=chosen_result.from_user.id,
                 text="✅ Юзербот успешно запущен через инлайн-режим!"
             )
 
-            global monitor_task
+            global log_follow_task
             if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
+                if log_follow_task:
+                    log_follow_task.cancel()
+                log_follow_task = asyncio.create_task(monitor_userbot_logs(context.bot))
         else:
             await context.bot.send_message(
                 chat_id=chosen_result.from_user.id,
-                text="❌ Не удалось запустить юзербота через инлайн-режим. Проверьте логи."
+                text=f"❌ Не удалось запустить юзербота через инлайн-режим.\n\n{format_startup_failure(ready_reason)}"
             )
 
     except Exception as e:
@@ -4346,15 +6916,8 @@ async def execute_inline_stop_userbot(chosen_result, context):
             text="🛑 Останавливаю юзербота через инлайн-режим..."
         )
 
-        processes = []
-        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-            try:
-                cmdline = proc.info['cmdline'] or []
-                cmdline_str = ' '.join(cmdline).lower()
-                if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                    processes.append(proc)
-            except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-                continue
+        release_userbot_supervisor()
+        processes = get_userbot_processes()
 
         if not processes:
             await context.bot.send_message(
@@ -4417,15 +6980,9 @@ async def execute_inline_restart_userbot(chosen_result, context):
         )
 
         # Сначала останавливаем
-        processes = []
-        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-            try:
-                cmdline = proc.info['cmdline'] or []
-                cmdline_str = ' '.join(cmdline).lower()
-                if ('python' in cmdline_str and 'heroku' in cmdline_str and '--no-web' in cmdline_str):
-                    processes.append(proc)
-            except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
-                continue
+        restart_requested = time.time()
+        release_userbot_supervisor()
+        processes = get_userbot_processes()
 
         if processes:
             for proc in processes:
@@ -4460,38 +7017,24 @@ async def execute_inline_restart_userbot(chosen_result, context):
                     pass
 
         # Запускаем заново
-        cmd = f"cd {USERBOT_DIR} && {USERBOT_CMD}"
-
-        env = os.environ.copy()
-        env['GIT_PYTHON_REFRESH'] = 'quiet'
-        env['PATH'] = '/usr/bin:/bin:/usr/local/bin:/home/alina/.venv/bin'
-
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            cwd=USERBOT_DIR,
-            env=env
-        )
-
-        await asyncio.sleep(5)
+        process = await spawn_userbot(context.bot)
 
-        is_running, _ = get_userbot_status()
+        is_running, ready_reason = await wait_userbot_ready(process, restart_started=restart_requested)
         if is_running:
             await context.bot.send_message(
                 chat_id=chosen_result.from_user.id,
                 text="✅ Юзербот успешно перезапущен через инлайн-режим!"
             )
 
-            global monitor_task
+            global log_follow_task
             if DEBUG_CHATS:
-                if monitor_task:
-                    monitor_task.cancel()
-                monitor_task = asyncio.create_task(monitor_userbot_logs(context.bot))
+                if log_follow_task:
+                    log_follow_task.cancel()
+                log_follow_task = asyncio.create_task(monitor_userbot_logs(context.bot))
         else:
             await context.bot.send_message(
                 chat_id=chosen_result.from_user.id,
-                text="❌ Не удалось перезапустить юзербота через инлайн-режим. Проверьте логи."
+                text=f"❌ Не удалось перезапустить юзербота через инлайн-режим.\n\n{format_startup_failure(ready_reason)}"
             )
 
     except Exception as e:
@@ -4582,15 +7125,184 @@ async def send_startup_notification(application):
         message = f"🤖 Бот {bot_info.first_name} запущен и готов к работе!\n\n" \
                  f"Используйте /menu для просмотра меню"
 
-        for user_id in USER_IDS:
-            try:
-                await application.bot.send_message(chat_id=user_id, text=message)
-                print(f"Уведомление отправлено пользователю {user_id}")
-            except Exception as e:
-                print(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        await broadcast_message(application.bot, USER_IDS, message)
     except Exception as e:
         print(f"Ошибка при отправке уведомлений: {e}")
 
+# Таблица действий: callback_data и команды -> обработчик и минимальная роль
+# (viewer - только просмотр, user - проверки и подтверждение алертов,
+# owner - управление, логи, ping и все, что касается файлов юзербота)
+CALLBACK_ROUTES = [
+    # Меню и просмотр
+    ("main_menu", show_main_menu, "viewer"),
+    ("status", status_callback, "viewer"),
+    ("system_info", system_info_callback, "viewer"),
+    ("detailed_info", detailed_info_callback, "viewer"),
+    ("about_bot", about_bot, "viewer"),
+    ("help", show_help, "viewer"),
+    ("settings", show_settings_menu, "viewer"),
+    ("connection_status", connection_status, "viewer"),
+    ("monitoring_status", monitoring_status, "viewer"),
+    ("load_graph", show_load_graph, "viewer"),
+    ("scheduler_status", scheduler_status, "viewer"),
+
+    # Логи, проверки и отчеты
+    ("logs_menu", show_logs_menu, "owner"),
+    ("ping_menu", show_ping_menu, "owner"),
+    ("force_connection_check", force_connection_check, "user"),
+    ("generate_report", generate_report, "owner"),
+    ("updates_menu", show_updates_menu, "user"),
+    ("check_updates", check_updates_callback, "owner"),
+
+    # Управление юзерботом
+    ("start_userbot", start_userbot_callback, "owner"),
+    ("start_proxy", start_userbot_proxy_callback, "owner"),
+    ("stop_userbot", stop_userbot_callback, "owner"),
+    ("management", show_management_menu, "owner"),
+    ("install_requirements", install_requirements_callback, "owner"),
+    ("update_heroku", update_heroku_callback, "owner"),
+    ("debug_userbot", debug_userbot_callback, "owner"),
+    ("open_logs_dir", open_logs_dir_callback, "owner"),
+    ("fleet", show_fleet_menu, "owner"),
+    ("fleet_start", functools.partial(fleet_action_callback, action="start"), "owner"),
+    ("fleet_stop", functools.partial(fleet_action_callback, action="stop"), "owner"),
+    ("fleet_restart", functools.partial(fleet_action_callback, action="restart"), "owner"),
+
+    # Бот, мониторинг и планировщик
+    ("update_bot", update_bot_callback, "owner"),
+    ("restart_bot", restart_bot, "owner"),
+    ("toggle_debug", toggle_debug_callback, "owner"),
+    ("terminal_menu", show_terminal_menu, "owner"),
+    ("test_alert", test_alert, "owner"),
+    ("monitoring_settings", monitoring_settings, "owner"),
+    ("performance", show_performance_menu, "owner"),
+    ("performance_reset", reset_performance_stats, "owner"),
+    ("scheduler_settings", scheduler_settings, "owner"),
+    ("toggle_auto_restart", toggle_auto_restart, "owner"),
+    ("toggle_scheduler", toggle_scheduler, "owner"),
+    ("set_restart_time", set_restart_time, "owner"),
+    ("set_clean_days", set_clean_days, "owner"),
+    ("apply_scheduler_settings", apply_scheduler_settings, "owner"),
+    ("save_scheduler_config", save_scheduler_config, "owner"),
+
+    # Пользователи
+    ("users_menu", show_users_menu, "owner"),
+    ("add_me", add_me_callback, "owner"),
+    ("list_users", list_users_callback, "owner"),
+    ("delete_user", delete_user_callback, "owner")
+]
+
+async def handle_time_setting_button(update: Update, context: ContextTypes.DEFAULT_TYPE, value):
+    """set_time_/set_restart_/set_logs_/set_tz_: значение разбирает handle_time_setting"""
+    await handle_time_setting(update, context)
+
+# Параметризованные callback_data: префикс -> обработчик(update, context, остаток)
+PREFIX_ROUTES = [
+    ("load_graph_", show_load_graph, "viewer"),
+    ("logs_", send_logs_callback, "owner"),
+    ("ping_", ping_host_callback, "owner"),
+    ("alert_ack_", acknowledge_alert_callback, "user"),
+    ("fleet_logs_", show_fleet_logs, "owner"),
+    ("del_user_", delete_specific_user_callback, "owner"),
+    ("terminal_", execute_terminal_command, "owner"),
+    ("set_time_", handle_time_setting_button, "owner"),
+    ("set_restart_", handle_time_setting_button, "owner"),
+    ("set_logs_", handle_time_setting_button, "owner"),
+    ("set_tz_", handle_time_setting_button, "owner")
+]
+
+COMMAND_ROUTES = [
+    ("start", start, "viewer"),
+    ("menu", show_main_menu, "viewer"),
+    ("status", status, "viewer"),
+    ("info", system_info, "viewer"),
+    ("detailed_info", detailed_info, "viewer"),
+    ("ram", ram_info, "viewer"),
+    ("cpu", cpu_info, "viewer"),
+    ("disk", disk_info, "viewer"),
+    ("uptime", uptime, "viewer"),
+    ("uptime_userbot", uptime_userbot, "viewer"),
+    ("connection_status", connection_status, "viewer"),
+    ("monitoring", monitoring_status, "viewer"),
+    ("logs", logs, "owner"),
+    ("ping", ping, "owner"),
+    ("du", disk_usage_report, "owner"),
+    ("check_updates", check_updates, "owner"),
+    ("start_userbot", start_userbot, "owner"),
+    ("stop_userbot", stop_userbot, "owner"),
+    ("restart_userbot", restart_userbot, "owner"),
+    ("restart_bot", restart_bot, "owner"),
+    ("update_bot", update_bot, "owner"),
+    ("install_requirements", install_requirements, "owner"),
+    ("update_heroku", update_heroku, "owner"),
+    ("debug_on", start_debug, "owner"),
+    ("debug_off", stop_debug, "owner"),
+    ("debug_userbot", debug_userbot, "owner"),
+    ("terminal", terminal, "owner"),
+    ("reload_config", reload_config_command, "owner"),
+    ("fleet", fleet_command, "owner"),
+    ("get_owner", get_owner, "owner"),
+    ("get_user", get_user, "owner"),
+    ("del_user", del_user, "owner")
+]
+
+def index_routes(kind, routes):
+    """Строит {ключ: (обработчик, роль)}; повторная регистрация ключа - ошибка при запуске"""
+    table = {}
+    duplicates = []
+    for key, handler, role in routes:
+        if role not in ROLE_LEVELS:
+            raise ValueError(f"Неизвестная роль {role} для маршрута {kind}:{key}")
+        if key in table:
+            duplicates.append(key)
+        table[key] = (handler, role)
+
+    if duplicates:
+        raise ValueError(f"Повторная регистрация маршрутов {kind}: {', '.join(duplicates)}")
+    return table
+
+def build_prefix_trie(prefix_actions):
+    """Префиксное дерево по символам: узел - dict, маршрут лежит в узле под ключом None"""
+    trie = {}
+    for prefix, (handler, _) in prefix_actions.items():
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = (prefix, handler)
+    return trie
+
+def build_action_roles():
+    """Сводит все таблицы в {имя действия: минимальная роль}"""
+    roles = {f"callback:{data}": role for data, (_, role) in CALLBACK_ACTIONS.items()}
+    roles.update({f"callback:{prefix}*": role for prefix, (_, role) in PREFIX_ACTIONS.items()})
+    roles.update({f"command:{name}": role for name, (_, role) in COMMAND_ACTIONS.items()})
+    return roles
+
+CALLBACK_ACTIONS = index_routes("callback", CALLBACK_ROUTES)
+PREFIX_ACTIONS = index_routes("prefix", PREFIX_ROUTES)
+COMMAND_ACTIONS = index_routes("command", COMMAND_ROUTES)
+PREFIX_TRIE = build_prefix_trie(PREFIX_ACTIONS)
+ACTION_ROLES.update(build_action_roles())
+
+def count_dispatch(action):
+    """Учитывает срабатывание маршрута"""
+    route_dispatch_counts[action] = route_dispatch_counts.get(action, 0) + 1
+
+def make_command_handler(name, handler):
+    """Оборачивает команду проверкой роли по таблице действий"""
+    action = f"command:{name}"
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not can_run_action(update.effective_user.id, action):
+            if is_user(update.effective_user.id):
+                await update.message.reply_text("❌ Доступ запрещен")
+            return
+        count_dispatch(action)
+        await handler(update, context)
+    return wrapper
+
+
 async def main():
     """Главная функция"""
     global USER_IDS, monitor_task
@@ -4614,21 +7326,24 @@ async def main():
     load_users()
     print(f"Загружено пользователей: {len(USER_IDS)}")
 
-    # Загружаем конфигурацию заново для актуальности
-    global CONFIG, MONITORING_CONFIG, SCHEDULED_TASKS_CONFIG
-    CONFIG = load_config()
-    MONITORING_CONFIG = CONFIG.get("MONITORING", DEFAULT_CONFIG["MONITORING"])
-    SCHEDULED_TASKS_CONFIG = CONFIG.get("SCHEDULED_TASKS", DEFAULT_CONFIG["SCHEDULED_TASKS"])
+    # Подхватываем юзербота, запущенного до перезапуска бота
+    load_userbot_pidfile()
+
+    # Активные алерты переживают перезапуск и не рассылаются повторно
+    load_alert_state()
 
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(BOT_TOKEN)
+    if BOT_API_BASE_URL:
+        # Свой сервер Bot API (например, локальный или тестовый)
+        builder = builder.base_url(f"{BOT_API_BASE_URL.rstrip('/')}/bot").base_file_url(f"{BOT_API_BASE_URL.rstrip('/')}/file/bot")
+    application = builder.build()
 
-    # Регистрируем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("menu", show_main_menu))
-    application.add_handler(CommandHandler("monitoring", monitoring_status))
+    # Регистрируем обработчики из таблицы действий
+    for name, (handler, _) in COMMAND_ACTIONS.items():
+        application.add_handler(CommandHandler(name, timed_handler(make_command_handler(name, handler))))
 
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(timed_handler(button_handler)))
 
     print("Бот инициализирован")
 
@@ -4636,32 +7351,43 @@ async def main():
         await application.initialize()
         await application.start()
 
-        await application.updater.start_polling(
-            poll_interval=1.0,
-            timeout=20.0,
-            drop_pending_updates=True
-        )
+        await start_updates(application)
 
-        print("Polling запущен")
+        # Запускаем фоновый сбор метрик
+        await start_metrics_sampler()
+        await start_loop_lag_probe()
+        await start_metrics_exporter()
 
         # Запускаем планировщик задач
         await setup_scheduler(application)
 
-        # Запускаем мониторинг системы
-        if MONITORING_CONFIG["ENABLED"]:
-            print(f"Запуск мониторинга (интервал: {MONITORING_CONFIG['CHECK_INTERVAL']} сек)")
+        # Запускаем фоновую проверку обновлений
+        await start_update_checker(application)
 
-            # Фоновая задача для мониторинга
-            async def monitoring_loop():
-                while True:
-                    try:
-                        await check_system_health(application)
-                    except Exception as e:
-                        print(f"Ошибка мониторинга: {e}")
-                    await asyncio.sleep(MONITORING_CONFIG["CHECK_INTERVAL"])
+        # Следим за ростом памяти юзербота
+        await start_leak_detector(application)
+
+        # Индексируем размеры файлов в каталоге юзербота
+        await start_disk_index()
 
-            monitor_task = asyncio.create_task(monitoring_loop())
-            print("Система мониторинга запущена")
+        # Следим за config.json
+        await start_config_watcher(application)
+
+        # Запускаем мониторинг системы (цикл работает всегда, чтобы MONITORING.ENABLED
+        # можно было включить в config.json без перезапуска)
+        print(f"Запуск мониторинга (интервал: {MONITORING_CONFIG['CHECK_INTERVAL']} сек)")
+
+        # Фоновая задача для мониторинга
+        async def monitoring_loop():
+            while True:
+                try:
+                    await check_system_health(application)
+                except Exception as e:
+                    print(f"Ошибка мониторинга: {e}")
+                await asyncio.sleep(MONITORING_CONFIG["CHECK_INTERVAL"])
+
+        monitor_task = asyncio.create_task(monitoring_loop())
+        print("Система мониторинга запущена")
 
         print("Бот успешно запущен и готов к работе!")
 
@@ -4673,11 +7399,7 @@ async def main():
 • Версия: {BOT_VERSION}
         """
 
-        for user_id in USER_IDS:
-            try:
-                await safe_send_message(application.bot, user_id, startup_message, parse_mode='Markdown')
-            except Exception as e:
-                print(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        await broadcast_message(application.bot, USER_IDS, startup_message, parse_mode='Markdown')
 
         # Бесконечный цикл
         while True:
@@ -4690,12 +7412,22 @@ async def main():
 
 
         await stop_monitoring()
+        await stop_config_watcher()
+        await stop_metrics_sampler()
+        await stop_supervisor()
+        if output_file_state["file"]:
+            output_file_state["file"].close()
+        await stop_loop_lag_probe()
+        await stop_metrics_exporter()
+        await stop_leak_detector()
+        await stop_disk_index()
+        close_metrics_db()
+        await stop_update_checker()
         await stop_scheduler()
 
         # Останавливаем приложение
         try:
-            if application.updater:
-                await application.updater.stop()
+            await stop_updates(application)
             await application.stop()
             await application.shutdown()
         except Exception as e:
@@ -4704,6 +7436,9 @@ async def main():
         print("Бот остановлен")
 
 if __name__ == "__main__":
+    if "--check-webhook" in sys.argv:
+        sys.exit(0 if asyncio.run(run_webhook_check()) else 1)
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: